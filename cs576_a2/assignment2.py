@@ -1,3 +1,8 @@
+import io
+import os
+import sys
+import numpy as np
+import multiprocessing as mp
 from PIL import Image
 from tqdm import tqdm
 from pathlib import Path
@@ -6,9 +11,20 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 from torchvision import transforms
 
+# shared data utilities of cs576_a3.
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'cs576_a3'))
+from image_cache import DecodedImageCache
+from amp import autocast, grad_scaler
+from checkpoint import CheckpointManager
+from metrics import MetricLogger, peak_rss_mb
+from profiler import StageProfiler
+from shards import ShardReader, ShardedIterableDataset
+from loader import make_loader, loader_settings
+
 class ResBlockPlain(nn.Module):
     def __init__(self, in_channels, use_bn=False):
         super(ResBlockPlain, self).__init__()
@@ -120,6 +136,11 @@ class Print(nn.Module):
         print(self.msg, x.shape)
         return x
 
+def decode_image(source):
+    """ Decode a CIFAR10 image, given its path or its encoded bytes, into a uint8 array of shape (3, 32, 32). """
+    image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    return np.asarray(image.convert('RGB')).transpose(2, 0, 1)
+
 class CIFAR10(Dataset):
     """Customized `CIFAR10 <https://www.cs.toronto.edu/~kriz/cifar.html>`_ Dataset.
 
@@ -161,7 +182,7 @@ class CIFAR10(Dataset):
                     `-- 06000.png
 
     """
-    def __init__(self, root, train=True, transform=None):
+    def __init__(self, root, train=True, transform=None, image_cache=None, shards=None, preload=False, preload_path=None):
         super(CIFAR10, self).__init__()
         """
         Instructions: 
@@ -181,8 +202,21 @@ class CIFAR10(Dataset):
                 creates from test set. (default: True)
             transform (callable, optional): A function/transform that takes in an PIL image
                 and returns a transformed version. E.g, ``transforms.RandomCrop`` (default: None)
+            image_cache (DecodedImageCache, optional): Cache of decoded images shared by DataLoader workers.
+                The transform still runs on every access. (default: None)
+            shards (ShardReader, optional): Shards packed by `python shards.py cifar`, from which the images
+                are read instead of their files. The decoded-image cache is not used then. (default: None)
+            preload (bool, optional): Decode all images once, in a process pool, into a uint8 tensor kept in memory.
+                Items are then sliced out of it, and `idx` can be a list of indices to get a whole batch at once.
+                `transform` is applied to the float image tensors in this mode. (default: False)
+            preload_path (string, optional): `.npy` file where the preloaded images are saved, and from which
+                later runs memory-map them instead of decoding. (default: None)
         """
+        self.root = root
         self.transform = transform 
+        self.image_cache = image_cache
+        self.shards = shards
+        self.images = None
 
         ################################
         ## P4.1. Write your code here ##
@@ -200,6 +234,27 @@ class CIFAR10(Dataset):
         else:
             assert len(self.paths) == 12000, 'There are 12,000 test images, but you have gathered %d image paths' % len(self.paths)
 
+        if preload:
+            self.images = self.preload(preload_path)
+            self.labels = torch.tensor([int(path.split('/')[-2]) for path in self.paths])
+
+    def preload(self, path=None):
+        """ All images as one contiguous uint8 tensor of shape (N, 3, 32, 32), memory-mapped from `path` if it exists. """
+        shape = (len(self.paths), 3, 32, 32)
+        if path is not None and os.path.exists(path):
+            images = np.load(path, mmap_mode='c') # copy-on-write, so that the tensor is writable without copying.
+            if images.shape == shape and images.dtype == np.uint8:
+                return torch.from_numpy(images)
+        sources = [self.shards.read(self.shard_key(idx)) for idx in range(len(self.paths))] if self.shards is not None else self.paths
+        with mp.Pool() as pool:
+            images = np.stack(pool.map(decode_image, sources, chunksize=256))
+        if path is not None:
+            tmp = '%s.%d.tmp' % (path, os.getpid()) # own temporary file, in case of concurrent runs.
+            with open(tmp, 'wb') as f:
+                np.save(f, images)
+            os.replace(tmp, path)
+        return torch.from_numpy(images)
+
     def __getitem__(self, idx):
         """
         Instructions:
@@ -214,6 +269,12 @@ class CIFAR10(Dataset):
             label (torch.LongTensor): A label tensor of shape ().
         """
 
+        if self.images is not None:
+            image = self.images[idx].float().div_(255)
+            if self.transform is not None:
+                image = self.transform(image)
+            return image, self.labels[idx]
+
         path = self.paths[idx] 
         # P4.2. Infer class label from `path`,
         # write your code here.
@@ -223,7 +284,12 @@ class CIFAR10(Dataset):
         # label = write_your_code_here (one-liner).
         label = label.long() # Note: you must erase this line
 
-        image = Image.open(path)
+        if self.shards is not None:
+            image = Image.open(io.BytesIO(self.shards.read(self.shard_key(idx))))
+        elif self.image_cache is None:
+            image = Image.open(path)
+        else:
+            image = Image.fromarray(self.image_cache.get(path, lambda: np.array(Image.open(path)), dataset='CIFAR10'))
         if self.transform is not None:
             image = self.transform(image) 
 
@@ -232,23 +298,56 @@ class CIFAR10(Dataset):
     def __len__(self):
         return len(self.paths)
 
+    def shard_key(self, idx):
+        return self.paths[idx][len(self.root)+1:]
+
 def get_dataloader(args):
     transform = transforms.Compose([
         transforms.ToTensor(),
         ])
-    train_dataset = CIFAR10(args.dataroot, train=True, transform=transform)
-    test_dataset = CIFAR10(args.dataroot, train=False, transform=transform)
+    image_cache = DecodedImageCache(args.image_cache_bytes) if args.image_cache_bytes > 0 else None
+    train_shards = test_shards = None
+    if args.shard_root is not None:
+        train_shards = ShardReader(str(Path(args.shard_root) / 'cifar10_train.index.json'))
+        test_shards = ShardReader(str(Path(args.shard_root) / 'cifar10_test.index.json'))
+    if args.preload:
+        # Images are decoded once into uint8 tensors, and whole batches are sliced out of them: the sampler yields
+        # the indices of a batch, and batch_size=None turns off the per-sample collate.
+        preload_path = lambda split: str(Path(args.dataroot) / ('%s.uint8.npy' % split)) if args.preload_cache else None
+        train_dataset = CIFAR10(args.dataroot, train=True, shards=train_shards, preload=True, preload_path=preload_path('train'))
+        test_dataset = CIFAR10(args.dataroot, train=False, shards=test_shards, preload=True, preload_path=preload_path('test'))
+        # Slicing needs no workers, unless a transform is added.
+        # The sampler shuffles with its own generator, seeded like the DataLoader path.
+        sampler = RandomSampler(train_dataset, generator=torch.Generator().manual_seed(args.seed))
+        train_dataloader = make_loader(train_dataset, num_workers=0, seed=args.seed, batch_size=None,
+                                       sampler=BatchSampler(sampler, args.batch_size, drop_last=True))
+        test_dataloader = make_loader(test_dataset, num_workers=0, seed=args.seed, batch_size=None,
+                                      sampler=BatchSampler(SequentialSampler(test_dataset), args.batch_size, drop_last=False))
+        return train_dataloader, test_dataloader
+
+    train_dataset = CIFAR10(args.dataroot, train=True, transform=transform, image_cache=image_cache, shards=train_shards)
+    test_dataset = CIFAR10(args.dataroot, train=False, transform=transform, image_cache=image_cache, shards=test_shards)
 
     # P4.4. Use `DataLoader` module for mini-batching train and test datasets.
     # train_dataloader = DataLoader(WRITE_YOUR_CODE_HERE, batch_size=args.batch_size, shuffle=True, drop_last=True)
     # test_dataloader = DataLoader(WRITE_YOUR_CODE_HERE, batch_size=args.batch_size, shuffle=False, drop_last=False)
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, drop_last=True)
-    test_dataloader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, drop_last=False)
+    # Workers persist across epochs. With args.num_workers = 'auto', their number is tuned on the train set once per machine.
+    tune_cache = str(Path(args.dataroot) / args.loader_tune_file)
+    if train_shards is not None:
+        # shards are shuffled and read sequentially, through a shuffle buffer of encoded images.
+        train_dataloader = make_loader(ShardedIterableDataset(train_dataset, buffer_size=args.shard_buffer, seed=args.seed),
+                                       args.num_workers, seed=args.seed, batch_size=args.batch_size, drop_last=True,
+                                       tune_cache=tune_cache)
+    else:
+        train_dataloader = make_loader(train_dataset, args.num_workers, seed=args.seed, batch_size=args.batch_size, shuffle=True,
+                                       drop_last=True, tune_cache=tune_cache)
+    test_dataloader = make_loader(test_dataset, seed=args.seed, batch_size=args.batch_size, shuffle=False, drop_last=False,
+                                  **loader_settings(train_dataloader))
 
     return train_dataloader, test_dataloader
 
 class MyNetwork(nn.Module):
-    def __init__(self, nf, resblock_type='plain', num_resblocks=[1, 1, 1], use_bn=False):
+    def __init__(self, nf, resblock_type='plain', num_resblocks=[1, 1, 1], use_bn=False, checkpoint_blocks=0):
         super(MyNetwork, self).__init__()
         """Initialize an entire network module components.
 
@@ -266,6 +365,8 @@ class MyNetwork(nn.Module):
                Each item at i-th index indicates the number of residual blocks at i-th Residual Layer.  
                (default: [1, 1, 1])
             4. use_bn (bool, optional): Whether to use batch normalization. (default: False)
+            5. checkpoint_blocks (int or str, optional): Activation checkpointing of the residual blocks,
+               as in `set_checkpointing`. (default: 0, disabled)
         """
         ################################
         ## P3.1. Write your code here ##
@@ -316,6 +417,50 @@ class MyNetwork(nn.Module):
         
         # When all components are initialized, perform weight initialization on weights and biases.
         self.apply(self.init_params)
+        self.set_checkpointing(checkpoint_blocks)
+
+    def set_checkpointing(self, checkpoint_blocks):
+        """Recompute the activations of the residual blocks in backward instead of keeping them for it.
+
+        Only the input of every checkpointed segment of blocks is kept during the forward of training, and the
+        segment is forwarded once more in backward. Modules and state_dict keys stay the same.
+
+        Args:
+            1. checkpoint_blocks (int or str): 'stage' to checkpoint every Residual Layer as one segment,
+               k to checkpoint every k consecutive blocks of a Residual Layer, 0 to keep all activations.
+        """
+        if not (checkpoint_blocks == 'stage' or (isinstance(checkpoint_blocks, int) and checkpoint_blocks >= 0)):
+            raise ValueError("checkpoint_blocks must be 'stage' or a non-negative int, got {!r}".format(checkpoint_blocks))
+        self.checkpoint_blocks = checkpoint_blocks
+        self.segments_ = [] # (start, end) indices of the checkpointed blocks in self.model.
+        if not checkpoint_blocks:
+          return
+        stages = [] # (start, end) of every Residual Layer, whose blocks are named 'res{layer}_{block}'.
+        for i, name in enumerate(self.model._modules):
+          stage = name.split('_')[0] if name.startswith('res') else None
+          if stage is not None and stages and stages[-1][0] == stage and stages[-1][2] == i:
+            stages[-1][2] = i + 1
+          elif stage is not None:
+            stages.append([stage, i, i + 1])
+        for _, start, end in stages:
+          size = end - start if checkpoint_blocks == 'stage' else checkpoint_blocks
+          self.segments_ += [(i, min(i + size, end)) for i in range(start, end, size)]
+
+    def run_blocks(self, blocks, recomputed, x):
+        # The recomputation in backward leaves the running statistics of batch normalization as the forward updated them.
+        if not recomputed:
+          recomputed.append(True)
+          return blocks(x)
+        bns = [m for m in blocks.modules() if isinstance(m, nn.BatchNorm2d)]
+        saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+        for m in bns:
+          m.momentum = 0.
+        try:
+          return blocks(x)
+        finally:
+          for m, (momentum, num_batches_tracked) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
 
     def forward(self, x):
         """Feed-forward the data `x` through the network.
@@ -331,7 +476,14 @@ class MyNetwork(nn.Module):
         """
         ################################
         ## P3.2. Write your code here ##
-        output = self.model(x)
+        if not (self.segments_ and self.training and torch.is_grad_enabled()):
+          return self.model(x)
+        output, i = x, 0
+        for start, end in self.segments_:
+          output = self.model[i:start](output)
+          output = checkpoint(self.run_blocks, self.model[start:end], [], output, use_reentrant=False)
+          i = end
+        output = self.model[i:](output)
         ################################
         return output
 
@@ -410,11 +562,21 @@ args.name = 'main'                   # experiment name.
 args.ckpt_dir = 'ckpts'              # checkpoint directory name.
 args.ckpt_iter = 100                 # how frequently checkpoints are saved.
 args.ckpt_reload = 'best'            # which checkpoint to re-load.
+args.ckpt_keep = 3                   # number of the most recent checkpoints kept, besides the best one.
 args.gpu = True                      # whether or not to use gpu. 
 
 # data options
 args.dataroot = 'dataset/cifar10'    # where CIFAR10 images exist.
 args.batch_size = 64                 # number of mini-batch size.
+args.micro_batch_size = None         # size of the micro-batches whose gradients accumulate into one step of batch_size. (None: the whole batch)
+args.num_workers = 0                 # number of DataLoader workers, or 'auto' to tune it and the prefetch depth on the first batches.
+args.loader_tune_file = 'loader_tune.json'  # where the settings tuned by num_workers='auto' are kept, under dataroot.
+args.image_cache_bytes = 0           # byte budget of the decoded-image cache shared by DataLoader workers. (0: disabled)
+args.shard_root = None               # where the shards packed by `python shards.py cifar` exist. (None: read the png files)
+args.preload = False                 # decode all images once into a uint8 tensor in memory, and slice batches out of it.
+args.preload_cache = True            # save the preloaded images as `<dataroot>/<split>.uint8.npy`, memory-mapped by later runs.
+args.shard_buffer = 10000            # number of encoded images in the shuffle buffer of the sharded train set.
+args.seed = 0                        # seed of the shuffling and of the DataLoader workers.
 
 # tensorboard options
 args.tensorboard = True             # whether or not to use tensorboard logging.
@@ -426,10 +588,14 @@ args.num_filters = 64                # number of output channels in the first nn
 args.resblock_type = 'plain'        # type of residual block. ('plain' | 'bottleneck').
 args.num_resblocks = [3,6,10]       # number of residual blocks in each Residual Layer.
 args.use_bn = False                  # whether or not to use batch normalization.
+args.checkpoint_blocks = 0           # recompute the activations of residual blocks in backward. ('stage' | k blocks | 0: disabled)
 
 # training options
 args.epoch = 50                    # training epoch.
 args.lr = 0.001                     # learning rate.
+args.profile = None                 # where the Chrome trace of the first `args.profile_steps` steps is written. (None: disabled)
+args.profile_steps = 20
+args.amp = False                    # whether or not to train in mixed precision. (bfloat16 on cpu, float16 on gpu)
 weight_decay= 0.001
 
 ###################################################################################################
@@ -481,128 +647,193 @@ tag_num = 13
 # log_25: ruined
 ###################################################################################################
 
-# Basic settings
-device = 'cuda' if torch.cuda.is_available() and args.gpu else 'cpu'
-
-result_dir = Path(root) / 'results' /args.name
-ckpt_dir = result_dir / args.ckpt_dir
-ckpt_dir.mkdir(parents=True, exist_ok=True)
-log_dir = result_dir / args.log_dir
-log_dir.mkdir(parents=True, exist_ok=True)
-
-global_step = 0
-best_accuracy = 0.
-
-# Setup tensorboard.
-if args.tensorboard:
-    from torch.utils.tensorboard import SummaryWriter 
-    writer = SummaryWriter(log_dir)
-    # %load_ext tensorboard
-    # %tensorboard --logdir '/gdrive/My Drive/'{str(log_dir).replace('/gdrive/My Drive/', '')}
-else:
-    writer = None
-
-###################################################################################################
-
-# Define your model and optimizer
-# Complete ResBlockPlain, ResBlockBottleneck, and MyNetwork modules to proceed further.
-net = MyNetwork(args.num_filters, args.resblock_type, args.num_resblocks, args.use_bn).to(device)
-optimizer = optim.Adam(net.parameters(), lr=args.lr, weight_decay=weight_decay)
-
-print(net)
-
-# Get train/test data loaders  
-# Complete CIFAR10 dataset class and get_dataloader method to proceed further.
-train_dataloader, test_dataloader = get_dataloader(args)
-
-for epoch in tqdm(range(args.epoch)):
-    # Here starts the train loop.
-    for x, y in tqdm(train_dataloader):
-        global_step += 1
-
-        # P5.1. Send `x` and `y` to either cpu or gpu using `device` variable.
-        # x = write your code here (one-liner). 
-        # y = write your code here (one-liner).
-        x = x.to(device)
-        y = y.to(device)
-        
-        # P5.2. Feed `x` into the network, get an output, and keep it in a variable called `logit`.
-        # logit = write your code here (one-liner).
-        logit = net(x)
-
-        # P5.3. Compute loss using `logit` and `y`, and keep it in a variable called `loss`
-        # loss =  write your code here (one-liner).
-        loss = net.compute_loss(logit, y)
-        accuracy = (logit.argmax(dim=1)==y).float().mean()
-
-        # P5.4. flush out the previously computed gradient
-        # write your code here (one-liner).
-        optimizer.zero_grad()
+def main():
+    # Basic settings
+    device = 'cuda' if torch.cuda.is_available() and args.gpu else 'cpu'
+
+    result_dir = Path(root) / 'results' /args.name
+    ckpt_dir = result_dir / args.ckpt_dir
+    ckpt_dir.mkdir(parents=True, exist_ok=True)
+    log_dir = result_dir / args.log_dir
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    global_step = 0
+    best_accuracy = 0.
+
+    # Setup tensorboard.
+    if args.tensorboard:
+        from torch.utils.tensorboard import SummaryWriter 
+        writer = SummaryWriter(log_dir)
+        # %load_ext tensorboard
+        # %tensorboard --logdir '/gdrive/My Drive/'{str(log_dir).replace('/gdrive/My Drive/', '')}
+    else:
+        writer = None
+
+    ###################################################################################################
+
+    # Define your model and optimizer
+    # Complete ResBlockPlain, ResBlockBottleneck, and MyNetwork modules to proceed further.
+    net = MyNetwork(args.num_filters, args.resblock_type, args.num_resblocks, args.use_bn, args.checkpoint_blocks).to(device)
+    optimizer = optim.Adam(net.parameters(), lr=args.lr, weight_decay=weight_decay)
+    scaler = grad_scaler(device, args.amp)
+
+    print(net)
+
+    # Get train/test data loaders  
+    # Complete CIFAR10 dataset class and get_dataloader method to proceed further.
+    train_dataloader, test_dataloader = get_dataloader(args)
+
+    # Resume from the newest checkpoint if exists, at the start of its epoch.
+    # Checkpoints are written in the background into `ckpt_dir`, keeping the last `args.ckpt_keep` and the best.
+    ckpt_manager = CheckpointManager(str(ckpt_dir), keep_last=args.ckpt_keep)
+    ckpt = ckpt_manager.load_latest(map_location=device)
+    start_epoch = 0
+    if ckpt is not None:
+        net.load_state_dict(ckpt['model'])
+        optimizer.load_state_dict(ckpt['optimizer'])
+        start_epoch = ckpt['step'] // len(train_dataloader)
+        global_step = start_epoch * len(train_dataloader)
+        best_accuracy = ckpt['best_accuracy']
+        print('Checkpoint of step {} is loaded. start_epoch: {}'.format(ckpt['step'], start_epoch))
+
+    def save_state():
+        return {'model': net.state_dict(), 'optimizer': optimizer.state_dict(),
+                'step': global_step, 'best_accuracy': best_accuracy}
+
+    # Metrics are averaged over every `args.log_iter` steps and written in the background.
+    train_metrics = MetricLogger(writer, args.log_iter, prefix='train_')
+
+    # Time every stage of the first `args.profile_steps` steps, including the image loading of the workers.
+    profiler = StageProfiler(args.profile is not None, sync_cuda=device == 'cuda')
+    train_dataset = getattr(train_dataloader.dataset, 'dataset', train_dataloader.dataset)
+    if train_dataset.transform is not None:
+        profiler.instrument(train_dataset, ['transform'])
+    profiled_steps = 0
+
+    for epoch in tqdm(range(start_epoch, args.epoch)):
+        # Here starts the train loop.
+        train_metrics.reset()
+        if isinstance(train_dataloader.dataset, ShardedIterableDataset):
+            train_dataloader.dataset.set_epoch(epoch)
+        for x, y in tqdm(profiler.iterate(train_dataloader), total=len(train_dataloader)):
+            train_metrics.data_ready()
+            global_step += 1
+
+            # P5.1. Send `x` and `y` to either cpu or gpu using `device` variable.
+            # x = write your code here (one-liner). 
+            # y = write your code here (one-liner).
+            with profiler.stage('to_device'):
+                x = x.to(device)
+                y = y.to(device)
 
-        # P5.5. backward the computed loss. 
-        # write your code here (one-liner).
-        loss.backward()
+            # P5.4. flush out the previously computed gradient
+            # write your code here (one-liner).
+            optimizer.zero_grad()
+
+            # P5.2-P5.5 per micro-batch of `args.micro_batch_size`, whose gradients accumulate into one update.
+            # Each loss is weighted by its share of the batch, so that they sum up to the mean loss of the batch.
+            loss, correct = 0., 0
+            micro_size = args.micro_batch_size or x.shape[0]
+            for x_micro, y_micro in zip(x.split(micro_size), y.split(micro_size)):
+                # P5.2. Feed `x` into the network, get an output, and keep it in a variable called `logit`.
+                # logit = write your code here (one-liner).
+                with autocast(device, args.amp):
+                    with profiler.stage('forward'):
+                        logit = net(x_micro)
+
+                    # P5.3. Compute loss using `logit` and `y`, and keep it in a variable called `loss`
+                    # loss =  write your code here (one-liner).
+                    with profiler.stage('loss'):
+                        loss_micro = net.compute_loss(logit, y_micro) * (y_micro.shape[0] / y.shape[0])
+
+                # P5.5. backward the computed loss. 
+                # write your code here (one-liner).
+                with profiler.stage('backward'):
+                    scaler.scale(loss_micro).backward()
+                loss = loss + loss_micro.detach()
+                if global_step % args.log_iter == 0:
+                    correct = correct + (logit.argmax(dim=1) == y_micro).sum()
+
+            # P5.6. update the network weights. 
+            # write your code here (one-liner).
+            with profiler.stage('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
 
-        # P5.6. update the network weights. 
-        # write your code here (one-liner).
-        optimizer.step()
+            if profiler.enabled:
+                profiled_steps += 1
+                if profiled_steps == args.profile_steps:
+                    profiler.stop(args.profile)
 
-        if global_step % args.log_iter == 0 and writer is not None:
             # P5.7. Log `loss` with a tag name 'train_loss' using `writer`. Use `global_step` as a timestamp for the log.
             # writer.writer_your_code_here (one-liner).
-            writer.add_scalar('train_loss_{}'.format(tag_num), loss, global_step)
-            # P5.8. Log `accuracy` with a tag name 'train_accuracy' using `writer`. Use `global_step` as a timestamp for the log.
-            # writer.writer_your_code_here (one-liner).
-            writer.add_scalar('train_accuracy_{}'.format(tag_num), accuracy, global_step)
-
-        if global_step % args.ckpt_iter == 0: 
-            # P5.9. Save network weights in the directory specified by `ckpt_dir` directory.
-            #    Use `global_step` to specify the timestamp in the checkpoint filename.
-            #    E.g) if `global_step=100`, the filename can be `100.pt`
-            # write your code here (one-liner).
-            torch.save(net.state_dict(), '{}.pt'.format(global_step))
-
-
-    # Here starts the test loop.
-    with torch.no_grad():
-        test_loss = 0.
-        test_accuracy = 0.
-        test_num_data = 0.
-        for x, y in tqdm(test_dataloader):
-            # P5.10. Send `x` and `y` to either cpu or gpu using `device` variable.
-            # x = write your code here (one-liner).
-            # y = write your code here (one-liner).
-            x = x.to(device)
-            y = y.to(device)
-
-            # P5.11. Feed `x` into the network, get an output, and keep it in a variable called `logit`.
-            # logit = write your code here (one-liner). 
-            logit = net(x)
-
-            # P5.12. Compute loss using `logit` and `y`, and keep it in a variable called `loss`
-            # loss = write your code yere (one-liner). 
-            loss = net.compute_loss(logit, y) 
-            accuracy = (logit.argmax(dim=1) == y).float().mean()
-
-            test_loss += loss.item()*x.shape[0]
-            test_accuracy += accuracy.item()*x.shape[0]
-            test_num_data += x.shape[0]
-
-        test_loss /= test_num_data
-        test_accuracy /= test_num_data
-
-        if writer is not None: 
-            # P5.13. Log `test_loss` with a tag name 'test_loss' using `writer`. Use `global_step` as a timestamp for the log.
-            # writer.write_your_code_here (one-liner).
-            writer.add_scalar('test_loss_{}'.format(tag_num), test_loss, global_step)
-            # P5.14. Log `test_accuracy` with a tag name 'test_accuracy' using `writer`. Use `global_step` as a timestamp for the log.
-            # writer.write_your_code_here (one-liner).
-            writer.add_scalar('test_accuracy_{}'.format(tag_num), test_accuracy, global_step)
-            writer.flush()
-
-        # P5.15. Whenever `test_accuracy` is greater than `best_accuracy`, save network weights with the filename 'best.pt' in the directory specified by `ckpt_dir`.
-        #     Also, don't forget to update the `best_accuracy` properly.
-        # write your code here. 
-        if test_accuracy > best_accuracy:
-          best_accuracy = test_accuracy
-          torch.save(net.state_dict(), 'best.pt')
\ No newline at end of file
+            metrics = {'train_loss_{}'.format(tag_num): loss}
+            if global_step % args.log_iter == 0 and writer is not None:
+                # P5.8. Log `accuracy` with a tag name 'train_accuracy' using `writer`. Use `global_step` as a timestamp for the log.
+                # writer.writer_your_code_here (one-liner).
+                # only computed on the logged steps.
+                metrics['train_accuracy_{}'.format(tag_num)] = correct.float() / y.shape[0]
+            train_metrics.update(global_step, x.shape[0], metrics)
+
+            if global_step % args.ckpt_iter == 0: 
+                # P5.9. Save network weights in the directory specified by `ckpt_dir` directory.
+                #    Use `global_step` to specify the timestamp in the checkpoint filename.
+                #    E.g) if `global_step=100`, the filename can be `100.pt`
+                # write your code here (one-liner).
+                ckpt_manager.save(save_state(), global_step)
+
+
+        # Here starts the test loop.
+        with torch.no_grad():
+            test_loss = 0.
+            test_accuracy = 0.
+            test_num_data = 0.
+            for x, y in tqdm(test_dataloader):
+                # P5.10. Send `x` and `y` to either cpu or gpu using `device` variable.
+                # x = write your code here (one-liner).
+                # y = write your code here (one-liner).
+                x = x.to(device)
+                y = y.to(device)
+
+                # P5.11. Feed `x` into the network, get an output, and keep it in a variable called `logit`.
+                # logit = write your code here (one-liner). 
+                with autocast(device, args.amp):
+                    logit = net(x)
+
+                    # P5.12. Compute loss using `logit` and `y`, and keep it in a variable called `loss`
+                    # loss = write your code yere (one-liner). 
+                    loss = net.compute_loss(logit, y) 
+                accuracy = (logit.argmax(dim=1) == y).float().mean()
+
+                test_loss += loss.item()*x.shape[0]
+                test_accuracy += accuracy.item()*x.shape[0]
+                test_num_data += x.shape[0]
+
+            test_loss /= test_num_data
+            test_accuracy /= test_num_data
+            tqdm.write('epoch {}: test loss {:.4f}, test accuracy {:.4f}, peak RSS {:.0f} MB'.format(
+                epoch, test_loss, test_accuracy, peak_rss_mb()))
+
+            if writer is not None: 
+                # P5.13. Log `test_loss` with a tag name 'test_loss' using `writer`. Use `global_step` as a timestamp for the log.
+                # writer.write_your_code_here (one-liner).
+                writer.add_scalar('test_loss_{}'.format(tag_num), test_loss, global_step)
+                # P5.14. Log `test_accuracy` with a tag name 'test_accuracy' using `writer`. Use `global_step` as a timestamp for the log.
+                # writer.write_your_code_here (one-liner).
+                writer.add_scalar('test_accuracy_{}'.format(tag_num), test_accuracy, global_step)
+                writer.flush()
+
+            # P5.15. Whenever `test_accuracy` is greater than `best_accuracy`, save network weights with the filename 'best.pt' in the directory specified by `ckpt_dir`.
+            #     Also, don't forget to update the `best_accuracy` properly.
+            # write your code here. 
+            if test_accuracy > best_accuracy:
+              best_accuracy = test_accuracy
+              ckpt_manager.save(save_state(), global_step, is_best=True)
+
+    if profiler.enabled: # trained for less than `args.profile_steps`.
+        profiler.stop(args.profile)
+    ckpt_manager.close()
+    train_metrics.close()
+
+if __name__ == '__main__':
+    main()
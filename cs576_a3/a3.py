@@ -2,11 +2,14 @@ root = './'
 import sys
 sys.path.append(root)
 
-import warnings
-warnings.filterwarnings("ignore")
-
 import os
 import cv2
+import time
+import argparse
+import warnings
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 import torch
@@ -15,9 +18,9 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
-from torchvision import transforms
 
-from data import VOCDetection
+from box_ops import compute_iou, NMS, batched_nms
+from amp import autocast, grad_scaler
 def makedirs(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -40,14 +43,75 @@ grid_size = 7       # 3x224x224 image is reduced to (5*num_boxes+num_classes)x7x
 lambda_coord = 7    # weight for coordinate regression loss.
 lambda_noobj = 0.5  # weight for no-objectness confidence loss.
 
+use_feature_cache = False       # train only the detector from cached features of the frozen backbone.
+feature_cache_root = 'feature_cache'  # where the cached backbone features are stored. (caches of a previous backbone are removed)
+feature_cache_views = 4         # number of deterministic augmentations cached per train image.
+use_batch_augment = False       # augment whole batches with torch ops in the main process, while workers only decode and resize.
+shard_root = None               # where the shards packed by `python shards.py voc` exist. (None: read the image files)
+shard_buffer = 256              # number of encoded images in the shuffle buffer of the sharded train set.
+image_cache_bytes = 0           # byte budget of the decoded-image cache shared by DataLoader workers. (0: disabled)
+num_workers = 8                 # number of DataLoader workers, or 'auto' to tune it and the prefetch depth on the first batches.
+loader_tune_file = 'loader_tune.json'  # where the settings tuned by num_workers='auto' are kept, under data_root.
+micro_batch_size = None         # size of the micro-batches whose gradients accumulate into one step of batch_size. (None: the whole batch)
+use_amp = False                 # autocast in bfloat16 on CPU, or in float16 with gradient scaling on GPU.
+score_threshold = 0.2           # minimum class score of the detections.
+nms_threshold = 0.35            # IoU over which NMS suppresses a detection.
+pre_nms_top_k = 20              # number of the highest scored candidates per image and class that enter NMS in infer_folder.
+map_score_threshold = 0.01      # minimum class score of the detections counted in the test mAP.
+map_num_bins = 10000            # probability bins of the test mAP histograms, which bound its memory. (None: exact, unbounded)
+map_max_det = 100               # maximum number of detections per image counted in the test mAP.
+ckpt_keep = 3                   # number of the most recent checkpoints kept, besides the best one.
+profile_path = None             # where the Chrome trace of the first `profile_steps` training steps is written. (None: disabled)
+profile_steps = 20
+
+log_dir = "./logs"
+tb_log_freq = 5
+test_image_dir = 'test_images'
+
 ckpt_dir = os.path.join(root, ckpt_root)
-makedirs(ckpt_dir)
 
-train_dset = VOCDetection(root=data_root, split='train')
-train_dloader = DataLoader(train_dset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=8)
 
-test_dset = VOCDetection(root=data_root, split='test')
-test_dloader = DataLoader(test_dset, batch_size=batch_size, shuffle=False, drop_last=False, num_workers=8)
+# Datasets, models and loaders are only built on demand, so that importing this module stays cheap.
+def build_dataloaders(data_root=data_root, batch_size=batch_size, num_workers=num_workers, image_cache=None, batch_augment=False,
+                      shard_root=None):
+    """ Build the train/test VOCDetection datasets and their DataLoaders.
+    With `batch_augment`, the train DataLoader yields (uint8 images, boxes, labels) to be augmented by BatchAugment.
+    With `shard_root`, images are read from the shards in it, and the train set streams through them shard by shard.
+    Workers persist across epochs; when `num_workers` is 'auto', it is tuned on the train set, or read from the result
+    of a previous run in `<data_root>/<loader_tune_file>`, and reused for the test set.
+
+    Returns:
+        train_dset, train_dloader, test_dset, test_dloader
+    """
+    from data import VOCDetection, DetectionCollate
+    from shards import ShardReader, ShardedIterableDataset
+    from loader import make_loader, loader_settings
+
+    # Targets are encoded per batch by DetectionCollate, so workers only ship the ground truths.
+    collate_fn = DetectionCollate(grid_size, num_boxes, num_classes)
+
+    tune_cache = os.path.join(data_root, loader_tune_file)
+    train_shards = test_shards = None
+    if shard_root is not None:
+        train_shards = ShardReader(os.path.join(shard_root, 'voc_train.index.json'))
+        test_shards = ShardReader(os.path.join(shard_root, 'voc_test.index.json'))
+
+    train_dset = VOCDetection(root=data_root, split='train', image_cache=image_cache, encode=False, batch_augment=batch_augment,
+                              shards=train_shards)
+    train_collate_fn = DetectionCollate(grid_size, num_boxes, num_classes, encode=False) if batch_augment else collate_fn
+    if train_shards is not None:
+        train_dloader = make_loader(ShardedIterableDataset(train_dset, buffer_size=shard_buffer), num_workers, batch_size=batch_size,
+                                    drop_last=True, collate_fn=train_collate_fn, tune_cache=tune_cache)
+    else:
+        train_dloader = make_loader(train_dset, num_workers, batch_size=batch_size, shuffle=True, drop_last=True, collate_fn=train_collate_fn,
+                                    tune_cache=tune_cache)
+
+    # The test set also yields the padded ground truths, (images, targets, boxes, labels), to evaluate the mAP.
+    test_dset = VOCDetection(root=data_root, split='test', image_cache=image_cache, encode=False, shards=test_shards)
+    test_collate_fn = DetectionCollate(grid_size, num_boxes, num_classes, return_boxes=True)
+    test_dloader = make_loader(test_dset, batch_size=batch_size, shuffle=False, drop_last=False, collate_fn=test_collate_fn,
+                               **loader_settings(train_dloader))
+    return train_dset, train_dloader, test_dset, test_dloader
 
 
 # Problem 1. Implement Architecture
@@ -100,39 +164,44 @@ class Yolo(nn.Module):
         )
     def forward(self, x):
         x = self.features(x)
-        x = x.view(x.size(0), -1)
+        return self.head(x)
+
+    def head(self, x):
+        # detection head on top of the backbone features, sized [batch_size, 512, 7, 7].
+        x = x.reshape(x.size(0), -1) # copies the features in channels-last format.
         x = self.detector(x)
         x = F.sigmoid(x)
         x = x.view(-1, self.S, self.S, self.B*5+self.C)
         return x
 
-model = Yolo(grid_size, num_boxes, num_classes)
-model = model.to(device)
-pretrained_weights = torch.load(pretrained_backbone_path)
-model.load_state_dict(pretrained_weights)
-# It should print out <All keys matched successfully> when you implemented VGG correctly.
-
-# Freeze the backbone network.
-model.features.requires_grad_(False)
-model_params = [v for v in model.parameters() if v.requires_grad is True]
-optimizer = optim.SGD(model_params, lr=lr, momentum=0.9, weight_decay=5e-4)
-
-# Load the last checkpoint if exits.
-ckpt_path = os.path.join(ckpt_dir, 'last.pth') 
-
-if os.path.exists(ckpt_path): 
-    ckpt = torch.load(ckpt_path)
+def build_model(weights_path=pretrained_backbone_path):
+    """ Build Yolo on `device` with the pretrained VGG16 backbone, frozen. """
+    model = Yolo(grid_size, num_boxes, num_classes)
+    model = model.to(device)
+    pretrained_weights = torch.load(weights_path, map_location=device)
+    print(model.load_state_dict(pretrained_weights))
+    # It should print out <All keys matched successfully> when you implemented VGG correctly.
+
+    # Freeze the backbone network.
+    model.features.requires_grad_(False)
+    return model
+
+def load_model(ckpt_path=None):
+    """ Build Yolo on `device` from a checkpoint saved by `train`. (default: the latest one in ckpt_dir) """
+    from checkpoint import CheckpointManager
+    model = Yolo(grid_size, num_boxes, num_classes)
+    model = model.to(device)
+    if ckpt_path is None:
+        ckpt = CheckpointManager(ckpt_dir).load_latest(map_location=device)
+    else:
+        ckpt = CheckpointManager(os.path.dirname(ckpt_path)).load(ckpt_path, map_location=device)
     model.load_state_dict(ckpt['model'])
-    optimizer.load_state_dict(ckpt['optimizer'])
-    last_epoch = ckpt['epoch'] + 1
-    print('Last checkpoint is loaded. start_epoch:', last_epoch)
-else:
-    print('No checkpoint is found.')
+    return model
 
 
 # Problem 2. Implement Architecture
 class Loss(nn.Module):
-    def __init__(self, grid_size=7, num_bboxes=2, num_classes=20):
+    def __init__(self, grid_size=7, num_bboxes=2, num_classes=20, vectorized=True):
         """ Loss module for Yolo v1.
         Use grid_size, num_bboxes, num_classes information if necessary.
 
@@ -140,58 +209,50 @@ class Loss(nn.Module):
             grid_size: (int) size of input grid.
             num_bboxes: (int) number of bboxes per each cell.
             num_classes: (int) number of the object classes.
+            vectorized: (bool) compute the responsible bboxes of all object cells at once.
+                If False, fall back to the per-cell loop, which is kept as a reference. (default: True)
         """
         super(Loss, self).__init__()
         self.S = grid_size
         self.B = num_bboxes
         self.C = num_classes
+        self.vectorized = vectorized
 
     def compute_iou(self, bbox1, bbox2):
         """ Compute the IoU (Intersection over Union) of two set of bboxes, each bbox format: [x1, y1, x2, y2].
-        Use this function if necessary.
+        Use this function if necessary. Leading batch dimensions are broadcast.
 
         Args:
-            bbox1: (Tensor) bounding bboxes, sized [N, 4].
-            bbox2: (Tensor) bounding bboxes, sized [M, 4].
+            bbox1: (Tensor) bounding bboxes, sized [..., N, 4].
+            bbox2: (Tensor) bounding bboxes, sized [..., M, 4].
         Returns:
-            (Tensor) IoU, sized [N, M].
+            (Tensor) IoU, sized [..., N, M].
         """
-        N = bbox1.size(0)
-        M = bbox2.size(0)
+        return compute_iou(bbox1, bbox2)
 
-        # Compute left-top coordinate of the intersections
-        lt = torch.max(
-            bbox1[:, :2].unsqueeze(1).expand(N, M, 2), # [N, 2] -> [N, 1, 2] -> [N, M, 2]
-            bbox2[:, :2].unsqueeze(0).expand(N, M, 2)  # [M, 2] -> [1, M, 2] -> [N, M, 2]
-        )
-        # Conpute right-bottom coordinate of the intersections
-        rb = torch.min(
-            bbox1[:, 2:].unsqueeze(1).expand(N, M, 2), # [N, 2] -> [N, 1, 2] -> [N, M, 2]
-            bbox2[:, 2:].unsqueeze(0).expand(N, M, 2)  # [M, 2] -> [1, M, 2] -> [N, M, 2]
-        )
-        # Compute area of the intersections from the coordinates
-        wh = rb - lt   # width and height of the intersection, [N, M, 2]
-        wh[wh < 0] = 0 # clip at 0
-        inter = wh[:, :, 0] * wh[:, :, 1] # [N, M]
-
-        # Compute area of the bboxes
-        area1 = (bbox1[:, 2] - bbox1[:, 0]) * (bbox1[:, 3] - bbox1[:, 1]) # [N, ]
-        area2 = (bbox2[:, 2] - bbox2[:, 0]) * (bbox2[:, 3] - bbox2[:, 1]) # [M, ]
-        area1 = area1.unsqueeze(1).expand_as(inter) # [N, ] -> [N, 1] -> [N, M]
-        area2 = area2.unsqueeze(0).expand_as(inter) # [M, ] -> [1, M] -> [N, M]
+    def center_to_ltrb(self, xywh):
+        """ Transform bboxes from 'center' to 'left-top, right-bottom'.
 
-        # Compute IoU from the areas
-        union = area1 + area2 - inter # [N, M, 2]
-        iou = inter / union           # [N, M, 2]
-
-        return iou
+        Args:
+            xywh (Tensor) : sized [..., 4], 4=len([x, y, w, h]) where x, y are in cell-size and w, h are in image-size.
+        Returns:
+            ltrb (Tensor) : sized [..., 4], 4=len([x1, y1, x2, y2]).
+        """
+        # As in encoder function, both w,h are in image-size and both x,y are in cell-size
+        cell_size = 1./self.S
+        xy = xywh[..., :2] * cell_size
+        half_wh = xywh[..., 2:4] * .5
+        return torch.cat([xy - half_wh, xy + half_wh], dim=-1)
 
-    def forward(self, pred_tensor, target_tensor):
+    def forward(self, pred_tensor, target_tensor, normalizer=None):
         """ Compute loss.
 
         Args:
             pred_tensor (Tensor): predictions, sized [batch_size, S, S, Bx5+C], 5=len([x, y, w, h, conf]).
             target_tensor (Tensor):  targets, sized [batch_size, S, S, Bx5+C].
+            normalizer (int, optional): number of images the losses are averaged over, e.g. the size of the whole
+                batch when this is one of its micro-batches, so that the losses of the micro-batches sum up to the
+                loss of the batch. (default: batch_size)
         Returns:
             loss_xy (Tensor): localization loss for center positions (x, y) of bboxes.
             loss_wh (Tensor): localization loss for width, height of bboxes.
@@ -199,7 +260,56 @@ class Loss(nn.Module):
             loss_noobj (Tensor): no-objectness loss.
             loss_class (Tensor): classification loss.
         """
-        # Write your code here
+        if not self.vectorized:
+            return self.forward_loop(pred_tensor, target_tensor, normalizer)
+
+        batch_size = target_tensor.shape[0] if normalizer is None else normalizer
+        conf_idxs = list(range(4, self.B*5, 5)) # 'conf' of every bbox, i.e. [4, 9] for B=2
+
+        # cells which contain object, and which does NOT contain object
+        mask_obj = target_tensor[:, :, :, 4] == 1 # [batch_size, S, S]
+        mask_noobj = target_tensor[:, :, :, 4] == 0 # [batch_size, S, S]
+
+        pred_tensor_obj = pred_tensor[mask_obj] # [filtered, Bx5+C]
+        target_tensor_obj = target_tensor[mask_obj] # [filtered, Bx5+C]
+        pred_tensor_obj_bb = pred_tensor_obj[:, :self.B*5].reshape([-1, self.B, 5]) # [filtered, B, 5], 5=len([x, y, w, h, conf])
+        target_tensor_obj_bb = target_tensor_obj[:, :self.B*5].reshape([-1, self.B, 5]) # [filtered, B, 5]
+
+        # iou of every predicted bbox against the ground truth of its cell, for all cells at once.
+        # target has duplicate ground truth as in encoder function in data.py, so the first one is used.
+        # computed in float32 under autocast, since the division of small areas loses too much precision otherwise.
+        pred_bb_ltrb = self.center_to_ltrb(pred_tensor_obj_bb[:, :, :4].float()) # [filtered, B, 4]
+        target_bb_ltrb = self.center_to_ltrb(target_tensor_obj_bb[:, :1, :4].float()) # [filtered, 1, 4]
+        iou = self.compute_iou(pred_bb_ltrb, target_bb_ltrb).squeeze(-1) # [filtered, B]
+        bb_resp_iou, bb_resp_idx = iou.max(-1) # choose maximum iou as resposible, [filtered]
+
+        # gather the bboxes which is resposible for the ground truth.
+        bb_resp_idx = bb_resp_idx[:, None, None].expand(-1, 1, 5) # [filtered, 1, 5]
+        pred_resp = pred_tensor_obj_bb.gather(1, bb_resp_idx).squeeze(1) # [filtered, 5]
+        target_resp = target_tensor_obj_bb.gather(1, bb_resp_idx).squeeze(1) # [filtered, 5]
+
+        # 1. loss_xy
+        loss_xy = torch.sum((target_resp[:, :2] - pred_resp[:, :2])**2) / batch_size
+
+        # 2. loss_wh, in float32 as the gradient of sqrt blows up near 0.
+        loss_wh = torch.sum((torch.sqrt(target_resp[:, 2:4].float()) - torch.sqrt(pred_resp[:, 2:4].float()))**2) / batch_size
+
+        # 3. loss_obj, conf = P(Obj) * IOU(pred, truth)
+        loss_obj = torch.sum((bb_resp_iou - pred_resp[:, 4])**2) / batch_size
+
+        # 4. loss_noobj, consider 'conf' of every bbox
+        pred_noobj_conf = pred_tensor[mask_noobj][:, conf_idxs] # [filtered, B]
+        target_noobj_conf = target_tensor[mask_noobj][:, conf_idxs]
+        loss_noobj = torch.sum((target_noobj_conf - pred_noobj_conf)**2) / batch_size
+
+        # 5. loss_class
+        loss_class = torch.sum((target_tensor_obj[:, self.B*5:] - pred_tensor_obj[:, self.B*5:])**2) / batch_size
+
+        return loss_xy, loss_wh, loss_obj, loss_noobj, loss_class
+
+    def forward_loop(self, pred_tensor, target_tensor, normalizer=None):
+        """ Compute loss cell by cell. Reference implementation of `forward`, sharing its arguments and returns.
+        """
         def center_to_ltrb(_tensor):
             """ Transform tensor from 'center' to 'left-top, right-bottom'
 
@@ -208,7 +318,7 @@ class Loss(nn.Module):
             Returns:
                 tensor_ltrb (Tensor) : for computing iou, sized [filtered x B, 5] where we have 'filtered' cells vary in context, 5=len([x1, y1, x2, y2, conf]).
             """
-            tensor_ltrb = torch.zeros_like(_tensor).to(device)
+            tensor_ltrb = torch.zeros_like(_tensor)
             # As in encoder function, both w,h are in image-size and both x,y are in cell-size
             cell_size = 1./self.S
             tensor_ltrb[:, :2] = _tensor[:, :2] * cell_size - _tensor[:, 2:4] * .5 # compute x1, y1
@@ -217,7 +327,7 @@ class Loss(nn.Module):
             return tensor_ltrb
 
         # mask for the cells which contain object
-        batch_size = target_tensor.shape[0]
+        batch_size = target_tensor.shape[0] if normalizer is None else normalizer
         mask_obj = target_tensor[:, :, :, 4] == 1 # [batch_size, S, S]
         mask_obj = mask_obj.unsqueeze(-1).expand_as(target_tensor) # [batch_size, S, S, Bx5+C], 5=len([x, y, w, h, conf])
         # mask for the cells which does NOT contain object
@@ -234,11 +344,10 @@ class Loss(nn.Module):
         target_tensor_obj_class = target_tensor_obj[:, self.B*5:].reshape([-1, self.C]) # [filtered, C]
 
         # mask for the bounding boxes which is resposible for the ground truth.
-        mask_resp = torch.ByteTensor(pred_tensor_obj_bb.size()).to(device)
-        mask_resp.zero_()
-        
+        mask_resp = torch.zeros(pred_tensor_obj_bb.size(), dtype=torch.bool, device=pred_tensor.device)
+
         # gather iou for loss_obj
-        target_tensor_obj_iou = torch.zeros_like(target_tensor_obj_bb).to(device)
+        target_tensor_obj_iou = torch.zeros_like(target_tensor_obj_bb)
 
         for i in range(0, target_tensor_obj_bb.shape[0], self.B):
             # preprocess
@@ -252,8 +361,8 @@ class Loss(nn.Module):
             bb_resp_iou, bb_resp_idx = iou.max(0) # choose maximum iou as resposible
 
             # update
-            mask_resp[i+bb_resp_idx] = 1
-            target_tensor_obj_iou[i+bb_resp_idx, 4] = bb_resp_iou.to(device)
+            mask_resp[i+bb_resp_idx] = True
+            target_tensor_obj_iou[i+bb_resp_idx, 4] = bb_resp_iou
 
         # --- compute each loss ---
         pred_resp = pred_tensor_obj_bb[mask_resp].reshape([-1, 5])
@@ -350,84 +459,200 @@ compute_loss = Loss(grid_size, num_boxes, num_classes)
 # compute_iou testing
 
 # Problem 3. Implement Train/Test Pipeline
-from torch.utils.tensorboard import SummaryWriter
-log_dir = "./logs"
-writer = SummaryWriter(log_dir)
-tb_log_freq = 5
-import time
-
-# Training & Testing.
-model = model.to(device)
-best_test_loss_final = np.inf
-for epoch in range(1, max_epoch):
-    start_time = time.time()
-    # Learning rate scheduling
-    if epoch in [50, 150]:
-        lr *= 0.1
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
-
-    if epoch < last_epoch:
-        continue
-
-    model.train()
-    for i, (x, y) in enumerate(train_dloader):
-        # implement training pipeline here
-        # 1. set proper device
-        x = x.to(device) # torch.Size([64, 3, 224, 224])
-        y = y.to(device) # torch.Size([64, 7, 7, 30])
-
-        # 2. feed and get output from network
-        y_pred = model(x)
-
-        # 2. compute loss aggregated to a single final loss as paper
-        loss_function = Loss()
-        loss_xy, loss_wh, loss_obj, loss_noobj, loss_class = loss_function(y_pred, y)
-        train_loss_final = lambda_coord*(loss_xy+loss_wh) + loss_obj + lambda_noobj*loss_noobj + loss_class
-
-        # 3. backward and update
-        optimizer.zero_grad()
-        train_loss_final.backward()
-        optimizer.step()
+def train(data_root=data_root, batch_size=batch_size, lr=lr, max_epoch=max_epoch, num_workers=num_workers, use_amp=use_amp,
+          profile_path=profile_path, use_batch_augment=use_batch_augment, shard_root=shard_root, micro_batch_size=micro_batch_size):
+    """ Train Yolo on VOC, resuming from the last checkpoint if exists.
+    With `micro_batch_size`, every batch of `batch_size` is forwarded and backwarded in micro-batches whose
+    gradients accumulate into a single update, which bounds the memory of the activations by the micro-batch.
 
-        # tensorboard
-        n_iter = epoch * len(train_dloader) + i
-        if n_iter % tb_log_freq == 0:
-            writer.add_scalar('train/loss', train_loss_final, n_iter)
+    Returns:
+        model: (nn.Module) trained model.
+    """
+    from torch.utils.tensorboard import SummaryWriter
+    from feature_cache import FeatureCache
+    from image_cache import DecodedImageCache
+    from checkpoint import CheckpointManager
+    from metrics import MetricLogger, peak_rss_mb
+    from profiler import StageProfiler
+    from augment import BatchAugment
+    from data import encode_targets
+    from shards import ShardedIterableDataset
+    from loader import make_loader, loader_settings
+    from voc_eval import VOCEvaluator
+
+    if (use_batch_augment or shard_root is not None) and use_feature_cache:
+        raise ValueError('batch augmentation and shards cannot be used with the feature cache, which reads the dataset by itself.')
+    makedirs(ckpt_dir)
+    image_cache = DecodedImageCache(image_cache_bytes) if image_cache_bytes > 0 else None
+    train_dset, train_dloader, test_dset, test_dloader = build_dataloaders(data_root, batch_size, num_workers, image_cache, use_batch_augment,
+                                                                           shard_root)
+    batch_augment = BatchAugment() if use_batch_augment else None
+
+    # Time every stage of the first `profile_steps` steps, including the augmentations run by the workers.
+    profiler = StageProfiler(profile_path is not None, sync_cuda=device == 'cuda')
+    profiler.instrument(train_dset, ['read_image', 'random_flip', 'randomScale', 'randomBlur', 'RandomColorJitter',
+                                     'randomShift', 'randomCrop', 'transform'])
+    profiled_steps = 0
+
+    model = build_model()
+    model_params = [v for v in model.parameters() if v.requires_grad is True]
+    optimizer = optim.SGD(model_params, lr=lr, momentum=0.9, weight_decay=5e-4)
+    scaler = grad_scaler(device, use_amp)
+
+    # Load the last checkpoint if exits.
+    # Checkpoints are written in the background, and the frozen backbone only once per run.
+    last_epoch = 1 # the last training epoch. (defulat: 1)
+    best_test_loss_final = np.inf
+    ckpt_manager = CheckpointManager(ckpt_dir, keep_last=ckpt_keep, frozen=['features.' + k for k in model.features.state_dict()])
+    ckpt = ckpt_manager.load_latest(map_location=device)
+
+    if ckpt is not None:
+        model.load_state_dict(ckpt['model'])
+        optimizer.load_state_dict(ckpt['optimizer'])
+        last_epoch = ckpt['epoch'] + 1
+        best_test_loss_final = ckpt.get('best_test_loss', np.inf)
+        print('Last checkpoint is loaded. start_epoch:', last_epoch)
+    else:
+        print('No checkpoint is found.')
+
+    # Replace the image loaders by the cached features of the frozen backbone.
+    if use_feature_cache:
+        settings = loader_settings(train_dloader)
+        train_dloader = make_loader(FeatureCache(train_dset, model.features, feature_cache_root, feature_cache_views, device=device,
+                                                 num_workers=settings['num_workers']),
+                                    batch_size=batch_size, shuffle=True, drop_last=True, **settings)
+        test_dloader = make_loader(FeatureCache(test_dset, model.features, feature_cache_root, device=device,
+                                                num_workers=settings['num_workers']),
+                                   batch_size=batch_size, shuffle=False, drop_last=False, **settings)
+
+    writer = SummaryWriter(log_dir)
+    train_metrics = MetricLogger(writer, tb_log_freq, prefix='train/')
+    evaluator = VOCEvaluator(num_classes, num_bins=map_num_bins)
+
+    # Training & Testing.
+    for epoch in range(1, max_epoch):
+        start_time = time.time()
+        # Learning rate scheduling
+        if epoch in [50, 150]:
+            lr *= 0.1
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
+
+        if epoch < last_epoch:
+            continue
 
-    model.eval()
-    with torch.no_grad():
-        for x, y in test_dloader:
-            # implement testing pipeline here
+        model.train()
+        train_metrics.reset()
+        if isinstance(train_dloader.dataset, ShardedIterableDataset):
+            train_dloader.dataset.set_epoch(epoch)
+        for i, batch in enumerate(profiler.iterate(train_dloader)):
+            train_metrics.data_ready()
+            if batch_augment is not None:
+                with profiler.stage('augment'):
+                    x, boxes, labels = batch_augment(*batch)
+                    batch = x, encode_targets(boxes, labels, grid_size, num_boxes, num_classes)
+            x, y = batch
+            # implement training pipeline here
             # 1. set proper device
-            x = x.to(device) # torch.Size([64, 3, 224, 224])
-            y = y.to(device) # torch.Size([64, 7, 7, 30])
-
-            # 2. feed and get output from network
-            y_pred = model(x)
-
-            # 2. compute loss aggregated to a single final loss as paper
-            loss_function = Loss()
-            loss_xy, loss_wh, loss_obj, loss_noobj, loss_class = loss_function(y_pred, y)
-            test_loss_final = lambda_coord*(loss_xy+loss_wh) + loss_obj + lambda_noobj*loss_noobj + loss_class
-
-            # tensorboard
-            n_iter = epoch * len(test_dloader) + i
-            if n_iter % tb_log_freq == 0:
-                writer.add_scalar('test/loss', test_loss_final, n_iter)
-    
-    if test_loss_final < best_test_loss_final:
-        best_test_loss_final = test_loss_final
-
-    # save the results
-    ckpt = {'model':model.state_dict(),
-            'optimizer':optimizer.state_dict(),
-            'epoch':epoch}
-    torch.save(ckpt, ckpt_path)
-
-    # print
-    print('Epoch [%d/%d], Val Loss: %.4f, Best Val Loss: %.4f, Time: %.4f'
-    % (epoch + 1, max_epoch, test_loss_final, best_test_loss_final, time.time() - start_time))
+            with profiler.stage('to_device'):
+                x = x.to(device) # torch.Size([64, 3, 224, 224])
+                y = y.to(device) # torch.Size([64, 7, 7, 30])
+
+            # 2-3. per micro-batch, whose gradients accumulate. Its losses are normalized by the whole batch size,
+            #      so that they sum up to the loss of the batch.
+            optimizer.zero_grad()
+            train_loss_final = 0.
+            micro_size = micro_batch_size or x.size(0)
+            for x_micro, y_micro in zip(x.split(micro_size), y.split(micro_size)):
+                with autocast(device, use_amp):
+                    # 2. feed and get output from network
+                    with profiler.stage('forward'):
+                        y_pred = model.head(x_micro) if use_feature_cache else model(x_micro)
+
+                    # 2. compute loss aggregated to a single final loss as paper
+                    with profiler.stage('loss'):
+                        loss_function = Loss()
+                        loss_xy, loss_wh, loss_obj, loss_noobj, loss_class = loss_function(y_pred, y_micro, normalizer=x.size(0))
+                        loss_micro = lambda_coord*(loss_xy+loss_wh) + loss_obj + lambda_noobj*loss_noobj + loss_class
+
+                # 3. backward
+                with profiler.stage('backward'):
+                    scaler.scale(loss_micro).backward()
+                train_loss_final = train_loss_final + loss_micro.detach()
+
+            # 3. update
+            with profiler.stage('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+
+            if profiler.enabled:
+                profiled_steps += 1
+                if profiled_steps == profile_steps:
+                    profiler.stop(profile_path)
+
+            # tensorboard, averaged over every tb_log_freq iterations.
+            n_iter = epoch * len(train_dloader) + i
+            train_metrics.update(n_iter, x.size(0), {'train/loss': train_loss_final})
+
+        model.eval()
+        evaluator.reset()
+        test_loss_sum, num_test_images = 0., 0
+        with torch.no_grad():
+            for batch in test_dloader:
+                # implement testing pipeline here
+                # 1. set proper device
+                x = batch[0].to(device) # torch.Size([64, 3, 224, 224])
+                y = batch[1].to(device) # torch.Size([64, 7, 7, 30])
+
+                with autocast(device, use_amp):
+                    # 2. feed and get output from network
+                    y_pred = model.head(x) if use_feature_cache else model(x)
+
+                    # 2. compute loss aggregated to a single final loss as paper
+                    loss_function = Loss()
+                    loss_xy, loss_wh, loss_obj, loss_noobj, loss_class = loss_function(y_pred, y)
+                    test_loss_final = lambda_coord*(loss_xy+loss_wh) + loss_obj + lambda_noobj*loss_noobj + loss_class
+                test_loss_sum += test_loss_final.float() * x.size(0)
+                num_test_images += x.size(0)
+
+                # 3. match the detections to the ground truths, in the same pass. (the feature cache has no ground truths)
+                if len(batch) == 4:
+                    detections = decode_batch(y_pred.float(), num_boxes, map_score_threshold, max_det=map_max_det, padded=True)
+                    evaluator.update(detections, batch[2], batch[3])
+
+        # tensorboard, averaged over the test set.
+        test_loss_final = test_loss_sum / max(num_test_images, 1)
+        writer.add_scalar('test/loss', test_loss_final, epoch)
+        test_map = evaluator.compute() if evaluator.num_images else None
+        if test_map is not None:
+            writer.add_scalar('test/mAP', test_map['map_area'], epoch)
+            writer.add_scalar('test/mAP_11point', test_map['map_11point'], epoch)
+
+        is_best = bool(test_loss_final < best_test_loss_final)
+        if is_best:
+            best_test_loss_final = test_loss_final.item()
+
+        # save the results
+        ckpt = {'model':model.state_dict(),
+                'optimizer':optimizer.state_dict(),
+                'epoch':epoch,
+                'best_test_loss':best_test_loss_final}
+        ckpt_manager.save(ckpt, epoch, is_best)
+
+        # print
+        print('Epoch [%d/%d], Val Loss: %.4f, Best Val Loss: %.4f, Time: %.4f, Peak RSS: %.0f MB'
+        % (epoch + 1, max_epoch, test_loss_final, best_test_loss_final, time.time() - start_time, peak_rss_mb()))
+        if test_map is not None:
+            print('    Val mAP: %.4f (VOC07 11-point: %.4f)' % (test_map['map_area'], test_map['map_11point']))
+        if image_cache is not None:
+            print('Image cache:', image_cache.stats())
+    if profiler.enabled: # trained for less than `profile_steps`.
+        profiler.stop(profile_path)
+    ckpt_manager.close()
+    train_metrics.close()
+    if image_cache is not None:
+        image_cache.close()
+    return model
 
 
 # Problem 4. Implement decoder to extract bounding boxes from output-grids
@@ -438,49 +663,12 @@ VOC_CLASSES = (
     'motorbike', 'person', 'pottedplant',
     'sheep', 'sofa', 'train', 'tvmonitor')
 
-def NMS(bboxes, scores, threshold=0.35):
-    ''' Non Max Suppression
-    Args:
-        bboxes: (torch.tensors) list of bounding boxes. size:(N, 4) ((left_top_x, left_top_y, right_bottom_x, right_bottom_y), (...))
-        probs: (torch.tensors) list of confidence probability. size:(N,) 
-        threshold: (float)   
-    Returns:
-        keep_dim: (torch.tensors)
-    '''
-    x1 = bboxes[:, 0]
-    y1 = bboxes[:, 1]
-    x2 = bboxes[:, 2]
-    y2 = bboxes[:, 3]
-
-    areas = (x2 - x1) * (y2 - y1)
-
-    _, order = scores.sort(0, descending=True)
-    keep = []
-    while order.numel() > 0:
-        try:
-            i = order[0]
-        except:
-            i = order.item()
-        keep.append(i)
-
-        if order.numel() == 1: break
-
-        xx1 = x1[order[1:]].clamp(min=x1[i]) # consider intersection
-        yy1 = y1[order[1:]].clamp(min=y1[i])
-        xx2 = x2[order[1:]].clamp(max=x2[i])
-        yy2 = y2[order[1:]].clamp(max=y2[i])
-
-        w = (xx2 - xx1).clamp(min=0) # clamp out which is outbounded from current box
-        h = (yy2 - yy1).clamp(min=0)
-        inter = w * h
-
-        ovr = inter / (areas[i] + areas[order[1:]] - inter) # iou
-        ids = (ovr <= threshold).nonzero().squeeze() # leave only over the threshold
-        if ids.numel() == 0:
-            break
-        order = order[ids + 1]
-    keep_dim = torch.LongTensor(keep)
-    return keep_dim
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp') # files of the image directory that are inferred.
+
+def result_name(path):
+    """ File name of the detections drawn on the image at `path`, e.g. 'a.png' -> 'a_result.png'. """
+    name, ext = os.path.splitext(os.path.basename(path))
+    return name + '_result' + ext
 
 def inference(model, image_path):
     """ Inference function
@@ -491,6 +679,7 @@ def inference(model, image_path):
     # load & pre-processing
     image_name = image_path.split('/')[-1]
     image = cv2.imread(image_path)
+    from torchvision import transforms
 
     h, w, c = image.shape
     img = cv2.resize(image, (224, 224))
@@ -506,6 +695,16 @@ def inference(model, image_path):
     #### YOU SHOULD IMPLEMENT FOLLOWING decoder FUNCTION ####
     # decode the output grid to the detected bounding boxes, classes and probabilities.
     bboxes, class_idxs, probs = decoder(output_grid)
+    draw_detections(image, bboxes, class_idxs, probs)
+    cv2.imwrite(result_name(image_name), image)
+
+def draw_detections(image, bboxes, class_idxs, probs):
+    """ Draw bounding boxes & class names on the image in place.
+    Args:
+        image: (np.ndarray) BGR image.
+        bboxes, class_idxs, probs: (torch.tensors) detections of the image as returned by decoder.
+    """
+    h, w, c = image.shape
     num_bboxes = bboxes.size(0)
 
     # draw bounding boxes & class name
@@ -521,122 +720,299 @@ def inference(model, image_path):
         cv2.putText(image, '%s: %.2f'%(class_name, prob), (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 255), 1,
                     8)
 
-    cv2.imwrite(image_name.replace('.jpg', '_result.jpg'), image)
+def infer_folder(model, image_dir, output_dir='.', batch_size=16, num_threads=4, prefetch=2, image_size=224,
+                 score_threshold=score_threshold, nms_threshold=nms_threshold, top_k=pre_nms_top_k):
+    """ Batched inference over every image of a directory.
+    A thread pool decodes and resizes the images ahead of the model, the model runs on batches of `batch_size`
+    under inference mode, all outputs of a batch are decoded at once, and drawing/writing the results is handed
+    to a background thread pool. Throughput and per-stage latency are printed at the end.
+
+    Args:
+        model: (nn.Module) Trained YOLO model.
+        image_dir: (str) Directory of the images.
+        output_dir: (str) Directory to which '<name>_result.<ext>' are written.
+        batch_size: (int) Number of images per forward.
+        num_threads: (int) Number of threads of each of the reader and the writer pools.
+        prefetch: (int) Number of batches read ahead of the model.
+        image_size: (int) Input size of the model.
+        score_threshold, nms_threshold, top_k: decoding parameters, as in decode_batch.
+    Returns:
+        stats: (dict) number of images, images/sec and seconds spent in each stage.
+    """
+    paths = sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir)
+                   if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+    makedirs(output_dir)
+    device = next(model.parameters()).device
+    mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1)
+
+    def read(path):
+        start = time.perf_counter()
+        image = cv2.imread(path)
+        if image is None:
+            return None, None, time.perf_counter() - start
+        img = cv2.cvtColor(cv2.resize(image, (image_size, image_size)), cv2.COLOR_BGR2RGB)
+        return image, img, time.perf_counter() - start
+
+    def write(path, image, bboxes, class_idxs, probs):
+        start = time.perf_counter()
+        draw_detections(image, bboxes, class_idxs, probs)
+        cv2.imwrite(os.path.join(output_dir, result_name(path)), image)
+        return time.perf_counter() - start
+
+    stats = {'read': 0., 'wait': 0., 'model': 0., 'decode': 0., 'write': 0.}
+    readers = ThreadPoolExecutor(num_threads)
+    writers = ThreadPoolExecutor(num_threads)
+    pending = collections.deque()
+    remaining = iter(paths)
+    writes = []
+    num_images, num_batches = 0, 0
+    start = time.perf_counter()
+
+    model.eval()
+    try:
+        with torch.inference_mode():
+            while True:
+                # keep `prefetch` batches being read ahead of the model
+                while len(pending) < batch_size * (prefetch + 1):
+                    path = next(remaining, None)
+                    if path is None:
+                        break
+                    pending.append((path, readers.submit(read, path)))
+                if not pending:
+                    break
+                batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+
+                t = time.perf_counter()
+                loaded = [future.result() for _, future in batch]
+                stats['wait'] += time.perf_counter() - t
+                stats['read'] += sum(read_time for _, _, read_time in loaded)
+
+                # skip the files which cv2 cannot decode
+                for (path, _), (image, _, _) in zip(batch, loaded):
+                    if image is None:
+                        print('Skipping unreadable image:', path)
+                kept = [i for i, (image, _, _) in enumerate(loaded) if image is not None]
+                batch, loaded = [batch[i] for i in kept], [loaded[i] for i in kept]
+                if not batch:
+                    continue
+                num_images += len(batch)
+                num_batches += 1
+
+                t = time.perf_counter()
+                x = torch.from_numpy(np.stack([img for _, img, _ in loaded])).to(device)
+                x = (x.permute(0, 3, 1, 2).contiguous().float().div(255) - mean) / std # Normalization
+                output_grid = model(x).cpu()
+                stats['model'] += time.perf_counter() - t
+
+                t = time.perf_counter()
+                detections = decode_batch(output_grid, score_threshold=score_threshold, nms_threshold=nms_threshold, top_k=top_k)
+                stats['decode'] += time.perf_counter() - t
+
+                for (path, _), (image, _, _), (bboxes, class_idxs, probs) in zip(batch, loaded, detections):
+                    writes.append(writers.submit(write, path, image, bboxes, class_idxs, probs))
+
+        stats['write'] = sum(future.result() for future in writes)
+    finally:
+        # on error, the reads are cancelled while the queued writes still complete.
+        readers.shutdown(cancel_futures=True)
+        writers.shutdown()
+    elapsed = time.perf_counter() - start
+
+    print('Inference: %d images in %.2fs, %.1f images/sec' % (num_images, elapsed, num_images / max(elapsed, 1e-9)))
+    print('  read   %7.2f ms/image (%d threads), waited %.2fs' % (stats['read'] * 1e3 / max(num_images, 1), num_threads, stats['wait']))
+    print('  model  %7.2f ms/batch of %d' % (stats['model'] * 1e3 / max(num_batches, 1), batch_size))
+    print('  decode %7.2f ms/batch' % (stats['decode'] * 1e3 / max(num_batches, 1)))
+    print('  write  %7.2f ms/image (%d threads)' % (stats['write'] * 1e3 / max(num_images, 1), num_threads))
+    stats.update({'images': num_images, 'elapsed': elapsed, 'images_per_sec': num_images / max(elapsed, 1e-9)})
+    return stats
 
 def decoder(grid):
     """ Decoder function that decode the output-grid to bounding box, class and probability. 
     Args:
-        grid: (torch.tensors)
+        grid: (torch.tensors) output-grid of a single image, sized [1, S, S, Bx5+C].
     Returns:
         bboxes: (torch.tensors) list of bounding boxes. size:(N, 4) ((left_top_x, left_top_y, right_bottom_x, right_bottom_y), (...))
         class_idxs: (torch.tensors) list of class index. size:(N,)
         probs: (torch.tensors) list of confidence probability. size:(N,)
     """
+    grid = grid.reshape((-1,) + grid.shape[-3:])[:1].cpu()
+    return decode_batch(grid)[0]
 
-    grid_num = 7
-    bboxes = []
-    class_idxs = []
-    probs = []
-
-    S = grid_num
-    B = 2
-    C = 20
-
-    def rel_center_to_abs_ltrb(_tensor):
-        """ Transform tensor from relative 'center' to absolute 'left-top, right-bottom' normalized in image-size.
-
-        Args:
-            _tensor (Tensor) : original, sized [S x S x B, 5], 5=len([x, y, w, h, conf]).
-        Returns:
-            tensor_abs_ltrb (Tensor) : sized [S x S x B, 5] where we have 'filtered' cells vary in context, 5=len([x1, y1, x2, y2, conf]) normalized in image-size.
-        """
-        # As in encoder function, both w,h are in image-size and both x,y are in cell-size
-        cell_size = 1./S
-
-        # denormalized xy coordinates
-        tensor_ltrb = torch.zeros_like(_tensor)
-        for i in range(0, _tensor.shape[0], B):
-            cell_x0 = int(i/B) % 7
-            cell_y0 = int(i/B) // 7 # j
-            # print("cell_y0x0:", i, (cell_y0, cell_x0), _tensor[i])
-            # print("cell_y0x02:", i, (cell_y0, cell_x0), _tensor[i+1])
-            abs_cell_x0y0 = torch.FloatTensor([cell_x0, cell_y0]) * cell_size # as a reverse of encoder, the left-top coordinates of this cell normalized in image-size
-            # compute x1, y1, x2, y2 normalized in image-size / w,h are already normalized in image-size
-            tensor_ltrb[i:i+2, :2] = _tensor[i:i+2, :2] * cell_size + abs_cell_x0y0 - 0.5 * _tensor[i:i+2, 2:4]
-            tensor_ltrb[i:i+2, 2:4] = _tensor[i:i+2, :2] * cell_size + abs_cell_x0y0 + 0.5 * _tensor[i:i+2, 2:4] 
-            tensor_ltrb[i:i+2, 4] = _tensor[i:i+2, 4] # pass conf
-        
-        return tensor_ltrb # abs_ltrb
-
-    # for i in range(S):
-    #     for j in range(S):
-    #         print("ji:", (j,i))
-    #         print(grid[j, i, :5])
-    #         print(grid[j, i, 5:5*B])
-
-    # grid : [S, S, Bx5+C] = [7, 7, 30]
-    grid = grid.squeeze().cpu().data
-    
-    # extract coordinates and confidences
-    grid_coord = grid[:,:,:B*5].reshape([-1, 5]) # [S x S x B, 5], 5=len([x, y, w, h, conf])
-    grid_coord_abs_ltrb = rel_center_to_abs_ltrb(grid_coord) # [S x S x B, 5], 5=len([x1, y1, x2, y2, conf]) in real image-size
-    bboxes_all = grid_coord_abs_ltrb[:,:4] # [S X S X B, 4], we only need (left_top_x, left_top_y, right_bottom_x, right_bottom_y) for each boxes
-    probs_all = grid_coord_abs_ltrb[:,4] # [S X S X B]
-
-    # extract class probabilities
-    grid_class = grid[:,:,B*5:] # [S, S, C]
-    grid_class = grid_class.repeat([1,1,B]).reshape([-1, C]) # [S x S x B, C]
-
-    # compute class scores for filtering out lower ones
-    score_threshold = 0.2
-    class_score_all = grid_class * grid_coord_abs_ltrb[:,4].unsqueeze(-1) # [S x S x B, C]
-    class_score_all[class_score_all < score_threshold] = 0 # set zero if score < score_threshold
-
-    # NMS among bboxes by classes
-    class_scores = []
-    for c in range(C):
-        if np.count_nonzero(class_score_all[:,c]) == 0: # if all class score are zero, then pass
-            continue
-        keep_dim = NMS(bboxes_all, class_score_all[:, c], threshold=0.35) # Non Max Suppression for each classes
-        bboxes.append(bboxes_all[keep_dim].reshape([-1, 4]))
-        probs.append(probs_all[keep_dim])
-        class_scores.append(class_score_all[keep_dim])
-
-    bboxes_decoded = []
-    probs_decoded = []
-    class_idxs_decoded = []
-    # select bboxes to draw by class score values
-    for b in range(len(bboxes)):
-        for (bb, prob, cs) in zip(bboxes[b], probs[b], class_scores[b]):
-            if np.count_nonzero(cs) == 0: # if there is no non-zero class score, then pass
-                continue
-            score, class_idx = torch.max(cs, 0)
-            if score > 0: # only count the case where each predicted label class has non-zero score
-                bboxes_decoded.append(bb)
-                probs_decoded.append(prob * score)
-                class_idxs_decoded.append(class_idx)
-
-    if len(bboxes_decoded) == 0: # Any box was not detected
-        bboxes_decoded = torch.tensor([])
-        probs_decoded = torch.tensor([])
-        class_idxs_decoded = torch.tensor([])
-
-    else:
-        # list of tensors -> tensors
-        if len(bboxes_decoded) == 1: # if only one box was detected
-            bboxes_decoded = torch.stack(bboxes_decoded)
-            probs_decoded = torch.stack(probs_decoded)
-            class_idxs_decoded = torch.stack(class_idxs_decoded)
-
-        else :
-            bboxes_decoded = torch.stack(bboxes_decoded).squeeze()
-            probs_decoded = torch.stack(probs_decoded).squeeze()
-            class_idxs_decoded = torch.stack(class_idxs_decoded).squeeze()
+@functools.lru_cache(maxsize=None)
+def cell_offsets(S, B, device='cpu'):
+    """ Left-top coordinates of the cell of every bbox, normalized in image-size.
 
-    return bboxes_decoded, class_idxs_decoded, probs_decoded
+    Args:
+        S: (int) grid size.
+        B: (int) number of bboxes per each cell.
+        device: (str) device of the returned tensor.
+    Returns:
+        (torch.tensors) sized [S x S x B, 2], in the order of grid[:, :, :Bx5].reshape([-1, 5]).
+    """
+    cell = torch.arange(S*S).repeat_interleave(B) # cell index of every bbox, row-major
+    return (torch.stack([cell % S, cell // S], dim=-1).float() / S).to(device)
 
-test_image_dir = 'test_images'
-image_path_list = [os.path.join(test_image_dir, path) for path in os.listdir(test_image_dir)]
+def decode_batch(grid, num_boxes=2, score_threshold=score_threshold, nms_threshold=nms_threshold, top_k=None,
+                 max_det=None, padded=False):
+    """ Decode the output-grids of a batch to bounding boxes, classes and probabilities at once.
+    A bbox is a candidate for every class whose score (class probability x confidence) is at least `score_threshold`,
+    and NMS runs over them per image and class, or only over the `top_k` highest scored ones when given.
+    Bboxes whose best class score is under the threshold are pruned before any class score is computed, so
+    the cost of the class scores and of NMS follows the number of survivors rather than all S x S x B x C.
 
-for image_path in image_path_list:
-    inference(model, image_path)
\ No newline at end of file
+    Args:
+        grid: (torch.tensors) output-grids, sized [N, S, S, Bx5+C].
+        num_boxes: (int) B, number of bboxes per each cell.
+        score_threshold: (float) minimum class score of the detections.
+        nms_threshold: (float) IoU threshold of NMS.
+        top_k: (int, optional) maximum number of candidates per image and class entering NMS, a latency setting of
+            inference. (default: None, all of them, as decoder and the mAP evaluation need)
+        max_det: (int, optional) maximum number of detections per image.
+        padded: (bool) return padded tensors instead of a list per image.
+    Returns:
+        if padded is False, list of (bboxes, class_idxs, probs) per image, each sized (K, 4), (K,), (K,) as in decoder.
+        if padded is True, (bboxes, class_idxs, probs, num_dets) sized [N, K, 4], [N, K], [N, K], [N]
+        where K is the maximum number of detections in the batch, and paddings have class_idx -1 and prob 0.
+    """
+    grid = grid.detach()
+    N, S = grid.shape[:2]
+    B = num_boxes
+    C = grid.shape[-1] - B*5
+
+    # extract coordinates and confidences, and convert all bboxes to (x1, y1, x2, y2) normalized in image-size
+    grid_coord = grid[..., :B*5].reshape([N, S*S*B, 5]) # [N, S x S x B, 5], 5=len([x, y, w, h, conf])
+    xy = grid_coord[..., :2] / S + cell_offsets(S, B, str(grid.device))
+    half_wh = grid_coord[..., 2:4] * .5
+    bboxes_all = torch.cat([xy - half_wh, xy + half_wh], dim=-1) # [N, S x S x B, 4]
+    probs_all = grid_coord[..., 4] # [N, S x S x B]
+
+    # prune the bboxes which cannot reach the threshold with their best class
+    grid_class = grid[..., B*5:].reshape([N, S*S, C])
+    best_score = grid_class.amax(-1).repeat_interleave(B, dim=1) * probs_all # [N, S x S x B]
+    img_idx, box_idx = (best_score >= score_threshold).nonzero(as_tuple=True)
+
+    # class scores of the surviving bboxes, and the (image, bbox, class) candidates over the threshold
+    class_score = grid_class[img_idx, box_idx // B] * probs_all[img_idx, box_idx].unsqueeze(-1) # [M, C]
+    cand_idx, class_idx = (class_score >= score_threshold).nonzero(as_tuple=True)
+    img_idx, box_idx = img_idx[cand_idx], box_idx[cand_idx]
+    scores = class_score[cand_idx, class_idx]
+
+    # keep the top_k candidates of every (image, class)
+    if top_k is not None and len(scores) > top_k:
+        group = img_idx * C + class_idx
+        order = scores.argsort(descending=True)
+        order = order[group[order].argsort(stable=True)]
+        _, counts = torch.unique_consecutive(group[order], return_counts=True)
+        rank = torch.arange(len(order), device=grid.device) - (counts.cumsum(0) - counts).repeat_interleave(counts)
+        order = order[rank < top_k]
+        img_idx, box_idx, class_idx, scores = img_idx[order], box_idx[order], class_idx[order], scores[order]
+    bboxes = bboxes_all[img_idx, box_idx]
+
+    # NMS among bboxes by images and classes, all at once
+    keep = batched_nms(bboxes, scores, class_idx, img_idx, threshold=nms_threshold, max_det=max_det)
+    img_idx, class_idx, bboxes = img_idx[keep], class_idx[keep], bboxes[keep]
+    probs = probs_all[img_idx, box_idx[keep]] * scores[keep]
+
+    # order the detections by image, then by probability
+    order = probs.argsort(descending=True)
+    order = order[img_idx[order].argsort(stable=True)]
+    img_idx, class_idx, bboxes, probs = img_idx[order], class_idx[order], bboxes[order], probs[order]
+    num_dets = torch.bincount(img_idx, minlength=N)
+
+    if not padded:
+        counts = num_dets.tolist()
+        return list(zip(bboxes.split(counts), class_idx.split(counts), probs.split(counts)))
+
+    K = int(num_dets.max()) if N > 0 else 0
+    slot = torch.arange(len(img_idx), device=grid.device) - (num_dets.cumsum(0) - num_dets)[img_idx] # rank within image
+    bboxes_padded = bboxes.new_zeros((N, K, 4))
+    class_idxs_padded = class_idx.new_full((N, K), -1)
+    probs_padded = probs.new_zeros((N, K))
+    bboxes_padded[img_idx, slot] = bboxes
+    class_idxs_padded[img_idx, slot] = class_idx
+    probs_padded[img_idx, slot] = probs
+    return bboxes_padded, class_idxs_padded, probs_padded, num_dets
+
+
+def quantize(model, data_root=data_root, calib_images=256, batch_size=16, num_workers=num_workers,
+             quantized_path=os.path.join(ckpt_dir, 'yolo_int8.pth')):
+    """ Quantize `model` into int8 on CPU, calibrated on the first `calib_images` of the test split,
+    save it, and report its size, latency, loss, detections and mAP against fp32 over the whole test split.
+    """
+    from torch.utils.data import Subset
+    from data import VOCDetection, DetectionCollate
+    from quantize import quantize_yolo, save_quantized, report
+    from loader import make_loader, loader_settings
+
+    collate_fn = DetectionCollate(grid_size, num_boxes, num_classes)
+    test_dset = VOCDetection(root=data_root, split='test', encode=False)
+    test_dloader = make_loader(test_dset, num_workers, batch_size=batch_size, shuffle=False,
+                               collate_fn=DetectionCollate(grid_size, num_boxes, num_classes, return_boxes=True),
+                               tune_cache=os.path.join(data_root, loader_tune_file))
+    calib_dloader = make_loader(Subset(test_dset, range(min(calib_images, len(test_dset)))), batch_size=batch_size,
+                                shuffle=False, collate_fn=collate_fn, **loader_settings(test_dloader))
+
+    model = model.cpu().eval()
+    quantized = quantize_yolo(model, calib_dloader)
+    save_quantized(quantized, quantized_path)
+
+    loss_function = Loss(grid_size, num_boxes, num_classes)
+    def final_loss(y_pred, y):
+        loss_xy, loss_wh, loss_obj, loss_noobj, loss_class = loss_function(y_pred, y)
+        return lambda_coord*(loss_xy+loss_wh) + loss_obj + lambda_noobj*loss_noobj + loss_class
+    decode_map = functools.partial(decode_batch, num_boxes=num_boxes, score_threshold=map_score_threshold, max_det=map_max_det)
+    report(model, quantized, test_dloader, final_loss, decode_batch, decode_map)
+    return quantized
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train Yolo v1 on VOC and/or run it on a directory of images.')
+    parser.add_argument('mode', nargs='?', default='all', choices=['train', 'infer', 'all', 'export', 'quantize'],
+                        help='train, infer, train then infer with the trained model, export the checkpoint '
+                             'for CPU inference, or quantize it into int8. (default: all)')
+    parser.add_argument('--data-root', default=data_root)
+    parser.add_argument('--batch-size', type=int, default=batch_size)
+    parser.add_argument('--lr', type=float, default=lr)
+    parser.add_argument('--max-epoch', type=int, default=max_epoch)
+    parser.add_argument('--num-workers', type=lambda v: v if v == 'auto' else int(v), default=num_workers,
+                        help="number of DataLoader workers, or 'auto' to tune it.")
+    parser.add_argument('--micro-batch-size', type=int, default=micro_batch_size,
+                        help='split every batch into micro-batches of this size, accumulating their gradients.')
+    parser.add_argument('--amp', action='store_true', default=use_amp, help='train with mixed precision.')
+    parser.add_argument('--shards', default=shard_root, metavar='SHARD_ROOT',
+                        help='read the images from the shards packed by `python shards.py voc` in SHARD_ROOT.')
+    parser.add_argument('--batch-augment', action='store_true', default=use_batch_augment,
+                        help='augment whole batches in the main process instead of every image in the workers.')
+    parser.add_argument('--profile', default=profile_path, metavar='TRACE_PATH',
+                        help='profile the first %d training steps and write a Chrome trace.' % profile_steps)
+    parser.add_argument('--ckpt', default=None, help='checkpoint to infer with. (default: the latest one)')
+    parser.add_argument('--image-dir', default=test_image_dir)
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--infer-batch-size', type=int, default=16)
+    parser.add_argument('--score-threshold', type=float, default=score_threshold, help='minimum class score of the detections.')
+    parser.add_argument('--nms-threshold', type=float, default=nms_threshold, help='IoU over which NMS suppresses a detection.')
+    parser.add_argument('--top-k', type=lambda v: None if v == 'none' else int(v), default=pre_nms_top_k,
+                        help="candidates per image and class entering NMS, or 'none' for all of them.")
+    parser.add_argument('--export-path', default=os.path.join(ckpt_dir, 'yolo_cpu.pt'), help='where the exported model is saved.')
+    parser.add_argument('--quantized-path', default=os.path.join(ckpt_dir, 'yolo_int8.pth'), help='where the quantized model is saved.')
+    parser.add_argument('--calib-images', type=int, default=256, help='number of test images to calibrate the int8 backbone on.')
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    if args.mode in ['train', 'all']:
+        model = train(args.data_root, args.batch_size, args.lr, args.max_epoch, args.num_workers, args.amp, args.profile, args.batch_augment,
+                      args.shards, args.micro_batch_size)
+    if args.mode in ['infer', 'export', 'quantize']:
+        model = load_model(args.ckpt)
+    if args.mode == 'export':
+        from export import export
+        export(model.cpu(), torch.rand(1, 3, 224, 224), args.export_path)
+    if args.mode == 'quantize':
+        quantize(model, args.data_root, args.calib_images, args.infer_batch_size, args.num_workers, args.quantized_path)
+    if args.mode in ['infer', 'all']:
+        infer_folder(model, args.image_dir, args.output_dir, batch_size=args.infer_batch_size,
+                     score_threshold=args.score_threshold, nms_threshold=args.nms_threshold, top_k=args.top_k)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+""" Mixed precision helpers shared by the training loops of cs576_a2 and cs576_a3. """
+import torch
+
+
+def device_type(device):
+    return 'cuda' if str(device).startswith('cuda') else 'cpu'
+
+
+def amp_dtype(device):
+    """ float16 on GPU, bfloat16 on CPU where float16 kernels are slow or missing. """
+    return torch.float16 if device_type(device) == 'cuda' else torch.bfloat16
+
+
+def autocast(device, enabled=True):
+    """ Autocast context of `device`, in `amp_dtype(device)`. A no-op when disabled.
+
+    Ops which autocast keeps in float32 (e.g. cross entropy) are unaffected, but elementwise ops
+    follow their inputs, so numerically sensitive ones have to cast to float32 themselves.
+    """
+    return torch.autocast(device_type(device), dtype=amp_dtype(device), enabled=enabled)
+
+
+def grad_scaler(device, enabled=True):
+    """ GradScaler for float16 on GPU. bfloat16 keeps the exponent range of float32, so gradients
+    cannot underflow and the scaler is a pass-through on CPU: scale() returns the loss as is and
+    step() calls optimizer.step().
+    """
+    return torch.amp.GradScaler('cuda', enabled=enabled and device_type(device) == 'cuda')
@@ -0,0 +1,178 @@
+""" Augmentation of whole batches with vectorized torch ops, as an alternative to the per-sample augmentations of
+VOCDetection run in the DataLoader workers.
+
+The workers then only decode and resize the images (VOCDetection(..., batch_augment=True)), and BatchAugment
+applies flip, blur, HSV jitter, shift and crop to the [N, 3, H, W] batch in the main process, where it scales
+with the intra-op threads of torch instead of with worker processes.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def rgb_to_hsv(rgb, eps=1e-8):
+    """ Convert images from RGB to HSV.
+
+    Args:
+        rgb: (Tensor) RGB images in [0, 1], sized [N, 3, H, W].
+    Returns:
+        (Tensor) HSV images in [0, 1], sized [N, 3, H, W]. Hue is a fraction of the full turn.
+    """
+    maxc = rgb.amax(1)
+    delta = maxc - rgb.amin(1)
+    r, g, b = rgb.unbind(1)
+    rc, gc, bc = ((maxc.unsqueeze(1) - rgb) / delta.clamp(min=eps).unsqueeze(1)).unbind(1)
+    h = torch.where(r == maxc, bc - gc, torch.where(g == maxc, 2 + rc - bc, 4 + gc - rc))
+    h = (h / 6) % 1
+    s = delta / maxc.clamp(min=eps)
+    return torch.stack([h, s, maxc], dim=1)
+
+
+def hsv_to_rgb(hsv):
+    """ Convert images from HSV, as returned by rgb_to_hsv, back to RGB. """
+    h, s, v = hsv[:, :1], hsv[:, 1:2], hsv[:, 2:]
+    k = (torch.tensor([5., 3., 1.]).view(1, 3, 1, 1) + h * 6) % 6 # [N, 3, H, W], for r, g, b.
+    return v - v * s * torch.minimum(k, 4 - k).clamp(0, 1)
+
+
+class BatchAugment(object):
+    """ Random augmentations of a batch of images and their padded ground truths, drawn independently per image.
+
+    Each augmentation is applied to an image with probability `p`, in the order of VOCDetection: horizontal flip,
+    box blur, HSV jitter, then shift and crop, which are composed into a single affine resampling. As in
+    VOCDetection, a shift or a crop is skipped for an image when it would leave none of its boxes, and otherwise
+    drops the boxes whose center leaves the image. The random scale of VOCDetection is left out: it only
+    stretches the width before the final resize, which the normalized boxes do not see. Batches are augmented
+    on CPU, before they are moved to the device.
+
+    Args:
+        p: (float) probability of each augmentation.
+        max_shift: (float) maximum shift, as a fraction of the image size.
+        min_crop: (float) minimum size of a crop, as a fraction of the image size.
+        jitter: (tuple) factors by which hue, saturation and value are scaled.
+        blur_kernel: (int) size of the box blur, on the resized image.
+        fill: (tuple) RGB color of the area uncovered by a shift, in [0, 255].
+        mean, std: (tuple) RGB normalization of the returned images.
+        generator: (torch.Generator, optional) source of randomness.
+    """
+    def __init__(self, p=0.5, max_shift=0.2, min_crop=0.6, jitter=(0.5, 1.5), blur_kernel=3, fill=(123, 117, 104),
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), generator=None):
+        self.p = p
+        self.max_shift = max_shift
+        self.min_crop = min_crop
+        self.jitter = torch.tensor(jitter)
+        self.blur_kernel = blur_kernel
+        self.fill = torch.tensor(fill).view(1, 3, 1, 1) / 255.
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.generator = generator
+
+    def rand(self, *size):
+        return torch.rand(size, generator=self.generator)
+
+    def draw(self, n):
+        """ Which of `n` images get an augmentation. """
+        return self.rand(n) < self.p
+
+    def __call__(self, imgs, boxes, labels):
+        """ Augment and normalize a batch.
+
+        Args:
+            imgs: (Tensor) RGB images, uint8 in [0, 255] or float in [0, 1], sized [N, 3, H, W].
+            boxes: (Tensor) [x1, y1, x2, y2] normalized in image-size, sized [N, K, 4].
+            labels: (Tensor) class labels starting from 1, sized [N, K]. 0 marks padding.
+        Returns:
+            imgs: (Tensor) normalized float images, sized [N, 3, H, W].
+            boxes, labels: (Tensor) augmented ground truths, sized [N, K, 4] and [N, K]. Dropped boxes become padding.
+        """
+        imgs = imgs.float().mul_(1/255.) if imgs.dtype == torch.uint8 else imgs.float()
+        boxes = boxes.clone()
+        imgs, boxes = self.flip(imgs, boxes)
+        imgs = self.blur(imgs)
+        imgs = self.color_jitter(imgs)
+        imgs, boxes, labels = self.shift_crop(imgs, boxes, labels)
+        return imgs.sub_(self.mean).div_(self.std), boxes, labels
+
+    def flip(self, imgs, boxes):
+        flipped = self.draw(len(imgs))
+        index = flipped.nonzero().squeeze(1)
+        if len(index):
+            imgs = imgs.index_copy(0, index, imgs[index].flip(-1))
+        mirrored = torch.stack([1 - boxes[..., 2], boxes[..., 1], 1 - boxes[..., 0], boxes[..., 3]], dim=-1)
+        boxes = torch.where(flipped.view(-1, 1, 1), mirrored, boxes)
+        return imgs, boxes
+
+    def blur(self, imgs):
+        blurred = self.draw(len(imgs)).nonzero().squeeze(1)
+        if len(blurred):
+            # separable box filter over the reflected border, as cv2.blur.
+            k = self.blur_kernel
+            x = F.pad(imgs[blurred], (k//2,) * 4, mode='reflect')
+            x = sum(x[..., i:i+x.size(-1)-k+1] for i in range(k))
+            x = sum(x[..., i:i+x.size(-2)-k+1, :] for i in range(k)) / (k*k)
+            imgs = imgs.index_copy(0, blurred, x)
+        return imgs
+
+    def color_jitter(self, imgs, eps=1e-8):
+        # factor of every image on each of h, s, v: 1 or a random choice among `jitter`.
+        n = len(imgs)
+        choice = self.jitter[(self.rand(n, 3) * len(self.jitter)).long()]
+        factor = torch.where(self.rand(n, 3) < self.p, choice, torch.ones(n, 3)) # [N, 3]
+
+        hue = (factor[:, 0] != 1).nonzero().squeeze(1)
+        if len(hue):
+            hsv = rgb_to_hsv(imgs[hue])
+            hsv[:, 0] = (hsv[:, 0] * factor[hue, 0].view(-1, 1, 1)) % 1 # hue wraps around.
+            imgs = imgs.index_copy(0, hue, hsv_to_rgb(hsv))
+
+        # Saturation and value are scaled without converting to HSV: at a given hue, every channel is v*(1 - s*k)
+        # for some k, so scaling s moves the channels towards/away from v, and scaling v scales them all.
+        sv = (factor[:, 1:] != 1).any(1).nonzero().squeeze(1)
+        if len(sv):
+            x = imgs[sv]
+            v = x.amax(1, keepdim=True)
+            gap = v - x.amin(1, keepdim=True) # v*s
+            s_factor = torch.minimum(factor[sv, 1].view(-1, 1, 1, 1), v / gap.clamp(min=eps)) # s is clipped to 1.
+            v_factor = torch.minimum(factor[sv, 2].view(-1, 1, 1, 1), 1 / v.clamp(min=eps)) # v is clipped to 1.
+            imgs = imgs.index_copy(0, sv, (v - (v - x) * s_factor) * v_factor)
+        return imgs
+
+    def keep_inside(self, boxes, valid, offset, size, apply):
+        """ Boxes whose center lies in the window at `offset` of `size`, and the images where the window applies. """
+        center = (boxes[..., :2] + boxes[..., 2:]) / 2 - offset.unsqueeze(1) # [N, K, 2]
+        inside = ((center > 0) & (center < size.unsqueeze(1))).all(-1) & valid # [N, K]
+        apply = apply & inside.any(1) # skip when no box would be left.
+        return torch.where(apply.unsqueeze(1), inside, valid), apply
+
+    def shift_crop(self, imgs, boxes, labels):
+        n = len(imgs)
+        valid = labels > 0
+
+        # shift: the image moves by d, uncovering an area filled with `fill`.
+        d = (self.rand(n, 2) * 2 - 1) * self.max_shift # [N, 2]
+        valid, shifted = self.keep_inside(boxes + d.repeat(1, 2).unsqueeze(1), valid, torch.zeros(n, 2), torch.ones(n, 2), self.draw(n))
+        d = d * shifted.unsqueeze(1)
+        boxes = boxes + d.repeat(1, 2).unsqueeze(1)
+
+        # crop: the window at xy of size wh is stretched to the whole image.
+        wh = self.min_crop + (1 - self.min_crop) * self.rand(n, 2)
+        xy = self.rand(n, 2) * (1 - wh)
+        valid, cropped = self.keep_inside(boxes, valid, xy, wh, self.draw(n))
+        xy = xy * cropped.unsqueeze(1)
+        wh = torch.where(cropped.unsqueeze(1), wh, torch.ones_like(wh))
+        boxes = (boxes - xy.repeat(1, 2).unsqueeze(1)) / wh.repeat(1, 2).unsqueeze(1)
+        boxes = torch.where(cropped.view(-1, 1, 1), boxes.clamp(0, 1), boxes)
+
+        boxes = boxes * valid.unsqueeze(-1)
+        labels = labels * valid
+
+        # output pixel u in [0, 1] samples the input at xy + u*wh - d, in the [-1, 1] coordinates of grid_sample.
+        moved = (shifted | cropped).nonzero().squeeze(1)
+        if len(moved):
+            theta = torch.zeros(len(moved), 2, 3)
+            theta[:, 0, 0] = wh[moved, 0]
+            theta[:, 1, 1] = wh[moved, 1]
+            theta[:, :, 2] = 2*xy[moved] + wh[moved] - 1 - 2*d[moved]
+            grid = F.affine_grid(theta, [len(moved)] + list(imgs.shape[1:]), align_corners=False)
+            warped = F.grid_sample(imgs[moved] - self.fill, grid, mode='bilinear', padding_mode='zeros', align_corners=False) + self.fill
+            imgs = imgs.index_copy(0, moved, warped)
+        return imgs, boxes, labels
@@ -0,0 +1,688 @@
+""" Micro benchmarks of the detection hot paths, on synthetic inputs and CPU.
+
+Usage: python bench.py [name ...] [--json results.json] [--compare baseline.json]
+
+Without names, every micro benchmark runs; the model-level ones (amp, accumulate, checkpoint, amp-convergence,
+export) only run when named. Results are recorded under keys such as 'nms/batched_nms/n=1000', in seconds unless the key
+says otherwise, and can be stored as JSON and compared against the JSON of another commit.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+from box_ops import compute_iou, NMS, batched_nms
+
+A2_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cs576_a2') # where assignment2.py is.
+
+RESULTS = {} # key -> measurement of the benchmarks run so far.
+
+def record(key, value):
+    RESULTS[key] = value
+    return value
+
+
+def timeit(fn, repeat=5, warmup=1):
+    """ Median wall time of fn() in seconds. """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def random_bboxes(n, num_classes=20, seed=0):
+    """ n random bboxes (x1, y1, x2, y2) normalized in image-size, with scores and class indices. """
+    g = torch.Generator().manual_seed(seed)
+    xy = torch.rand((n, 2), generator=g)
+    wh = torch.rand((n, 2), generator=g) * 0.3 + 0.01
+    bboxes = torch.cat([xy, xy + wh], dim=1)
+    scores = torch.rand((n,), generator=g)
+    class_idxs = torch.randint(0, num_classes, (n,), generator=g)
+    return bboxes, scores, class_idxs
+
+
+def degenerate_bboxes(n, num_classes=20, seed=0):
+    """ random_bboxes with a third of them collapsed to zero width or height, and some of those duplicated. """
+    bboxes, scores, class_idxs = random_bboxes(n, num_classes, seed)
+    bboxes[0::6, 2] = bboxes[0::6, 0]
+    bboxes[3::6, 3] = bboxes[3::6, 1]
+    dup = torch.arange(0, n, 12)
+    return torch.cat([bboxes, bboxes[dup]]), torch.cat([scores, scores[dup] * 0.5]), torch.cat([class_idxs, class_idxs[dup]])
+
+
+def random_targets(batch_size, num_objects=3, seed=0):
+    """ Yolo targets of `batch_size` images with `num_objects` random ground truths each, with the ground truths. """
+    from data import encode_targets
+    g = torch.Generator().manual_seed(seed)
+    xy = torch.rand((batch_size, num_objects, 2), generator=g) * 0.7
+    boxes = torch.cat([xy, xy + torch.rand((batch_size, num_objects, 2), generator=g) * 0.3 + 0.01], dim=-1)
+    labels = torch.randint(1, 21, (batch_size, num_objects), generator=g)
+    return encode_targets(boxes, labels), boxes, labels
+
+
+def synthetic_voc(root, num_images=5000, split='train', seed=0):
+    """ Write a label file of `num_images` random images, 1 to 5 objects each, as labels/<split>.txt under root. """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, 'labels'), exist_ok=True)
+    with open(os.path.join(root, 'labels', '%s.txt' % split), 'w') as f:
+        for i in range(num_images):
+            objects = []
+            for _ in range(rng.randint(1, 6)):
+                x1, y1 = rng.randint(0, 300), rng.randint(0, 200)
+                objects.append('%d %d %d %d %d' % (x1, y1, x1 + rng.randint(20, 200), y1 + rng.randint(20, 170), rng.randint(0, 20)))
+            f.write('%s_%06d.jpg %s\n' % (split, i, ' '.join(objects)))
+
+
+def bench_iou():
+    """ compute_iou of N against M bboxes, as used by Loss and NMS. """
+    for n, m in [(98, 1), (100, 100), (1000, 1000), (64*49, 2)]:
+        bbox1, _, _ = random_bboxes(n, seed=1)
+        bbox2, _, _ = random_bboxes(m, seed=2)
+        t = record('iou/N=%d,M=%d' % (n, m), timeit(lambda: compute_iou(bbox1, bbox2)))
+        print('iou N=%-5d M=%-5d %8.3f ms' % (n, m, t * 1e3))
+
+
+def bench_loss():
+    """ Loss.forward on random predictions against targets of 3 objects per image. """
+    import a3
+    loss_function = a3.Loss(a3.grid_size, a3.num_boxes, a3.num_classes)
+    for batch_size in [1, 16, 64]:
+        target, _, _ = random_targets(batch_size)
+        pred = torch.rand(target.shape)
+        t = record('loss/forward/batch=%d' % batch_size, timeit(lambda: loss_function(pred, target)))
+        print('loss forward batch=%-3d %8.3f ms' % (batch_size, t * 1e3))
+
+
+def parity_targets(seed=0):
+    """ Targets of 8 images with no object, one object per cell, and several objects sharing a cell. """
+    from data import encode_targets
+    g = torch.Generator().manual_seed(seed)
+    boxes, labels = torch.zeros((8, 4, 4)), torch.zeros((8, 4), dtype=torch.long)
+    for i in range(1, 8):
+        num_objects = 1 if i < 4 else 4
+        xy = torch.rand((num_objects, 2), generator=g) * 0.7
+        if i >= 4: # centers within one cell
+            xy = xy[:1] + torch.rand((num_objects, 2), generator=g) * 0.02
+        wh = torch.rand((num_objects, 2), generator=g) * 0.25 + 0.02
+        boxes[i, :num_objects] = torch.cat([xy - wh / 2, xy + wh / 2], dim=-1).clamp(0, 1)
+        labels[i, :num_objects] = torch.randint(1, 21, (num_objects,), generator=g)
+    return encode_targets(boxes, labels)
+
+
+def bench_loss_parity():
+    """ Loss.forward has to match the per-cell reference forward_loop: every loss term, and the gradient of every
+    term with respect to the predictions, for images with no object, one object per cell and several per cell. """
+    import a3
+    loss_function = a3.Loss(a3.grid_size, a3.num_boxes, a3.num_classes)
+    names = ['loss_xy', 'loss_wh', 'loss_obj', 'loss_noobj', 'loss_class']
+    for seed in range(3):
+        target = parity_targets(seed)
+        pred = torch.rand(target.shape, generator=torch.Generator().manual_seed(seed)) * 0.9 + 0.05
+        for k, name in enumerate(names):
+            results = []
+            for forward in [loss_function.forward, loss_function.forward_loop]:
+                x = pred.clone().requires_grad_(True)
+                term = forward(x, target)[k]
+                grad, = torch.autograd.grad(term, x, allow_unused=True)
+                results.append((term.detach(), torch.zeros_like(x) if grad is None else grad))
+            (vec, vec_grad), (loop, loop_grad) = results
+            if not torch.allclose(vec, loop, rtol=1e-5, atol=1e-6) or not torch.allclose(vec_grad, loop_grad, rtol=1e-5, atol=1e-6):
+                raise SystemExit('Loss.forward differs from forward_loop in %s (seed %d): %.6f vs %.6f, grad max diff %.3g'
+                                 % (name, seed, vec, loop, (vec_grad - loop_grad).abs().max()))
+    print('loss parity: forward matches forward_loop on %d terms x 3 seeds, values and gradients' % len(names))
+
+
+def bench_decode():
+    """ decoder on a single output grid, and decode_batch on a batch of 64, of random predictions. """
+    import a3
+    g = torch.Generator().manual_seed(0)
+    grid = torch.rand((64, a3.grid_size, a3.grid_size, a3.num_boxes*5 + a3.num_classes), generator=g)
+    t = record('decode/decoder', timeit(lambda: a3.decoder(grid[:1])))
+    print('decode decoder           %8.3f ms' % (t * 1e3))
+    t = record('decode/decode_batch/batch=64', timeit(lambda: a3.decode_batch(grid)))
+    print('decode decode_batch x64  %8.3f ms' % (t * 1e3))
+
+
+def trained_like_grid(batch_size, seed=0):
+    """ Output grids shaped like those of a trained model: peaked class probabilities and mostly low confidences. """
+    import a3
+    g = torch.Generator().manual_seed(seed)
+    S, B, C = a3.grid_size, a3.num_boxes, a3.num_classes
+    grid = torch.rand((batch_size, S, S, B*5 + C), generator=g)
+    grid[..., 4:B*5:5] = grid[..., 4:B*5:5] ** 4
+    grid[..., B*5:] = torch.softmax(torch.randn((batch_size, S, S, C), generator=g) * 3, dim=-1)
+    return grid
+
+
+def bench_decode_thresholds():
+    """ decode_batch on a batch of 64 trained-like grids across score thresholds, with and without the top-K. """
+    import a3
+    grid = trained_like_grid(64)
+    for score_threshold in [0.01, 0.05, 0.1, 0.2, 0.3]:
+        num_cands = int((grid[..., a3.num_boxes*5:].repeat_interleave(a3.num_boxes, dim=-2).reshape(64, -1, a3.num_classes)
+                         * grid[..., 4:a3.num_boxes*5:5].reshape(64, -1, 1) >= score_threshold).sum())
+        line = 'decode threshold=%.2f candidates=%-6d' % (score_threshold, num_cands)
+        for top_k in [None, a3.pre_nms_top_k, 5]:
+            t = record('decode/thresholds/threshold=%g,top_k=%s' % (score_threshold, top_k),
+                       timeit(lambda: a3.decode_batch(grid, score_threshold=score_threshold, top_k=top_k)))
+            line += '  top_k=%-4s %8.3f ms' % (top_k, t * 1e3)
+        print(line)
+
+
+def reference_voc_ap(bboxes, class_idxs, probs, gt_boxes, gt_labels, num_classes=20, iou_threshold=0.5):
+    """ Area AP of every class by the VOC protocol, one class and one detection at a time, on padded tensors. """
+    aps = []
+    for c in range(num_classes):
+        dets = sorted(((float(probs[i, k]), i, k) for i, k in (class_idxs == c).nonzero().tolist()), reverse=True)
+        num_gts = int((gt_labels == c + 1).sum())
+        if num_gts == 0:
+            aps.append(float('nan'))
+            continue
+        used, tp = set(), []
+        for _, i, k in dets:
+            gts = (gt_labels[i] == c + 1).nonzero().squeeze(1).tolist()
+            ious = [float(compute_iou(bboxes[i, k:k+1], gt_boxes[i, g:g+1])) for g in gts]
+            best = max(range(len(gts)), key=lambda j: ious[j]) if gts else None
+            hit = best is not None and ious[best] >= iou_threshold and (i, gts[best]) not in used
+            if hit:
+                used.add((i, gts[best]))
+            tp.append(hit)
+        tp = np.array(tp, dtype=bool)
+        rec = np.cumsum(tp) / num_gts
+        prec = np.cumsum(tp) / np.maximum(np.arange(1, len(tp) + 1), 1)
+        mrec = np.concatenate([[0.], rec, [1.]])
+        mpre = np.maximum.accumulate(np.concatenate([[0.], prec, [0.]])[::-1])[::-1]
+        aps.append(float(np.sum((mrec[1:] - mrec[:-1]) * mpre[1:])))
+    return aps
+
+
+def bench_voc_eval(num_images=64, num_dets=30, tolerance=1e-3):
+    """ VOCEvaluator against the reference VOC AP on random detections around the ground truths: the exact mode
+    has to match it, the histogram mode to stay within `tolerance`. Also times the update of a batch. """
+    from voc_eval import VOCEvaluator
+    g = torch.Generator().manual_seed(0)
+    _, gt_boxes, gt_labels = random_targets(num_images, num_objects=4)
+    # half of the detections jitter a ground truth, a few with the wrong class, the rest are random.
+    near = torch.randint(0, 4, (num_images, num_dets // 2), generator=g)
+    jittered = gt_boxes.gather(1, near.unsqueeze(-1).expand(-1, -1, 4)) + torch.randn((num_images, num_dets // 2, 4), generator=g) * 0.03
+    labels = gt_labels.gather(1, near) - 1
+    labels = torch.where(torch.rand(labels.shape, generator=g) < 0.2, torch.randint(0, 20, labels.shape, generator=g), labels)
+    random_boxes, _, random_labels = random_bboxes(num_images * (num_dets - num_dets // 2), seed=1)
+    bboxes = torch.cat([jittered, random_boxes.view(num_images, -1, 4)], dim=1)
+    class_idxs = torch.cat([labels, random_labels.view(num_images, -1)], dim=1)
+    probs, order = torch.rand((num_images, num_dets), generator=g).sort(dim=1, descending=True)
+    bboxes, class_idxs = bboxes.gather(1, order.unsqueeze(-1).expand(-1, -1, 4)), class_idxs.gather(1, order)
+    class_idxs[:, -3:] = -1 # paddings
+    detections = (bboxes, class_idxs, probs, (class_idxs >= 0).sum(1))
+
+    reference = np.nanmean(reference_voc_ap(bboxes, class_idxs, probs, gt_boxes, gt_labels))
+    for name, num_bins, limit in [('exact', None, 1e-9), ('bins=10000', 10000, tolerance)]:
+        evaluator = VOCEvaluator(num_bins=num_bins)
+        t = record('voc_eval/update/%s/batch=%d' % (name, num_images), timeit(lambda: (evaluator.reset(), evaluator.update(detections, gt_boxes, gt_labels))))
+        mAP = evaluator.compute()['map_area']
+        print('voc_eval %-10s mAP: %.6f  reference: %.6f  update x%d: %8.3f ms' % (name, mAP, reference, num_images, t * 1e3))
+        if abs(mAP - reference) > limit:
+            raise SystemExit('VOCEvaluator (%s) differs from the reference mAP by %.3g' % (name, abs(mAP - reference)))
+
+
+def bench_encoder():
+    """ VOCDetection.encoder per image, and encode_targets of a batch of 64 at once as in DetectionCollate. """
+    from data import VOCDetection, encode_targets
+    root = tempfile.mkdtemp()
+    try:
+        synthetic_voc(root, num_images=1)
+        dset = VOCDetection(root, 'train')
+        _, boxes, labels = random_targets(64)
+        t = record('encoder/per_image', timeit(lambda: dset.encoder(boxes[0], labels[0])))
+        print('encoder per image        %8.3f ms' % (t * 1e3))
+        t = record('encoder/encode_targets/batch=64', timeit(lambda: encode_targets(boxes, labels, dset.S, dset.B, dset.C)))
+        print('encoder batch of 64      %8.3f ms' % (t * 1e3))
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_augment():
+    """ Each augmentation of VOCDetection on a random 500x375 image with 3 objects. """
+    from data import VOCDetection
+    root = tempfile.mkdtemp()
+    try:
+        synthetic_voc(root, num_images=1)
+        dset = VOCDetection(root, 'train')
+    finally:
+        shutil.rmtree(root)
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (375, 500, 3)).astype(np.uint8)
+    boxes = torch.tensor([[48., 240., 195., 371.], [8., 12., 352., 498.], [100., 50., 300., 200.]])
+    labels = torch.tensor([12, 15, 3])
+    random.seed(0)
+    cases = [('random_flip', lambda: dset.random_flip(img.copy(), boxes.clone())),
+             ('randomScale', lambda: dset.randomScale(img, boxes.clone())),
+             ('randomBlur', lambda: dset.randomBlur(img)),
+             ('RandomBrightness', lambda: dset.RandomBrightness(img)),
+             ('RandomSaturation', lambda: dset.RandomSaturation(img)),
+             ('RandomHue', lambda: dset.RandomHue(img)),
+             ('RandomColorJitter', lambda: dset.RandomColorJitter(img)),
+             ('randomShift', lambda: dset.randomShift(img, boxes.clone(), labels.clone())),
+             ('randomCrop', lambda: dset.randomCrop(img, boxes.clone(), labels.clone()))]
+    for name, fn in cases:
+        t = record('augment/%s' % name, timeit(fn, repeat=21))
+        print('augment %-18s %8.3f ms' % (name, t * 1e3))
+
+
+def bench_batch_augment():
+    """ A batch of 64 synthetic images through the per-sample augmentations of VOCDetection, against decoding and
+    resizing only followed by BatchAugment on the whole batch, at 1 intra-op thread and at all of them. """
+    import cv2
+    from data import VOCDetection, DetectionCollate
+    from augment import BatchAugment
+    root = tempfile.mkdtemp()
+    try:
+        synthetic_voc(root, num_images=64)
+        os.makedirs(os.path.join(root, 'images'))
+        rng = np.random.RandomState(0)
+        for i in range(64):
+            cv2.imwrite(os.path.join(root, 'images', 'train_%06d.jpg' % i), rng.randint(0, 256, (375, 500, 3)).astype(np.uint8))
+        per_sample = VOCDetection(root, 'train', encode=False)
+        per_batch = VOCDetection(root, 'train', encode=False, batch_augment=True)
+        collate_fn = DetectionCollate(encode=False)
+        augment = BatchAugment(generator=torch.Generator().manual_seed(0))
+        random.seed(0)
+        threads = torch.get_num_threads()
+        t_sample = record('batch_augment/per_sample/batch=64', timeit(lambda: collate_fn([per_sample[i] for i in range(64)]), repeat=3))
+        t_decode = record('batch_augment/decode_resize/batch=64', timeit(lambda: collate_fn([per_batch[i] for i in range(64)]), repeat=3))
+        batch = collate_fn([per_batch[i] for i in range(64)])
+        for num_threads in sorted({1, threads}):
+            torch.set_num_threads(num_threads)
+            t_batch = record('batch_augment/batch_augment/batch=64,threads=%d' % num_threads, timeit(lambda: augment(*batch), repeat=5))
+            print('batch augment x64, %d threads: per sample: %8.2f ms  decode+resize: %8.2f ms + batch: %8.2f ms'
+                  % (num_threads, t_sample * 1e3, t_decode * 1e3, t_batch * 1e3))
+        torch.set_num_threads(threads)
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_parse_labels():
+    """ VOCDetection.parse_labels on a synthetic label file of 5000 images: packing it, then loading the packed arrays. """
+    from data import VOCDetection
+    root = tempfile.mkdtemp()
+    try:
+        synthetic_voc(root, num_images=5000)
+        dset = VOCDetection(root, 'train')
+        def cold():
+            for ext in ('.fnames.npy', '.boxes.npy', '.labels.npy', '.offsets.npy'):
+                os.remove(os.path.join(root, 'labels', 'train' + ext))
+            return dset.parse_labels()
+        t = record('parse_labels/pack/images=5000', timeit(cold, repeat=3))
+        print('parse_labels pack 5000 images  %8.2f ms' % (t * 1e3))
+        t = record('parse_labels/load/images=5000', timeit(dset.parse_labels))
+        print('parse_labels load 5000 images  %8.2f ms' % (t * 1e3))
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_nms():
+    """ NMS called once per class, as decoder did, versus a single batched_nms over all classes.
+    Fails when they keep different bboxes, including on degenerate bboxes of zero area. """
+    cases = [('n=%d' % n, random_bboxes(n)) for n in [98, 1000, 10000]] + [('degenerate', degenerate_bboxes(1000))]
+    for name, (bboxes, scores, class_idxs) in cases:
+
+        def per_class():
+            keep = []
+            for c in class_idxs.unique():
+                idx = (class_idxs == c).nonzero().squeeze(1)
+                keep.append(idx[NMS(bboxes[idx], scores[idx])])
+            return torch.cat(keep)
+
+        same = set(per_class().tolist()) == set(batched_nms(bboxes, scores, class_idxs).tolist()) and \
+            set(per_class().tolist()) == set(batched_nms(bboxes, scores, class_idxs, max_matrix=1).tolist())
+        t_loop = record('nms/NMS_per_class/%s' % name, timeit(per_class))
+        t_batched = record('nms/batched_nms/%s' % name, timeit(lambda: batched_nms(bboxes, scores, class_idxs)))
+        print('nms %-10s NMS per class: %8.2f ms  batched_nms: %8.2f ms  (x%.1f, same keep: %s)'
+              % (name, t_loop * 1e3, t_batched * 1e3, t_loop / t_batched, same))
+        if not same:
+            raise SystemExit('batched_nms keeps other bboxes than NMS on %s' % name)
+
+
+def import_time(module, repeat=5):
+    """ Median wall time of importing `module` in a fresh interpreter, in seconds. """
+    code = 'import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)' % module
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = [float(subprocess.check_output([sys.executable, '-c', code], cwd=here)) for _ in range(repeat)]
+    return sorted(times)[len(times) // 2]
+
+
+IMPORT_BUDGET = 1.0 # seconds `import a3` may take on top of `import torch`.
+
+def bench_import():
+    """ `import a3` must not build datasets, loaders or models. Fails when its overhead over torch exceeds the budget. """
+    t_torch = record('import/torch', import_time('torch'))
+    t_a3 = record('import/a3', import_time('a3'))
+    print('import torch: %8.2f ms  import a3: %8.2f ms  (overhead: %.2f ms, budget: %.2f ms)'
+          % (t_torch * 1e3, t_a3 * 1e3, (t_a3 - t_torch) * 1e3, IMPORT_BUDGET * 1e3))
+    if t_a3 - t_torch > IMPORT_BUDGET:
+        raise SystemExit('import a3 is over budget')
+
+
+def peak_memory(device):
+    """ Peak memory of this process in MB: allocated by torch on GPU, resident set size on CPU. """
+    from metrics import peak_rss_mb
+    if str(device).startswith('cuda'):
+        return torch.cuda.max_memory_allocated() / 2**20
+    return peak_rss_mb()
+
+
+def run_isolated(fn, *args):
+    """ fn(*args) in a fresh spawned process, so that its peak memory is measured on its own. """
+    with mp.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def amp_case(name, batch_size, seed=0):
+    """ Model, trainable parameters, loss function and a random batch of `yolo` or `cifar`. """
+    torch.manual_seed(seed)
+    if name == 'yolo':
+        import a3
+        from data import encode_targets
+        model = a3.Yolo(a3.grid_size, a3.num_boxes, a3.num_classes)
+        model.features.requires_grad_(False)
+        loss_function = a3.Loss(a3.grid_size, a3.num_boxes, a3.num_classes)
+        def compute_loss(y_pred, y):
+            loss_xy, loss_wh, loss_obj, loss_noobj, loss_class = loss_function(y_pred, y)
+            return a3.lambda_coord*(loss_xy+loss_wh) + loss_obj + a3.lambda_noobj*loss_noobj + loss_class
+        x = torch.rand((batch_size, 3, 224, 224))
+        xy = torch.rand((batch_size, 3, 2)) * 0.7
+        boxes = torch.cat([xy, xy + torch.rand((batch_size, 3, 2)) * 0.3 + 0.01], dim=-1)
+        y = encode_targets(boxes, torch.randint(1, a3.num_classes+1, (batch_size, 3)), a3.grid_size, a3.num_boxes, a3.num_classes)
+    else:
+        sys.path.append(A2_DIR)
+        import assignment2
+        args = assignment2.args
+        model = assignment2.MyNetwork(args.num_filters, args.resblock_type, args.num_resblocks, args.use_bn)
+        compute_loss = model.compute_loss
+        x = torch.rand((batch_size, 3, 32, 32))
+        y = torch.randint(0, 10, (batch_size,))
+    params = [v for v in model.parameters() if v.requires_grad]
+    return model, params, compute_loss, x, y
+
+
+def amp_step(name, batch_size, use_amp, steps=5):
+    """ Median training step time and peak memory of `name`, in fp32 or mixed precision. """
+    from amp import autocast, grad_scaler
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model, params, compute_loss, x, y = amp_case(name, batch_size)
+    model, x, y = model.to(device), x.to(device), y.to(device)
+    optimizer = torch.optim.SGD(params, lr=1e-3, momentum=0.9)
+    scaler = grad_scaler(device, use_amp)
+
+    def step():
+        with autocast(device, use_amp):
+            loss = compute_loss(model(x), y)
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    return timeit(step, repeat=steps), peak_memory(device)
+
+
+def bench_amp():
+    """ Training step of Yolo + Loss and of MyNetwork + compute_loss, in fp32 and in mixed precision. """
+    for name, batch_size in [('yolo', 8), ('cifar', 64)]:
+        t_fp32, mem_fp32 = run_isolated(amp_step, name, batch_size, False)
+        t_amp, mem_amp = run_isolated(amp_step, name, batch_size, True)
+        record('amp/%s/fp32' % name, t_fp32)
+        record('amp/%s/amp' % name, t_amp)
+        record('amp/%s/fp32/peak_mb' % name, mem_fp32)
+        record('amp/%s/amp/peak_mb' % name, mem_amp)
+        print('amp %-5s batch=%-3d fp32: %8.2f ms %8.1f MB  amp: %8.2f ms %8.1f MB  (x%.2f)'
+              % (name, batch_size, t_fp32 * 1e3, mem_fp32, t_amp * 1e3, mem_amp, t_fp32 / t_amp))
+
+
+def accumulate_step(name, batch_size, micro_batch_size, steps=3):
+    """ Median training step time and peak memory of `name` on batches of `batch_size`, accumulating the gradients
+    of micro-batches of `micro_batch_size` as the training loops do. """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model, params, compute_loss, x, y = amp_case(name, batch_size)
+    model, x, y = model.to(device), x.to(device), y.to(device)
+    optimizer = torch.optim.SGD(params, lr=1e-3, momentum=0.9)
+
+    def step():
+        optimizer.zero_grad()
+        for x_micro, y_micro in zip(x.split(micro_batch_size), y.split(micro_batch_size)):
+            loss = compute_loss(model(x_micro), y_micro) * (len(x_micro) / batch_size)
+            loss.backward()
+        optimizer.step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    return timeit(step, repeat=steps), peak_memory(device)
+
+
+ACCUMULATE_MEMORY_CAP = 4096 # MB, under which the fastest micro-batch size is picked.
+
+def bench_accumulate():
+    """ Samples/sec and peak memory of a training step per micro-batch size, at a fixed effective batch size.
+    Each case runs in its own process, since the peak RSS of a process never goes down. """
+    for name, batch_size in [('yolo', 16), ('cifar', 64)]:
+        best = None
+        for micro_batch_size in [batch_size >> i for i in range(4)]:
+            t, mem = run_isolated(accumulate_step, name, batch_size, micro_batch_size)
+            record('accumulate/%s/micro=%d' % (name, micro_batch_size), t)
+            record('accumulate/%s/micro=%d/peak_mb' % (name, micro_batch_size), mem)
+            print('accumulate %-5s batch=%-3d micro=%-3d %9.2f ms/step %8.1f samples/s %8.1f MB'
+                  % (name, batch_size, micro_batch_size, t * 1e3, batch_size / t, mem))
+            if mem <= ACCUMULATE_MEMORY_CAP and (best is None or t < best[1]):
+                best = micro_batch_size, t
+        if best is not None:
+            print('accumulate %-5s fastest micro-batch under %d MB: %d' % (name, ACCUMULATE_MEMORY_CAP, best[0]))
+
+
+def saved_activations(model, x, y):
+    """ MB of the distinct tensors, other than parameters, kept by autograd for the backward of model on x. """
+    storages = {}
+    def pack(t):
+        if not isinstance(t, torch.nn.Parameter):
+            storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        model.compute_loss(model(x), y)
+    return sum(storages.values()) / 2**20
+
+
+def checkpoint_step(checkpoint_blocks, batch_size, steps=3):
+    """ Median training step time, peak memory and saved activations of MyNetwork as configured in
+    assignment2.args, with `checkpoint_blocks` activation checkpointing. """
+    sys.path.append(A2_DIR)
+    import assignment2
+    args = assignment2.args
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    model = assignment2.MyNetwork(args.num_filters, args.resblock_type, args.num_resblocks, args.use_bn, checkpoint_blocks).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+    x = torch.rand((batch_size, 3, 32, 32), device=device)
+    y = torch.randint(0, 10, (batch_size,), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        model.compute_loss(model(x), y).backward()
+        optimizer.step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    return timeit(step, repeat=steps), peak_memory(device), saved_activations(model, x, y)
+
+
+def bench_checkpoint():
+    """ Step time and peak memory of MyNetwork per activation checkpointing granularity, each in its own process. """
+    batch_size = 64
+    t_base, mem_base, saved_base = run_isolated(checkpoint_step, 0, batch_size)
+    for checkpoint_blocks in [0, 'stage', 4, 2, 1]:
+        t, mem, saved = ((t_base, mem_base, saved_base) if checkpoint_blocks == 0
+                         else run_isolated(checkpoint_step, checkpoint_blocks, batch_size))
+        record('checkpoint/%s' % checkpoint_blocks, t)
+        record('checkpoint/%s/peak_mb' % checkpoint_blocks, mem)
+        record('checkpoint/%s/saved_mb' % checkpoint_blocks, saved)
+        print('checkpoint %-5s batch=%-3d %9.2f ms/step  peak %8.1f MB  saved activations %7.1f MB  (time x%.2f, saved x%.2f)'
+              % (checkpoint_blocks, batch_size, t * 1e3, mem, saved, t / t_base, saved / saved_base))
+
+
+def amp_losses(name, use_amp, num_images=32, batch_size=8, epochs=5, seed=0):
+    """ Training losses over a few epochs of a small subset of the real dataset, from a fixed initialization. """
+    from amp import autocast, grad_scaler
+    from torch.utils.data import Subset, DataLoader
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model, params, compute_loss, _, _ = amp_case(name, batch_size, seed)
+    if name == 'yolo':
+        import a3
+        from data import VOCDetection, DetectionCollate
+        dset = VOCDetection(root=a3.data_root, split='train', encode=False)
+        collate_fn = DetectionCollate(a3.grid_size, a3.num_boxes, a3.num_classes)
+        optimizer = torch.optim.SGD(params, lr=a3.lr, momentum=0.9, weight_decay=5e-4)
+    else:
+        import assignment2
+        from torchvision import transforms
+        dset = assignment2.CIFAR10(assignment2.args.dataroot, train=True, transform=transforms.ToTensor())
+        collate_fn = None
+        optimizer = torch.optim.Adam(params, lr=assignment2.args.lr, weight_decay=assignment2.weight_decay)
+    subset = Subset(dset, range(0, len(dset), max(1, len(dset) // num_images))[:num_images]) # spread over classes
+    model = model.to(device)
+    scaler = grad_scaler(device, use_amp)
+
+    losses = []
+    for epoch in range(epochs):
+        # same batches and augmentations in both modes
+        torch.manual_seed(seed + epoch)
+        random.seed(seed + epoch)
+        total = 0.
+        for x, y in DataLoader(subset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn):
+            x, y = x.to(device), y.to(device)
+            with autocast(device, use_amp):
+                loss = compute_loss(model(x), y)
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            total += loss.item() * len(x)
+        losses.append(total / len(subset))
+    return losses
+
+
+def bench_amp_convergence():
+    """ Mixed precision has to follow the fp32 loss curve. Needs VOC at a3.data_root and CIFAR10 at
+    assignment2.args.dataroot, relative to the working directory; missing datasets are skipped.
+    """
+    import a3
+    sys.path.append(A2_DIR)
+    import assignment2
+    for name, root in [('yolo', a3.data_root), ('cifar', assignment2.args.dataroot)]:
+        if not os.path.exists(root):
+            print('amp-convergence %-5s skipped, %s not found' % (name, root))
+            continue
+        fp32 = run_isolated(amp_losses, name, False)
+        amp = run_isolated(amp_losses, name, True)
+        gap = record('amp-convergence/%s/final_loss_gap' % name, abs(amp[-1] - fp32[-1]) / fp32[-1])
+        print('amp-convergence %-5s fp32: %s' % (name, ' '.join('%.4f' % l for l in fp32)))
+        print('amp-convergence %-5s amp:  %s  (final loss gap: %.2f%%)' % (name, ' '.join('%.4f' % l for l in amp), gap * 100))
+
+
+def bench_export():
+    """ Eager fp32 model versus the channels-last, fused and frozen export of export.py, per batch size. """
+    from export import export
+    sys.path.append(A2_DIR)
+    import a3
+    import assignment2
+    args = assignment2.args
+    cases = [('yolo', a3.Yolo(a3.grid_size, a3.num_boxes, a3.num_classes), 224),
+             ('cifar', assignment2.MyNetwork(args.num_filters, args.resblock_type, args.num_resblocks, True), 32)]
+    for name, model, image_size in cases:
+        model.eval()
+        exported = export(model, torch.rand((1, 3, image_size, image_size)))
+        for batch_size in [1, 8, 64]:
+            x = torch.rand((batch_size, 3, image_size, image_size))
+            with torch.no_grad():
+                t_eager = record('export/%s/eager/batch=%d' % (name, batch_size), timeit(lambda: model(x), repeat=3))
+                t_export = record('export/%s/exported/batch=%d' % (name, batch_size), timeit(lambda: exported(x), repeat=3))
+            print('export %-5s batch=%-3d eager: %9.2f ms  exported: %9.2f ms  (x%.2f)'
+                  % (name, batch_size, t_eager * 1e3, t_export * 1e3, t_eager / t_export))
+
+
+BENCHMARKS = {
+    'iou': bench_iou,
+    'loss': bench_loss,
+    'loss-parity': bench_loss_parity,
+    'nms': bench_nms,
+    'decode': bench_decode,
+    'decode-thresholds': bench_decode_thresholds,
+    'voc-eval': bench_voc_eval,
+    'encoder': bench_encoder,
+    'augment': bench_augment,
+    'batch-augment': bench_batch_augment,
+    'parse-labels': bench_parse_labels,
+    'import': bench_import,
+    'amp': bench_amp,
+    'accumulate': bench_accumulate,
+    'checkpoint': bench_checkpoint,
+    'amp-convergence': bench_amp_convergence,
+    'export': bench_export,
+}
+MICRO_BENCHMARKS = ['iou', 'loss', 'loss-parity', 'nms', 'decode', 'decode-thresholds', 'voc-eval', 'encoder', 'augment', 'batch-augment', 'parse-labels', 'import']
+
+
+def metadata():
+    """ Where the results come from: commit, versions and machine. """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'torch': torch.__version__, 'threads': torch.get_num_threads(), 'machine': platform.machine(),
+            'processor': platform.processor()}
+
+
+def compare(baseline, results, tolerance=0.1):
+    """ Print the ratio of every result to its baseline, marking regressions over `tolerance`. Lower is better. """
+    print('%-48s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key], results[key]
+        ratio = new / old if old else float('inf')
+        mark = '  <- regression' if ratio > 1 + tolerance else ''
+        print('%-48s %12.6g %12.6g %7.2fx%s' % (key, old, new, ratio, mark))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro benchmarks of the detection hot paths.')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run, among: %s. (default: %s)' % (', '.join(BENCHMARKS), ', '.join(MICRO_BENCHMARKS)))
+    parser.add_argument('--json', help='write the results with their metadata to this file.')
+    parser.add_argument('--compare', help='compare the results against the JSON of a previous run.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown over which a result is a regression.')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r, choose among: %s' % (name, ', '.join(BENCHMARKS)))
+
+    torch.set_num_threads(torch.get_num_threads())
+    for name in args.names or MICRO_BENCHMARKS:
+        BENCHMARKS[name]()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'meta': metadata(), 'results': RESULTS}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['results'], RESULTS, args.tolerance)
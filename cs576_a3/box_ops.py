@@ -0,0 +1,179 @@
+import torch
+
+
+def compute_iou(bbox1, bbox2, eps=1e-9):
+    """ Compute the IoU (Intersection over Union) of two set of bboxes, each bbox format: [x1, y1, x2, y2].
+    Leading batch dimensions are broadcast. Degenerate bboxes of zero area have an IoU of 0 rather than NaN.
+
+    Args:
+        bbox1: (Tensor) bounding bboxes, sized [..., N, 4].
+        bbox2: (Tensor) bounding bboxes, sized [..., M, 4].
+        eps: (float) lower bound of the union, so that it never divides by zero.
+    Returns:
+        (Tensor) IoU, sized [..., N, M].
+    """
+    # Compute left-top coordinate of the intersections
+    lt = torch.max(
+        bbox1[..., :, None, :2], # [..., N, 2] -> [..., N, 1, 2]
+        bbox2[..., None, :, :2]  # [..., M, 2] -> [..., 1, M, 2]
+    ) # [..., N, M, 2]
+    # Conpute right-bottom coordinate of the intersections
+    rb = torch.min(
+        bbox1[..., :, None, 2:], # [..., N, 2] -> [..., N, 1, 2]
+        bbox2[..., None, :, 2:]  # [..., M, 2] -> [..., 1, M, 2]
+    ) # [..., N, M, 2]
+    # Compute area of the intersections from the coordinates
+    wh = (rb - lt).clamp(min=0) # width and height of the intersection clipped at 0, [..., N, M, 2]
+    inter = wh[..., 0] * wh[..., 1] # [..., N, M]
+
+    # Compute area of the bboxes
+    area1 = (bbox1[..., 2] - bbox1[..., 0]) * (bbox1[..., 3] - bbox1[..., 1]) # [..., N]
+    area2 = (bbox2[..., 2] - bbox2[..., 0]) * (bbox2[..., 3] - bbox2[..., 1]) # [..., M]
+
+    # Compute IoU from the areas
+    union = (area1[..., :, None] + area2[..., None, :] - inter).clamp(min=eps) # [..., N, M]
+    iou = inter / union                                                           # [..., N, M]
+
+    return iou
+
+
+def NMS(bboxes, scores, threshold=0.35):
+    ''' Non Max Suppression
+    Args:
+        bboxes: (torch.tensors) list of bounding boxes. size:(N, 4) ((left_top_x, left_top_y, right_bottom_x, right_bottom_y), (...))
+        probs: (torch.tensors) list of confidence probability. size:(N,) 
+        threshold: (float)   
+    Returns:
+        keep_dim: (torch.tensors)
+    '''
+    x1 = bboxes[:, 0]
+    y1 = bboxes[:, 1]
+    x2 = bboxes[:, 2]
+    y2 = bboxes[:, 3]
+
+    areas = (x2 - x1) * (y2 - y1)
+
+    _, order = scores.sort(0, descending=True)
+    keep = []
+    while order.numel() > 0:
+        try:
+            i = order[0]
+        except:
+            i = order.item()
+        keep.append(i)
+
+        if order.numel() == 1: break
+
+        xx1 = x1[order[1:]].clamp(min=x1[i]) # consider intersection
+        yy1 = y1[order[1:]].clamp(min=y1[i])
+        xx2 = x2[order[1:]].clamp(max=x2[i])
+        yy2 = y2[order[1:]].clamp(max=y2[i])
+
+        w = (xx2 - xx1).clamp(min=0) # clamp out which is outbounded from current box
+        h = (yy2 - yy1).clamp(min=0)
+        inter = w * h
+
+        ovr = inter / (areas[i] + areas[order[1:]] - inter).clamp(min=1e-9) # iou, 0 rather than NaN for degenerate bboxes
+        ids = (ovr <= threshold).nonzero().squeeze() # leave only over the threshold
+        if ids.numel() == 0:
+            break
+        order = order[ids + 1]
+    keep_dim = torch.LongTensor(keep)
+    return keep_dim
+
+
+def matrix_nms(bboxes, counts, threshold=0.35):
+    ''' Greedy NMS of several groups at once through their IoU matrices.
+    Args:
+        bboxes: (torch.tensors) bounding boxes sorted by group and then by descending score. size:(N, 4)
+        counts: (torch.tensors) number of bboxes of each group, in order. size:(G,)
+        threshold: (float) IoU over which a bbox is suppressed by a higher-scored one of its group.
+    Returns:
+        keep: (torch.tensors) whether each bbox is kept. size:(N,)
+    '''
+    N, G, K = bboxes.size(0), counts.numel(), int(counts.max())
+    gid = torch.arange(G, device=bboxes.device).repeat_interleave(counts) # group of each bbox
+    rank = torch.arange(N, device=bboxes.device) - (counts.cumsum(0) - counts)[gid] # position within its group
+    padded = bboxes.new_zeros((G, K, 4))
+    padded[gid, rank] = bboxes
+    valid = torch.zeros((G, K), dtype=torch.bool, device=bboxes.device)
+    valid[gid, rank] = True
+
+    # overlap[g, i, j]: bbox j would be suppressed by the higher-scored bbox i of group g.
+    overlap = torch.triu(compute_iou(padded, padded) > threshold, diagonal=1) # [G, K, K]
+    # A bbox is kept unless a kept bbox overlaps it. Starting from keeping all, every iteration settles
+    # at least the next bbox in score order, so this reaches the greedy result within K iterations.
+    keep = valid
+    while True:
+        new_keep = valid & ~(overlap & keep.unsqueeze(2)).any(1)
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep[gid, rank]
+
+
+def batched_nms(bboxes, scores, class_idxs=None, img_idxs=None, threshold=0.35, max_det=None, max_matrix=1 << 22):
+    ''' Non Max Suppression over all classes and images in one call.
+    Bboxes are grouped by (image, class) and padded, so that the IoU matrices of many groups are computed at once
+    by `matrix_nms`, in chunks of at most `max_matrix` entries. When a single group is too large for that, e.g. thousands
+    of bboxes of one class, each group is shifted to its own region of the coordinate space instead, so that bboxes of
+    different groups never overlap and a single greedy loop as in `NMS` handles all of them.
+    Args:
+        bboxes: (torch.tensors) list of bounding boxes. size:(N, 4) ((left_top_x, left_top_y, right_bottom_x, right_bottom_y), (...))
+        scores: (torch.tensors) list of confidence score. size:(N,)
+        class_idxs: (torch.tensors, optional) class index of each bbox. size:(N,)
+        img_idxs: (torch.tensors, optional) image index of each bbox in a batch. size:(N,)
+        threshold: (float) IoU over which a bbox is suppressed by a higher-scored one of its group.
+        max_det: (int, optional) maximum number of detections kept per image.
+        max_matrix: (int) maximum number of entries of the IoU matrices computed at once.
+    Returns:
+        keep: (torch.tensors) indices of the kept bboxes, ordered by image and then by descending score.
+    '''
+    N = bboxes.size(0)
+    device = bboxes.device
+    if N == 0:
+        return torch.zeros((0,), dtype=torch.long, device=device)
+    if class_idxs is None:
+        class_idxs = torch.zeros((N,), dtype=torch.long, device=device)
+    if img_idxs is None:
+        img_idxs = torch.zeros((N,), dtype=torch.long, device=device)
+    group = img_idxs * (int(class_idxs.max()) + 1) + class_idxs
+
+    # sort by group, then by descending score
+    order = scores.argsort(descending=True)
+    order = order[group[order].argsort(stable=True)]
+    _, counts = torch.unique_consecutive(group[order], return_counts=True)
+    K = int(counts.max())
+
+    if K * K <= max_matrix:
+        chunk = max_matrix // (K * K) # number of groups per chunk
+        ends = counts.cumsum(0).tolist()
+        keep = []
+        for c in range(0, counts.numel(), chunk):
+            start = ends[c-1] if c > 0 else 0
+            end = ends[min(c+chunk, counts.numel())-1]
+            keep.append(matrix_nms(bboxes[order[start:end]], counts[c:c+chunk], threshold))
+        keep = order[torch.cat(keep)]
+    else:
+        # shift each group by a multiple of the coordinate extent, in float64 so that IoU keeps its precision.
+        shifted = bboxes.double() - float(bboxes.min())
+        shifted = shifted + (group * (float(shifted.max()) + 1.)).unsqueeze(1)
+        order = scores.argsort(descending=True)
+        shifted = shifted[order]
+        keep = torch.zeros((N,), dtype=torch.bool, device=device)
+        remain = torch.arange(N, device=device)
+        while remain.numel() > 0:
+            i = remain[0]
+            keep[i] = True
+            ovr = compute_iou(shifted[i].unsqueeze(0), shifted[remain[1:]]).squeeze(0)
+            remain = remain[1:][ovr <= threshold]
+        keep = order[keep]
+
+    # order by image and then by descending score, and cap the detections of each image.
+    keep = keep[scores[keep].argsort(descending=True)]
+    keep = keep[img_idxs[keep].argsort(stable=True)]
+    if max_det is not None:
+        img = img_idxs[keep]
+        first = torch.searchsorted(img, img) # position of the first detection of the same image
+        keep = keep[torch.arange(keep.numel(), device=device) - first < max_det]
+    return keep
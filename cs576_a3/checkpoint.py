@@ -0,0 +1,152 @@
+import os
+import re
+import shutil
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def snapshot(state):
+    """ Copy of `state` with every tensor detached and copied to CPU, so that training can go on while it is written. """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def atomic_save(state, path):
+    """ torch.save into a temporary file which replaces `path` once complete, so `path` is never left half written. """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointManager(object):
+    """ Checkpoints written in a background thread, keeping the last `keep_last` ones plus the best one.
+
+    `save` snapshots the state to CPU and returns, while a single writer thread saves it as `<step>.pth`
+    in `ckpt_dir` with an atomic rename, hard-links it as `best.pth` when asked to (or copies it where hard
+    links are not supported), and deletes the checkpoints older than the last `keep_last`, except the one
+    best.pth is linked to. At most one write is in flight: a `save` waits for the previous write to complete
+    before taking its snapshot.
+
+    Tensors of `state['model']` which never change while training, e.g. the frozen backbone, can be listed
+    in `frozen`. They are then written once per run to `frozen.pth` and merged back on load, instead of
+    being rewritten in every checkpoint.
+
+    The directory is only created by the first write, so a manager can load from any directory.
+    Runs from before this manager saved a single `last.pth`, which `load_latest` falls back to.
+
+    Args:
+        ckpt_dir: (str) directory of the checkpoints.
+        keep_last: (int) number of the most recent checkpoints kept.
+        frozen: (iterable of str, optional) keys of state['model'] written only once.
+    """
+    def __init__(self, ckpt_dir, keep_last=3, frozen=None):
+        self.ckpt_dir = ckpt_dir or '.'
+        self.keep_last = keep_last
+        self.frozen = set(frozen or [])
+        self.frozen_written = False
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def path(self, name):
+        return os.path.join(self.ckpt_dir, name)
+
+    def steps(self):
+        """ Steps of the checkpoints in ckpt_dir, newest first. """
+        if not os.path.isdir(self.ckpt_dir):
+            return []
+        steps = [int(m.group(1)) for m in (re.match(r'^(\d+)\.pth$', name) for name in os.listdir(self.ckpt_dir)) if m]
+        return sorted(steps, reverse=True)
+
+    def save(self, state, step, is_best=False):
+        """ Write `state` as the checkpoint of `step` in the background.
+
+        Args:
+            state: (dict) e.g. {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch}.
+            step: (int) epoch or iteration of the checkpoint, which orders the checkpoints.
+            is_best: (bool) also keep it as best.pth.
+        """
+        self.wait()
+        state = dict(state)
+        frozen = None
+        if self.frozen:
+            model = dict(state['model'])
+            frozen = {k: model.pop(k) for k in self.frozen if k in model}
+            state['model'] = model
+            if self.frozen_written:
+                frozen = None
+        state = snapshot(state)
+        frozen = snapshot(frozen)
+        self.pending = self.executor.submit(self.write, state, frozen, step, is_best)
+
+    def write(self, state, frozen, step, is_best):
+        os.makedirs(self.ckpt_dir, exist_ok=True)
+        if frozen is not None:
+            atomic_save(frozen, self.path('frozen.pth'))
+            self.frozen_written = True
+        path = self.path('%d.pth' % step)
+        atomic_save(state, path)
+        if is_best:
+            self.link_best(path)
+        best = self.path('best.pth')
+        for old in self.steps()[self.keep_last:]:
+            old = self.path('%d.pth' % old)
+            if os.path.exists(best) and os.path.samefile(old, best):
+                continue
+            os.remove(old)
+
+    def link_best(self, path):
+        """ Make best.pth a hard link to `path`, or a copy of it when the filesystem has no hard links. """
+        tmp = self.path('best.pth.%d.tmp' % os.getpid())
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(path, tmp)
+        except OSError: # e.g. FAT, some network filesystems, or a cross-device ckpt_dir
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, self.path('best.pth'))
+
+    def wait(self):
+        """ Block until the pending write is complete, raising its error if any. """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def load(self, path, map_location=None):
+        """ Load the checkpoint at `path`, merging the frozen tensors back into state['model'] when they were split off. """
+        state = torch.load(path, map_location=map_location)
+        frozen_path = self.path('frozen.pth')
+        if isinstance(state, dict) and 'model' in state and os.path.exists(frozen_path):
+            model = torch.load(frozen_path, map_location=map_location)
+            model.update(state['model'])
+            state['model'] = model
+        return state
+
+    def load_latest(self, map_location=None):
+        """ Load the newest checkpoint which can be read, skipping corrupted ones.
+
+        Returns:
+            (dict) state, or None if there is no valid checkpoint.
+        """
+        for step in self.steps():
+            try:
+                return self.load(self.path('%d.pth' % step), map_location)
+            except (EOFError, RuntimeError, pickle.UnpicklingError) as e:
+                print('Skipping unreadable checkpoint %d.pth: %s' % (step, e))
+        if os.path.exists(self.path('last.pth')):
+            print('No <step>.pth checkpoint, loading last.pth of an older run.')
+            return self.load(self.path('last.pth'), map_location)
+        return None
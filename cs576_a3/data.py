@@ -8,36 +8,156 @@ from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 
 
+class RaggedArray(object):
+    """ Read-only ragged array memory-mapped from .npy files, where item i is data[offsets[i]:offsets[i+1]].
+    Pickling keeps only the paths, so that every DataLoader worker maps the same files instead of copying them.
+    """
+    def __init__(self, data_path, offsets_path):
+        self.data_path = data_path
+        self.offsets_path = offsets_path
+        self.load()
+
+    def load(self):
+        self.data = np.load(self.data_path, mmap_mode='r')
+        self.offsets = np.load(self.offsets_path, mmap_mode='r')
+
+    def __getstate__(self):
+        return {'data_path': self.data_path, 'offsets_path': self.offsets_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.data[self.offsets[idx]:self.offsets[idx+1]]))
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+
+def encode_targets(boxes, labels, grid_size=7, num_boxes=2, num_classes=20):
+    """ Encode the ground truths of a batch into Yolo v1 targets at once.
+    When several boxes fall into the same cell, the last one gives the coordinates and all of them set their class.
+
+    Args:
+        boxes: (Tensor) [x1, y1, x2, y2] normalized in image-size, sized [N, K, 4].
+        labels: (Tensor) class labels starting from 1, sized [N, K]. 0 marks padding.
+        grid_size: (int) S, number of cells along each side of the image.
+        num_boxes: (int) B, number of bboxes per each cell.
+        num_classes: (int) C, number of the object classes.
+    Returns:
+        (Tensor) targets, sized [N, S, S, Bx5+C], 5=len([x, y, w, h, conf]).
+    """
+    S, B, C = grid_size, num_boxes, num_classes
+    N, K = labels.shape
+    target = torch.zeros((N*S*S, B*5+C))
+    cell_size = 1./S
+    valid = labels > 0 # [N, K]
+
+    wh = boxes[..., 2:]-boxes[..., :2] # 실제 이미지 크기 기준, [N, K, 2]
+    cxcy = (boxes[..., 2:]+boxes[..., :2])/2 # [cx, cy]
+    ij = ((cxcy/cell_size).ceil()-1).clamp(0, S-1) # grid cell의 indices in target.size()
+    xy = ij*cell_size # 실제 이미지 상에서의 각 cell의 left-top 위치
+    delta_xy = (cxcy-xy)/cell_size # cell 하나의 크기에 대한 상대 위치
+    cell = (torch.arange(N).unsqueeze(1)*S + ij[..., 1].long())*S + ij[..., 0].long() # flattened cell index, [N, K]
+
+    # a box is overwritten when a later box of the same image falls into the same cell.
+    same_cell = (cell.unsqueeze(2) == cell.unsqueeze(1)) & valid.unsqueeze(1) # [N, K, K]
+    last = valid & ~torch.triu(same_cell, diagonal=1).any(-1) # [N, K]
+
+    bbox = torch.cat([delta_xy, wh, torch.ones_like(wh[..., :1])], dim=-1).repeat(1, 1, B) # [N, K, Bx5]
+    target[cell[last], :B*5] = bbox[last]
+    target[cell[valid], B*5+labels[valid]-1] = 1
+    return target.view(N, S, S, B*5+C)
+
+
+class DetectionCollate(object):
+    """ collate_fn for VOCDetection(..., encode=False) which encodes the targets of the whole batch at once,
+    so that workers ship only the compact ground truths and encoding leaves the per-sample path.
+    The ground truths are padded to boxes [N, K, 4] and labels [N, K], with label 0 for padding.
+
+    Args:
+        grid_size, num_boxes, num_classes: (int) S, B, C as in encode_targets.
+        encode: (bool) return (images, targets). If False, return (images, boxes, labels). (default: True)
+        return_boxes: (bool) also return the padded boxes and labels after the targets. (default: False)
+    """
+    def __init__(self, grid_size=7, num_boxes=2, num_classes=20, encode=True, return_boxes=False):
+        self.S = grid_size
+        self.B = num_boxes
+        self.C = num_classes
+        self.encode = encode
+        self.return_boxes = return_boxes
+
+    def __call__(self, batch):
+        imgs, boxes, labels = zip(*batch)
+        K = max([1] + [len(label) for label in labels])
+        padded_boxes = torch.zeros((len(batch), K, 4))
+        padded_labels = torch.zeros((len(batch), K), dtype=torch.long)
+        for i, (box, label) in enumerate(zip(boxes, labels)):
+            padded_boxes[i, :len(label)] = box
+            padded_labels[i, :len(label)] = label
+        imgs = torch.stack(imgs)
+        if not self.encode:
+            return imgs, padded_boxes, padded_labels
+        targets = encode_targets(padded_boxes, padded_labels, self.S, self.B, self.C)
+        if self.return_boxes:
+            return imgs, targets, padded_boxes, padded_labels
+        return imgs, targets
+
+
 class VOCDetection(Dataset):
-    def __init__(self, root, split='train', image_size=224):
+    def __init__(self, root, split='train', image_size=224, image_cache=None,
+                 grid_size=None, num_boxes=2, num_classes=20, encode=True, batch_augment=False, shards=None):
         assert image_size == 224, 'Currently, only image of 448 is supported'
 
         self.root = root
         self.split = split
         self.image_size = image_size
+        self.image_cache = image_cache # (DecodedImageCache, optional) cache of decoded images shared by workers.
+        self.shards = shards # (ShardReader, optional) shards packed by shards.py, read instead of root/images.
+        self.S = grid_size or image_size // 32 # VGG16 reduces the image by 32.
+        self.B = num_boxes
+        self.C = num_classes
+        self.encode = encode # if False, return the ground truths to be encoded by DetectionCollate instead of the target.
+        self.batch_augment = batch_augment # if True, only decode and resize, and return uint8 RGB images to be augmented by BatchAugment.
         self.fnames, self.boxes, self.labels = self.parse_labels()
 
     def parse_labels(self):
         label_file_path = os.path.join(self.root, 'labels/%s.txt' % (self.split))
+        prefix = os.path.join(self.root, 'labels', self.split)
+        packed = [prefix + ext for ext in ('.fnames.npy', '.boxes.npy', '.labels.npy', '.offsets.npy')]
+        if not all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(label_file_path) for path in packed):
+            self.pack_labels(label_file_path, packed)
+        fnames = np.load(packed[0])
+        boxes = RaggedArray(packed[1], packed[3])
+        labels = RaggedArray(packed[2], packed[3])
+        return fnames, boxes, labels
+
+    def pack_labels(self, label_file_path, packed):
+        # Compile the label text into one flat float32 box array, one int64 label array and the offsets of each image,
+        # so that every DataLoader worker can memory-map them instead of holding its own copy of per-image tensors.
         with open(label_file_path) as f:
-            fnames, boxes, labels = [], [], []
-            for line in f.readlines():
+            fnames, boxes, labels, offsets = [], [], [], [0]
+            for line in f:
                 splited = line.strip().split()
+                if not splited:
+                    continue
                 fnames.append(splited[0])
                 num_boxes = (len(splited)-1)//5
-                box = []
-                label = []
-                for i in range(num_boxes):
-                    x = float(splited[1+5*i])
-                    y = float(splited[2+5*i])
-                    x2 = float(splited[3+5*i])
-                    y2 = float(splited[4+5*i])
-                    c = splited[5+5*i]
-                    box.append([x, y, x2, y2])
-                    label.append(int(c)+1)
-                boxes.append(torch.Tensor(box))
-                labels.append(torch.LongTensor(label))
-        return fnames, boxes, labels
+                values = np.array(splited[1:1+5*num_boxes], dtype=np.float64).reshape(-1, 5)
+                boxes.append(values[:, :4].astype(np.float32))
+                labels.append(values[:, 4].astype(np.int64)+1)
+                offsets.append(offsets[-1]+num_boxes)
+        arrays = [np.array(fnames),
+                  np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32),
+                  np.concatenate(labels) if labels else np.zeros((0,), dtype=np.int64),
+                  np.array(offsets, dtype=np.int64)]
+        # every process writes its own temporary file, so that concurrent builds never interleave in one.
+        for path, array in zip(packed, arrays):
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp, path)
 
     def transform(self, img):
         transform = transforms.Compose([
@@ -48,17 +168,15 @@ class VOCDetection(Dataset):
 
     def __getitem__(self,idx):
         fname = self.fnames[idx]
-        img = cv2.imread(os.path.join(self.root, 'images', fname))
-        boxes = self.boxes[idx].clone()
-        labels = self.labels[idx].clone()
+        img = self.read_image(fname)
+        boxes = self.boxes[idx]
+        labels = self.labels[idx]
 
-        if self.split == 'train':
+        if self.split == 'train' and not self.batch_augment:
             img, boxes = self.random_flip(img, boxes)
             img,boxes = self.randomScale(img,boxes)
             img = self.randomBlur(img)
-            img = self.RandomBrightness(img)
-            img = self.RandomHue(img)
-            img = self.RandomSaturation(img)
+            img = self.RandomColorJitter(img)
             img,boxes,labels = self.randomShift(img,boxes,labels)
             img,boxes,labels = self.randomCrop(img,boxes,labels)
 
@@ -66,33 +184,31 @@ class VOCDetection(Dataset):
         boxes /= torch.Tensor([w,h,w,h]).expand_as(boxes)
         img = self.BGR2RGB(img) 
         img = cv2.resize(img,(self.image_size,self.image_size))
+        if self.batch_augment:
+            img = torch.from_numpy(img).permute(2,0,1).contiguous() # [3, H, W], uint8
+        else:
+            img = self.transform(img)
+        if not self.encode:
+            return img,boxes,labels
         target = self.encoder(boxes,labels)
-        img = self.transform(img)
         return img,target
 
     def __len__(self):
         return len(self.boxes)
 
+    def shard_key(self, idx):
+        return str(self.fnames[idx])
+
+    def read_image(self, fname):
+        if self.shards is not None:
+            return cv2.imdecode(np.frombuffer(self.shards.read(fname), dtype=np.uint8), cv2.IMREAD_COLOR)
+        path = os.path.join(self.root, 'images', fname)
+        if self.image_cache is None:
+            return cv2.imread(path)
+        return self.image_cache.get(path, lambda: cv2.imread(path), dataset='VOCDetection:bgr')
+
     def encoder(self,boxes,labels): # boxes => [x1, y1, x2, y2]
-        grid_num = int(self.image_size / 32) 
-        target = torch.zeros((grid_num,grid_num,30))
-        cell_size = 1./grid_num
-        wh = boxes[:,2:]-boxes[:,:2] # 실제 이미지 크기 기준
-        cxcy = (boxes[:,2:]+boxes[:,:2])/2 # [cx, cy]
-        for i in range(cxcy.size()[0]):
-            cxcy_sample = cxcy[i]
-            ij = (cxcy_sample/cell_size).ceil()-1  # grid cell의 indices in target.size()
-            target[int(ij[1]),int(ij[0]),4] = 1
-            target[int(ij[1]),int(ij[0]),9] = 1
-            target[int(ij[1]),int(ij[0]),int(labels[i])+9] = 1
-            xy = ij*cell_size # 실제 이미지 상에서의 각 cell의 left-top 위치
-            # cell 하나의 크기에 대한 상대 위치 : ( (실제 이미지에서의 box 중심) - (실제 이미지에서의 해당 셀의 left-top 위치) ) / cell_size
-            delta_xy = (cxcy_sample -xy)/cell_size 
-            target[int(ij[1]),int(ij[0]),2:4] = wh[i]
-            target[int(ij[1]),int(ij[0]),:2] = delta_xy
-            target[int(ij[1]),int(ij[0]),7:9] = wh[i]
-            target[int(ij[1]),int(ij[0]),5:7] = delta_xy
-        return target
+        return encode_targets(boxes.unsqueeze(0), labels.unsqueeze(0), self.S, self.B, self.C)[0]
 
     def BGR2RGB(self,img):
         return cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
@@ -136,6 +252,20 @@ class VOCDetection(Dataset):
             bgr = self.HSV2BGR(hsv)
         return bgr
 
+    def RandomColorJitter(self,bgr):
+        # Fused RandomBrightness, RandomHue and RandomSaturation.
+        # Draw all factors first, then convert to HSV only once and scale every channel with a uint8 lookup table.
+        adjust = [1.,1.,1.] # h, s, v
+        for channel in (2,0,1): # same order of random draws as brightness(v), hue(h), saturation(s)
+            if random.random() < 0.5:
+                adjust[channel] = random.choice([0.5,1.5])
+        if adjust == [1.,1.,1.]:
+            return bgr
+        hsv = self.BGR2HSV(bgr)
+        lut = np.clip(np.arange(256)[:,None]*adjust, 0, 255).astype(np.uint8) # [256, 3]
+        cv2.LUT(hsv, lut.reshape(1,256,3), dst=hsv)
+        return self.HSV2BGR(hsv)
+
     def randomBlur(self,bgr):
         if random.random()<0.5:
             bgr = cv2.blur(bgr,(5,5))
@@ -0,0 +1,75 @@
+""" Export of trained models for CPU inference: channels-last, fused and frozen with TorchScript. """
+import copy
+
+import torch
+import torch.nn as nn
+from torch.fx.experimental.optimization import fuse
+
+
+def fold_batchnorm(model):
+    """ Fold every BatchNorm2d which directly follows a Conv2d into the weights of the conv.
+    Models without BatchNorm2d, e.g. Yolo, are returned as they are.
+
+    Args:
+        model: (nn.Module) model in eval mode, which torch.fx can trace.
+    Returns:
+        (nn.Module) model computing the same outputs without the folded BatchNorm2d.
+    """
+    if not any(isinstance(m, nn.BatchNorm2d) for m in model.modules()):
+        return model
+    return fuse(model)
+
+
+def check_outputs(reference, exported, x, rtol=1e-4, atol=1e-4):
+    """ Compare the outputs of `exported` against `reference` on `x`.
+
+    Returns:
+        (float) maximum absolute difference of the outputs.
+    Raises:
+        ValueError: when the outputs are not close.
+    """
+    with torch.no_grad():
+        expected = reference(x)
+        output = exported(x)
+    diff = (expected - output).abs().max().item()
+    if not torch.allclose(expected, output, rtol=rtol, atol=atol):
+        raise ValueError('exported model differs from the eager one, max abs diff: %g' % diff)
+    return diff
+
+
+def export(model, example, path=None, channels_last=True, rtol=1e-4, atol=1e-4):
+    """ Optimize `model` for CPU inference.
+
+    The model is copied in eval mode, BatchNorm2d is folded into the preceding convs, and the weights are
+    converted to channels-last. It is then traced and frozen with TorchScript, whose inference passes run
+    the chain of Conv2d+ReLU (and pooling) on oneDNN tensors with prepacked weights, converting the layout
+    once at its ends instead of around every conv. The outputs are checked against the eager model on
+    `example` before it is returned.
+
+    Args:
+        model: (nn.Module) trained model, e.g. Yolo or MyNetwork.
+        example: (Tensor) example input, e.g. sized [N, 3, 224, 224] for Yolo.
+        path: (str, optional) where the frozen module is saved, to be loaded by `load`.
+        channels_last: (bool) run the convs in channels-last memory format.
+        rtol, atol: (float) tolerances of the check against the eager model.
+    Returns:
+        (torch.jit.ScriptModule) exported model. It takes inputs in either memory format.
+    """
+    reference = copy.deepcopy(model).eval()
+    model = fold_batchnorm(copy.deepcopy(reference))
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        example = example.contiguous(memory_format=torch.channels_last)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(model, example))
+    if path is not None:
+        # oneDNN weights cannot be serialized, so the module is saved before the inference passes.
+        frozen.save(path)
+    exported = torch.jit.optimize_for_inference(frozen)
+    check_outputs(reference, exported, example, rtol, atol)
+    return exported
+
+
+def load(path):
+    """ Load a model saved by `export`, on CPU. """
+    return torch.jit.optimize_for_inference(torch.jit.load(path, map_location='cpu'))
@@ -0,0 +1,157 @@
+import os
+import json
+import random
+import shutil
+import hashlib
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+
+from data import DetectionCollate
+from loader import make_loader
+
+
+def backbone_hash(backbone):
+    """ sha1 digest of the backbone weights, used to invalidate cached features.
+
+    Args:
+        backbone: (nn.Module) frozen backbone network, e.g. `model.features`.
+    Returns:
+        (str) hex digest.
+    """
+    sha = hashlib.sha1()
+    for name, tensor in backbone.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+class SeededView(Dataset):
+    """ View of a dataset which repeats it `num_views` times, seeding `random` per (image, view) pair
+    so that the random augmentation of VOCDetection is deterministic. The state of `random` is restored
+    after every item, so the code running after it in the process is not affected.
+    """
+    def __init__(self, dset, num_views=1, seed=0):
+        self.dset = dset
+        self.num_views = num_views
+        self.seed = seed
+
+    def __getitem__(self, idx):
+        state = random.getstate()
+        random.seed(self.seed * 1000003 + idx)
+        try:
+            return self.dset[idx % len(self.dset)]
+        finally:
+            random.setstate(state)
+
+    def __len__(self):
+        return len(self.dset) * self.num_views
+
+
+class FeatureCache(Dataset):
+    """ Backbone features of VOCDetection computed once and memory-mapped from disk.
+
+    The backbone runs once per (image, view) pair and its outputs (512x7x7 for VGG16) are stored
+    in `<cache_root>/<split>_<image_size>_<key>/features.npy` along with the encoded targets.
+    The key hashes the backbone weights, split, image_size, num_views and seed, so the cache is
+    rebuilt whenever one of them changes. A rebuild deletes the caches of the same split, image_size,
+    num_views and seed built from another backbone, as recorded in their meta.json, so that outdated
+    feature dumps do not pile up while caches of other configurations are kept. Each item returns one
+    of the cached views of its image at random, so only `model.detector` has to run while training.
+
+    Args:
+        dset: (VOCDetection) dataset to cache.
+        backbone: (nn.Module) frozen backbone network, e.g. `model.features`.
+        cache_root: (str) directory under which caches are stored.
+        num_views: (int) number of deterministic augmentations cached per image.
+            Only the train split is augmented, so the other splits always use 1.
+        seed: (int) base seed of the cached augmentations.
+        device: (str) device on which the backbone runs while building the cache.
+        batch_size: (int) batch size while building the cache.
+        num_workers: (int) number of DataLoader workers while building the cache, e.g. those of the image loader.
+    """
+    def __init__(self, dset, backbone, cache_root='feature_cache', num_views=1, seed=0,
+                 device='cpu', batch_size=64, num_workers=0):
+        self.num_images = len(dset)
+        self.num_views = num_views if dset.split == 'train' else 1
+
+        self.meta = {'backbone': backbone_hash(backbone), 'split': dset.split, 'image_size': dset.image_size,
+                     'num_views': self.num_views, 'seed': seed}
+        key = '%s:%s:%d:%d:%d' % (self.meta['backbone'], dset.split, dset.image_size, self.num_views, seed)
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_root, '%s_%d_%s' % (dset.split, dset.image_size, digest))
+        if not os.path.exists(os.path.join(self.cache_dir, 'meta.json')):
+            self.build(SeededView(dset, self.num_views, seed), backbone, device, batch_size, num_workers)
+
+        # opened lazily, so that every DataLoader worker maps the files by itself.
+        self.features = None
+        self.targets = None
+
+    def build(self, view, backbone, device, batch_size, num_workers):
+        """ Run the backbone over every (image, view) pair and write the outputs to the cache.
+        Files are written into a temporary directory which is renamed once complete.
+        """
+        tmp_dir = self.cache_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        dset = view.dset
+        collate_fn = None if dset.encode else DetectionCollate(dset.S, dset.B, dset.C)
+        loader = make_loader(view, num_workers, batch_size=batch_size, shuffle=False, drop_last=False, collate_fn=collate_fn)
+        features, targets = None, None
+        training = backbone.training
+        backbone.eval()
+        with torch.no_grad():
+            start = 0
+            for x, y in loader:
+                feat = backbone(x.to(device)).cpu().numpy()
+                if features is None:
+                    features = np.lib.format.open_memmap(os.path.join(tmp_dir, 'features.npy'), mode='w+',
+                                                         dtype=np.float32, shape=(len(view),) + feat.shape[1:])
+                    targets = np.lib.format.open_memmap(os.path.join(tmp_dir, 'targets.npy'), mode='w+',
+                                                        dtype=np.float32, shape=(len(view),) + tuple(y.shape[1:]))
+                features[start:start+len(feat)] = feat
+                targets[start:start+len(feat)] = y.numpy()
+                start += len(feat)
+        backbone.train(training)
+        features.flush()
+        targets.flush()
+        del features, targets
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(dict(self.meta, num_images=self.num_images), f)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.rename(tmp_dir, self.cache_dir)
+        self.remove_stale()
+
+    def remove_stale(self):
+        """ Delete the complete caches whose meta.json differs from this one only by the backbone hash.
+        Caches of other configurations, without a readable meta.json, or still being built are left alone. """
+        cache_root, name = os.path.split(self.cache_dir)
+        cache_root = cache_root or '.'
+        for other in os.listdir(cache_root):
+            meta_path = os.path.join(cache_root, other, 'meta.json')
+            if other == name or not os.path.exists(meta_path):
+                continue
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            same_config = all(meta.get(k) == v for k, v in self.meta.items() if k != 'backbone')
+            if same_config and meta.get('backbone') not in (None, self.meta['backbone']):
+                print('Removing the feature cache of a previous backbone', os.path.join(cache_root, other))
+                shutil.rmtree(os.path.join(cache_root, other), ignore_errors=True)
+
+    def __getitem__(self, idx):
+        if self.features is None:
+            self.features = np.load(os.path.join(self.cache_dir, 'features.npy'), mmap_mode='r')
+            self.targets = np.load(os.path.join(self.cache_dir, 'targets.npy'), mmap_mode='r')
+        row = random.randrange(self.num_views) * self.num_images + idx
+        feature = torch.from_numpy(np.array(self.features[row]))
+        target = torch.from_numpy(np.array(self.targets[row]))
+        return feature, target
+
+    def __len__(self):
+        return self.num_images
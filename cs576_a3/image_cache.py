@@ -0,0 +1,133 @@
+import os
+import atexit
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import multiprocessing as mp
+
+
+class DecodedImageCache(object):
+    """ Cache of decoded images shared by all DataLoader workers.
+
+    Every entry is a .npy file in `cache_dir`, which lives in shared memory (/dev/shm) when available,
+    so a decoded image written by one worker is read back by the others without decoding it again.
+    When the entries exceed `max_bytes`, the least recently used ones are evicted until the cache is
+    back under 90% of the budget. Byte usage and the hit/miss/eviction counters are kept in shared
+    values, so the cache has to be created before the DataLoader forks its workers.
+
+    Only decoding is cached: callers run their augmentation on the returned image, so randomness is unaffected.
+
+    By default the entries go to a new directory of this run, which `close` deletes. It is also registered
+    with atexit in the creating process, so that shared memory is freed even when the owner does not close it.
+
+    Args:
+        max_bytes: (int) byte budget of the cached images.
+        cache_dir: (str, optional) directory of the entries, kept by `close`. (default: a new <shm or tmp>/image_cache_*)
+    """
+    def __init__(self, max_bytes, cache_dir=None):
+        self.owns_dir = cache_dir is None
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None, prefix='image_cache_')
+        elif not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.owner_pid = os.getpid()
+        atexit.register(self.close)
+
+        self.lock = mp.Lock()
+        self.num_bytes = mp.Value('q', sum(size for _, size, _ in self.entries()))
+        self.hits = mp.Value('q', 0)
+        self.misses = mp.Value('q', 0)
+        self.evictions = mp.Value('q', 0)
+
+    def get(self, path, decode, dataset=''):
+        """ Return the decoded image of `path`, calling `decode()` and caching its output on a miss.
+
+        Args:
+            path: (str) path of the encoded image. Its size and mtime are part of the key.
+            decode: (callable) returns the decoded image as np.ndarray.
+            dataset: (str) identifier of the dataset and its decoding, part of the key, so that datasets
+                sharing the cache never read each other's entries.
+        Returns:
+            (np.ndarray) decoded image.
+        """
+        stat = os.stat(path)
+        key = '%s:%s:%d:%d' % (dataset, os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        entry = os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+        try:
+            image = np.load(entry)
+        except (OSError, ValueError): # not cached, evicted or being replaced
+            image = None
+        if image is not None:
+            try:
+                os.utime(entry) # mark as recently used
+            except OSError:
+                pass
+            self.count(self.hits)
+            return image
+
+        image = decode()
+        self.count(self.misses)
+        if image is not None and image.nbytes <= self.max_bytes:
+            self.put(entry, image)
+        return image
+
+    def put(self, entry, image):
+        tmp = '%s.%d.tmp' % (entry, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, image)
+            os.replace(tmp, entry)
+        except OSError: # the cache was closed, or shared memory is full
+            return
+        with self.lock:
+            self.num_bytes.value += os.path.getsize(entry)
+            if self.num_bytes.value > self.max_bytes:
+                self.evict(int(self.max_bytes * 0.9))
+
+    def evict(self, target_bytes):
+        # Least recently used entries go first. The byte usage is recounted from the directory,
+        # which also corrects the double counting of entries written concurrently by two workers.
+        entries = sorted(self.entries())
+        num_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if num_bytes <= target_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                continue
+            num_bytes -= size
+            self.count(self.evictions)
+        self.num_bytes.value = num_bytes
+
+    def entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+        return entries
+
+    def count(self, counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def stats(self):
+        return {'hits': self.hits.value, 'misses': self.misses.value,
+                'evictions': self.evictions.value, 'bytes': self.num_bytes.value}
+
+    def close(self):
+        """ Delete the directory of the entries if this cache created it. Only the creating process does so,
+        so DataLoader workers exiting never remove it under the others. """
+        if self.owns_dir and os.getpid() == self.owner_pid:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
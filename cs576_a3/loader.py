@@ -0,0 +1,165 @@
+""" DataLoader factory shared by the assignments: persistent, seeded workers, and opt-in auto-tuned parallelism. """
+import os
+import json
+import time
+import random
+import platform
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def seed_worker(worker_id):
+    """ worker_init_fn seeding `random` and numpy from the torch seed of the worker, which differs across workers
+    and follows the seed of the DataLoader's generator, so the augmentations of VOCDetection are reproducible. """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def build_loader(dataset, num_workers, prefetch_factor=2, seed=0, pin_memory=None, **kwargs):
+    """ DataLoader with `num_workers` persistent workers, seeded from `seed`, pinning memory when a GPU exists. """
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=prefetch_factor, persistent_workers=True, worker_init_fn=seed_worker)
+    return DataLoader(dataset, num_workers=num_workers, pin_memory=pin_memory,
+                      generator=torch.Generator().manual_seed(seed), **kwargs)
+
+
+def throughput(loader, num_batches):
+    """ Batches per second over the first `num_batches` batches of `loader`, after the first one. """
+    iterator = iter(loader)
+    next(iterator, None) # the first batch waits for the workers to start.
+    start = time.perf_counter()
+    count = 0
+    for _ in range(num_batches):
+        if next(iterator, None) is None:
+            break
+        count += 1
+    elapsed = time.perf_counter() - start
+    del iterator
+    return count / elapsed if elapsed > 0 else float('inf')
+
+
+def autotune(dataset, num_batches=20, max_workers=None, prefetch_factors=(2, 4, 8), min_gain=0.05, **kwargs):
+    """ Find the number of workers and the prefetch depth which load `dataset` the fastest.
+
+    The number of workers doubles from 0 up to the number of CPUs, as long as it improves the throughput over
+    the first `num_batches` batches by more than `min_gain`. Then the prefetch depth of the best one is tuned
+    the same way. Every trial starts its own workers, so this costs a few times num_batches batches.
+
+    Args:
+        dataset: (Dataset) dataset to load.
+        num_batches: (int) number of batches measured per trial.
+        max_workers: (int, optional) maximum number of workers. (default: the number of CPUs)
+        prefetch_factors: (tuple) prefetch depths tried, in increasing order.
+        min_gain: (float) relative throughput gain under which a larger setting is not worth it.
+        kwargs: arguments of the DataLoader, e.g. batch_size, shuffle, collate_fn.
+    Returns:
+        (int, int) num_workers, prefetch_factor.
+    """
+    max_workers = cpu_count() if max_workers is None else max_workers
+    candidates = [0] + [2**i for i in range(max_workers.bit_length()) if 2**i <= max_workers]
+    measure = lambda num_workers, prefetch_factor: throughput(build_loader(dataset, num_workers, prefetch_factor, **kwargs), num_batches)
+
+    best_workers, best = 0, measure(0, prefetch_factors[0])
+    print('loader autotune: %2d workers: %8.1f batches/s' % (0, best))
+    for num_workers in candidates[1:]:
+        speed = measure(num_workers, prefetch_factors[0])
+        print('loader autotune: %2d workers: %8.1f batches/s' % (num_workers, speed))
+        if speed < best * (1 + min_gain):
+            break
+        best_workers, best = num_workers, speed
+
+    best_prefetch = prefetch_factors[0]
+    if best_workers > 0:
+        for prefetch_factor in prefetch_factors[1:]:
+            speed = measure(best_workers, prefetch_factor)
+            print('loader autotune: %2d workers, prefetch %d: %8.1f batches/s' % (best_workers, prefetch_factor, speed))
+            if speed < best * (1 + min_gain):
+                break
+            best_prefetch, best = prefetch_factor, speed
+    print('loader autotune: %d workers, prefetch %d' % (best_workers, best_prefetch))
+    return best_workers, best_prefetch
+
+
+def tune_key(dataset, batch_size, prefetch_factor):
+    """ Key of the tuned settings of `dataset` on this machine. """
+    return '%s:%d cpus:%s:%d items:batch %s:prefetch %s' % (platform.node(), cpu_count(), type(dataset).__name__,
+                                                             len(dataset), batch_size, prefetch_factor)
+
+
+def read_tuned(tune_cache, key):
+    """ (num_workers, prefetch_factor) tuned before under `key` in the json file `tune_cache`, or None. """
+    try:
+        with open(tune_cache) as f:
+            tuned = json.load(f)[key]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return tuned['num_workers'], tuned['prefetch_factor']
+
+
+def write_tuned(tune_cache, key, num_workers, prefetch_factor):
+    try:
+        with open(tune_cache) as f:
+            tuned = json.load(f)
+    except (OSError, ValueError):
+        tuned = {}
+    tuned[key] = {'num_workers': num_workers, 'prefetch_factor': prefetch_factor}
+    tmp = '%s.%d.tmp' % (tune_cache, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(tuned, f, indent=1, sort_keys=True)
+        os.replace(tmp, tune_cache)
+    except OSError: # e.g. a read-only dataset, which is tuned again next time.
+        pass
+
+
+def make_loader(dataset, num_workers=0, prefetch_factor='auto', seed=0, pin_memory=None, autotune_batches=20, tune_cache=None,
+                **kwargs):
+    """ Build a DataLoader whose workers persist across epochs, are seeded deterministically, and pin memory on GPU.
+
+    Autotuning is opt-in through num_workers='auto'. Its result is kept in the json file `tune_cache`, e.g. next to
+    the data, keyed by the machine, the dataset and the batch size, so that later runs skip the measurements.
+
+    Args:
+        dataset: (Dataset) dataset to load.
+        num_workers: (int or 'auto') number of worker processes, or 'auto' to measure the best one with `autotune`.
+        prefetch_factor: (int or 'auto') batches prefetched by every worker, or 'auto' to tune it along.
+        seed: (int) seed of the sampling order and of the workers.
+        pin_memory: (bool, optional) copy batches into pinned memory. (default: whether a GPU exists)
+        autotune_batches: (int) number of batches measured per setting by the autotuning.
+        tune_cache: (str, optional) json file of the tuned settings. (default: tune on every call)
+        kwargs: arguments of the DataLoader, e.g. batch_size, shuffle, drop_last, collate_fn, sampler.
+    Returns:
+        (DataLoader) loader. The chosen settings are its `num_workers` and `prefetch_factor`.
+    """
+    if num_workers == 'auto':
+        key = tune_key(dataset, kwargs.get('batch_size', 1), prefetch_factor)
+        tuned = read_tuned(tune_cache, key) if tune_cache is not None else None
+        if tuned is not None:
+            num_workers, prefetch_factor = tuned
+            print('loader autotune: %d workers, prefetch %d (cached in %s)' % (num_workers, prefetch_factor, tune_cache))
+        else:
+            prefetch_factors = (2, 4, 8) if prefetch_factor == 'auto' else (prefetch_factor,)
+            num_workers, prefetch_factor = autotune(dataset, autotune_batches, prefetch_factors=prefetch_factors, seed=seed,
+                                                    pin_memory=pin_memory, **kwargs)
+            if tune_cache is not None:
+                write_tuned(tune_cache, key, num_workers, prefetch_factor)
+    elif prefetch_factor == 'auto':
+        prefetch_factor = 2
+    return build_loader(dataset, num_workers, prefetch_factor, seed, pin_memory, **kwargs)
+
+
+def loader_settings(loader):
+    """ num_workers and prefetch_factor of `loader`, to build more loaders alike without tuning them again. """
+    return {'num_workers': loader.num_workers, 'prefetch_factor': loader.prefetch_factor or 2}
@@ -0,0 +1,97 @@
+import sys
+import time
+import resource
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB, since it started. DataLoader workers are not counted. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10 # bytes on macOS, KB on Linux
+
+
+class MetricLogger(object):
+    """ Training metrics averaged over logging intervals, without syncing the device in the training loop.
+
+    Metrics are summed as detached tensors on their device, and only every `log_freq` steps the sums are
+    handed over to a background thread, which converts them to python floats and writes them to
+    TensorBoard. The loop itself never calls `.item()`, so on GPU it never waits for the kernels queued.
+
+    Every interval also logs the throughput in samples/sec, the peak RSS of the process in MB, and how the
+    wall time of a step splits into waiting on the DataLoader (from the end of the previous step until
+    `data_ready`) and the rest (until `update`). On GPU the latter is the time to queue the work rather than
+    to run it, unless the step syncs by itself.
+
+    Args:
+        writer: (SummaryWriter, optional) where metrics are written. Nothing is logged if None.
+        log_freq: (int) number of steps per interval.
+        prefix: (str) prefix of the tags of the timing metrics, e.g. 'train/'.
+    """
+    def __init__(self, writer, log_freq, prefix=''):
+        self.writer = writer
+        self.log_freq = log_freq
+        self.prefix = prefix
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+        self.num_samples = 0
+        self.data_time = 0.
+        self.compute_time = 0.
+        self.interval_start = self.last = time.perf_counter()
+
+    def data_ready(self):
+        """ Mark the arrival of a batch from the DataLoader. """
+        now = time.perf_counter()
+        self.data_time += now - self.last
+        self.last = now
+
+    def update(self, step, num_samples, metrics=None):
+        """ Mark the end of a training step and accumulate its metrics.
+
+        Args:
+            step: (int) global step, by which intervals are counted and logged.
+            num_samples: (int) number of samples in the step.
+            metrics: (dict, optional) tag -> scalar tensor (or float) averaged over the interval.
+        """
+        now = time.perf_counter()
+        self.compute_time += now - self.last
+        self.last = now
+        self.num_samples += num_samples
+        if self.writer is not None:
+            for tag, value in (metrics or {}).items():
+                value = value.detach() if torch.is_tensor(value) else value
+                self.sums[tag] = self.sums[tag] + value if tag in self.sums else value
+                self.counts[tag] = self.counts.get(tag, 0) + 1
+        if step % self.log_freq == 0:
+            self.flush(step)
+
+    def flush(self, step):
+        """ Log the metrics of the current interval in the background, and start a new interval. """
+        if self.writer is not None:
+            elapsed = time.perf_counter() - self.interval_start
+            timings = {self.prefix + 'samples_per_sec': self.num_samples / elapsed,
+                       self.prefix + 'peak_rss_mb': peak_rss_mb(),
+                       self.prefix + 'data_time': self.data_time,
+                       self.prefix + 'compute_time': self.compute_time}
+            if self.pending is not None:
+                self.pending.result()
+            self.pending = self.executor.submit(self.write, step, self.sums, self.counts, timings)
+        self.reset()
+
+    def write(self, step, sums, counts, timings):
+        for tag, value in sums.items():
+            value = value.item() if torch.is_tensor(value) else value
+            self.writer.add_scalar(tag, value / counts[tag], step)
+        for tag, value in timings.items():
+            self.writer.add_scalar(tag, value, step)
+
+    def close(self):
+        if self.pending is not None:
+            self.pending.result()
+        self.executor.shutdown()
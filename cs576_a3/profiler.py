@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import queue
+import threading
+import multiprocessing as mp
+
+import torch
+
+
+class NullStage(object):
+    """ Stage of a disabled profiler, which does nothing. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.sync_cuda:
+            torch.cuda.synchronize()
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Timed(object):
+    """ Picklable wrapper of a function, which records every call to it as a stage. """
+    def __init__(self, profiler, name, fn):
+        self.profiler = profiler
+        self.name = name
+        self.fn = fn
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            self.profiler.record(self.name, start, time.perf_counter())
+
+
+class StageProfiler(object):
+    """ Wall time of the stages of a training loop, exported as a Chrome trace and summarized in a table.
+
+    Stages of the loop are timed with `stage` and `iterate`, and methods of a dataset with `instrument`.
+    Calls made in DataLoader workers are sent back through a queue, so they show up in the trace under
+    the pid of their worker. The profiler has to be enabled and the dataset instrumented before the
+    workers start. Whether to record is a shared flag, so that `stop` also stops persistent workers.
+
+    When disabled, `stage` returns a shared no-op context, and `iterate` and `instrument` leave their
+    arguments as they are, so the instrumented loop runs as if there were no profiler.
+
+    Args:
+        enabled: (bool) whether to record anything.
+        sync_cuda: (bool) synchronize the GPU at the end of every stage, so that stages measure the
+            kernels they queued. Only for profiling on GPU.
+    """
+    def __init__(self, enabled=False, sync_cuda=False):
+        self.enabled = enabled
+        self.sync_cuda = enabled and sync_cuda
+        self.pid = os.getpid()
+        self.events = []
+        self.queue = mp.Queue() if enabled else None
+        self.recording = mp.Value('b', enabled, lock=False) # shared with the workers.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['events'] = []
+        return state
+
+    def stage(self, name):
+        """ Context timing the stage `name`. """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def iterate(self, iterable, name='data'):
+        """ Iterate `iterable`, timing every `next` as the stage `name`, e.g. waiting on a DataLoader. """
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name)
+
+    def _iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, start, time.perf_counter())
+            yield item
+
+    def instrument(self, obj, names):
+        """ Time every call of the methods `names` of `obj`, e.g. the augmentations of a dataset. """
+        if self.enabled:
+            for name in names:
+                setattr(obj, name, Timed(self, name, getattr(obj, name)))
+
+    def record(self, name, start, end):
+        if not self.recording.value:
+            return
+        event = (name, os.getpid(), threading.get_ident(), start, end - start)
+        if os.getpid() == self.pid:
+            self.events.append(event)
+        else:
+            self.queue.put(event)
+
+    def collect(self):
+        """ Gather the events sent by the workers so far. """
+        if self.queue is None:
+            return
+        while True:
+            try:
+                self.events.append(self.queue.get(timeout=0.1))
+            except queue.Empty:
+                break
+
+    def stop(self, trace_path=None):
+        """ Stop recording, export the Chrome trace to `trace_path` if given, and print the summary. """
+        self.recording.value = False
+        self.collect()
+        self.enabled = False
+        self.sync_cuda = False
+        if trace_path is not None:
+            self.export_chrome_trace(trace_path)
+            print('Chrome trace is written to', trace_path)
+        print(self.summary())
+
+    def export_chrome_trace(self, path):
+        """ Write the events in the Chrome trace format, to be opened by chrome://tracing or Perfetto. """
+        t0 = min([event[3] for event in self.events] or [0])
+        trace = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': (start - t0) * 1e6, 'dur': duration * 1e6}
+                 for name, pid, tid, start, duration in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """ Table of the count, total and mean time of every stage. Worker stages are summed over the workers. """
+        stats = {}
+        for name, pid, _, _, duration in self.events:
+            where = 'main' if pid == self.pid else 'worker'
+            count, total = stats.get((where, name), (0, 0.))
+            stats[(where, name)] = (count + 1, total + duration)
+        main_total = sum(total for (where, _), (_, total) in stats.items() if where == 'main')
+        lines = ['%-6s %-18s %8s %12s %10s %7s' % ('where', 'stage', 'count', 'total (ms)', 'mean (ms)', 'share')]
+        for (where, name), (count, total) in sorted(stats.items(), key=lambda item: (item[0][0], -item[1][1])):
+            share = '%6.1f%%' % (total / main_total * 100) if where == 'main' and main_total > 0 else ''
+            lines.append('%-6s %-18s %8d %12.2f %10.3f %7s' % (where, name, count, total * 1e3, total / count * 1e3, share))
+        return '\n'.join(lines)
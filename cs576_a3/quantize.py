@@ -0,0 +1,166 @@
+""" Post-training int8 quantization of Yolo for CPU inference.
+
+The conv backbone is quantized statically, with activation ranges calibrated on a few batches, and the
+Linear detection head, which holds most of the parameters, dynamically with int8 weights.
+"""
+import io
+import copy
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, fuse_modules, quantize_dynamic
+
+
+def prepare_yolo(model, backend='x86'):
+    """ Copy of `model` on CPU whose backbone observes its activation ranges, ready for calibration.
+
+    Every Conv2d is fused with the ReLU following it, and the backbone is wrapped by quant/dequant stubs
+    so that it takes and returns float tensors as before.
+
+    Args:
+        model: (Yolo) trained model.
+        backend: (str) quantized engine, 'x86' or 'fbgemm' on x86 CPUs, 'qnnpack' on ARM.
+    Returns:
+        (Yolo) prepared model.
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    features = model.features
+    layers = list(features)
+    pairs = [[str(i), str(i+1)] for i in range(len(layers) - 1)
+             if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i+1], nn.ReLU)]
+    features = fuse_modules(features, pairs)
+    features = nn.Sequential(QuantStub(), features, DeQuantStub())
+    features.qconfig = get_default_qconfig(backend)
+    model.features = prepare(features)
+    return model
+
+
+def convert_yolo(model):
+    """ Convert a model prepared by `prepare_yolo` into int8: static backbone, dynamic Linear head. """
+    model.features = convert(model.features)
+    model.detector = quantize_dynamic(model.detector, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def quantize_yolo(model, calib_loader, num_batches=8, backend='x86'):
+    """ Quantize `model` into int8, calibrating the backbone on `calib_loader`.
+
+    Args:
+        model: (Yolo) trained model.
+        calib_loader: (DataLoader) yields (images, targets), e.g. of the VOCDetection test split.
+        num_batches: (int) number of batches of calib_loader used for calibration.
+        backend: (str) quantized engine.
+    Returns:
+        (Yolo) quantized model on CPU.
+    """
+    model = prepare_yolo(model, backend)
+    with torch.no_grad():
+        for i, (x, _) in enumerate(calib_loader):
+            if i == num_batches:
+                break
+            model.features(x)
+    return convert_yolo(model)
+
+
+def save_quantized(model, path, backend='x86'):
+    torch.save({'model': model.state_dict(), 'backend': backend}, path)
+
+
+def load_quantized(model, path):
+    """ Load a quantized checkpoint saved by `save_quantized`.
+
+    Args:
+        model: (Yolo) float model of the same architecture, whose weights are replaced.
+        path: (str) quantized checkpoint.
+    Returns:
+        (Yolo) quantized model on CPU.
+    """
+    ckpt = torch.load(path, map_location='cpu')
+    model = convert_yolo(prepare_yolo(model, ckpt['backend']))
+    model.load_state_dict(ckpt['model'])
+    return model
+
+
+def state_dict_bytes(model):
+    """ Size of the serialized state_dict of `model`. """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def latency(model, batch_size, image_size=224, repeat=5):
+    """ Median forward time of `model` on a random batch, in seconds. """
+    x = torch.rand((batch_size, 3, image_size, image_size))
+    times = []
+    with torch.no_grad():
+        model(x) # warmup
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(x)
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def report(fp32_model, int8_model, loader, compute_loss, decode, decode_map=None, batch_sizes=(1, 8), num_batches=None):
+    """ Compare the int8 model against fp32: size, latency, loss, detections and mAP on `loader`.
+
+    Args:
+        fp32_model, int8_model: (Yolo) models in eval mode on CPU.
+        loader: (DataLoader) yields (images, targets), or (images, targets, boxes, labels) with the padded ground
+            truths to evaluate the mAP, e.g. of the VOCDetection test split.
+        compute_loss: (callable) (y_pred, y) -> final loss, as in the training loop.
+        decode: (callable) output grids -> list of (bboxes, class_idxs, probs) per image, e.g. decode_batch.
+        decode_map: (callable, optional) decode of the mAP, which takes `padded=True`, e.g. decode_batch with a
+            low score threshold. (default: decode)
+        batch_sizes: (tuple) batch sizes at which latency is measured.
+        num_batches: (int, optional) number of batches of loader to evaluate. (default: all)
+    Returns:
+        (dict) report, also printed.
+    """
+    result = {'size_mb': {}, 'latency_ms': {}, 'loss': {}}
+    for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+        result['size_mb'][name] = state_dict_bytes(model) / 2**20
+        result['latency_ms'][name] = {bs: latency(model, bs) * 1e3 for bs in batch_sizes}
+
+    # detections of fp32 reproduced by int8: same class and IoU over 0.5.
+    from box_ops import compute_iou
+    from voc_eval import VOCEvaluator
+    decode_map = decode_map or decode
+    loss = {'fp32': 0., 'int8': 0.}
+    evaluators = {'fp32': VOCEvaluator(), 'int8': VOCEvaluator()}
+    num_images, matched, num_dets = 0, 0, 0
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            if i == num_batches:
+                break
+            x, y = batch[:2]
+            y_fp32, y_int8 = fp32_model(x), int8_model(x)
+            if len(batch) == 4:
+                evaluators['fp32'].update(decode_map(y_fp32, padded=True), batch[2], batch[3])
+                evaluators['int8'].update(decode_map(y_int8, padded=True), batch[2], batch[3])
+            loss['fp32'] += compute_loss(y_fp32, y).item() * len(x)
+            loss['int8'] += compute_loss(y_int8, y).item() * len(x)
+            num_images += len(x)
+            for (b1, c1, _), (b2, c2, _) in zip(decode(y_fp32), decode(y_int8)):
+                num_dets += len(b1)
+                if len(b1) and len(b2):
+                    same = (compute_iou(b1, b2) > 0.5) & (c1[:, None] == c2[None, :])
+                    matched += int(same.any(1).sum())
+    result['loss'] = {name: value / max(num_images, 1) for name, value in loss.items()}
+    result['detection_agreement'] = matched / num_dets if num_dets else 1.
+    if evaluators['fp32'].num_images:
+        result['map'] = {name: evaluator.compute()['map_area'] for name, evaluator in evaluators.items()}
+
+    print('quantization report (%d images)' % num_images)
+    print('  size     fp32: %8.1f MB  int8: %8.1f MB  (x%.1f smaller)'
+          % (result['size_mb']['fp32'], result['size_mb']['int8'], result['size_mb']['fp32'] / result['size_mb']['int8']))
+    for bs in batch_sizes:
+        t_fp32, t_int8 = result['latency_ms']['fp32'][bs], result['latency_ms']['int8'][bs]
+        print('  latency  fp32: %8.1f ms  int8: %8.1f ms  (batch %d, x%.2f)' % (t_fp32, t_int8, bs, t_fp32 / t_int8))
+    print('  loss     fp32: %8.4f     int8: %8.4f' % (result['loss']['fp32'], result['loss']['int8']))
+    print('  fp32 detections reproduced by int8: %.1f%%' % (result['detection_agreement'] * 100))
+    if 'map' in result:
+        print('  mAP      fp32: %8.4f     int8: %8.4f' % (result['map']['fp32'], result['map']['int8']))
+    return result
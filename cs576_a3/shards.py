@@ -0,0 +1,297 @@
+""" Sharded storage of datasets: encoded images packed into large tar shards, read sequentially.
+
+Reading VOC or CIFAR10 opens one small file per image, which caps the throughput on network filesystems.
+The packer writes the encoded images (and their labels/boxes in a json member) into tar shards of about
+`shard_bytes` each, along with an index mapping every key to its shard and byte range. Shards are made
+smaller when needed for a split to have at least `min_shards` of them, so that DataLoader workers all get
+some. The datasets then
+read either layout: given a ShardReader, VOCDetection and CIFAR10 read the bytes of an image with one read
+in an open shard instead of opening its file. ShardedIterableDataset reads them in shard order, so that
+every DataLoader worker streams through whole shards, or through parts of them when there are fewer
+shards than workers.
+
+Usage:
+    python shards.py voc dataset dataset/shards
+    python shards.py cifar dataset/cifar10 dataset/cifar10/shards
+"""
+import io
+import os
+import json
+import math
+import random
+import tarfile
+import argparse
+import multiprocessing as mp
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+class ShardWriter(object):
+    """ Write records into tar shards `<name>-00000.tar`, ... in `out_dir`, and their index `<name>.index.json`.
+
+    Every record is a member `<key>` with the encoded image. The metadata of the records of a shard, e.g. their
+    labels, are written at its end as the member `meta.json`, a json object keyed by record, rather than as one
+    member per record, which would double the tar headers and padding of small images such as CIFAR10.
+    The index records where the `meta.json` of every shard is, so ShardReader checks the shards against it.
+    A new shard is started once the current one exceeds `shard_bytes`.
+
+    Args:
+        out_dir: (str) directory of the shards.
+        name: (str) prefix of the shards and of the index, e.g. 'voc_train'.
+        shard_bytes: (int) size from which a new shard is started.
+    """
+    def __init__(self, out_dir, name, shard_bytes=256 * 2**20):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        self.name = name
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self.shard_metas = [] # (offset, size) of the meta.json of every shard.
+        self.records = {}
+        self.metas = {}
+        self.tar = None
+
+    def next_shard(self):
+        self.close_shard()
+        self.shards.append('%s-%05d.tar' % (self.name, len(self.shards)))
+        self.tar = tarfile.open(os.path.join(self.out_dir, self.shards[-1] + '.tmp'), 'w', format=tarfile.GNU_FORMAT)
+
+    def close_shard(self):
+        if self.tar is not None:
+            data = json.dumps(self.metas).encode()
+            self.shard_metas.append([self.add('meta.json', data), len(data)])
+            self.metas = {}
+            self.tar.close()
+            path = os.path.join(self.out_dir, self.shards[-1])
+            os.replace(path + '.tmp', path)
+            self.tar = None
+
+    def add(self, name, data):
+        """ Append a member, returning the byte offset of its data in the shard. """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        return self.tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+    def write(self, key, data, meta=None):
+        """ Write the encoded image `data` (bytes) of `key` with its json-serializable `meta`. """
+        if self.tar is None or self.tar.offset >= self.shard_bytes:
+            self.next_shard()
+        offset = self.add(key, data)
+        self.metas[key] = meta
+        self.records[key] = [len(self.shards) - 1, offset, len(data)]
+
+    def close(self):
+        """ Close the last shard and write the index. Returns the path of the index. """
+        self.close_shard()
+        path = os.path.join(self.out_dir, self.name + '.index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'shards': self.shards, 'metas': self.shard_metas, 'records': self.records}, f)
+        os.replace(path + '.tmp', path)
+        return path
+
+
+class ShardReader(object):
+    """ Random access to the images of the shards written by ShardWriter, through their index.
+
+    Shards are opened lazily and kept open. Reads do not move a shared file offset, so a reader can be handed
+    to forked DataLoader workers. Unless `validate` is False, the records listed in the `meta.json` of every
+    shard are checked against the index, which catches shards repacked or truncated after the index was written.
+
+    Args:
+        index_path: (str) `<name>.index.json` written by ShardWriter.
+        validate: (bool) check the shards against the index.
+    """
+    def __init__(self, index_path, validate=True):
+        self.index_path = index_path
+        with open(index_path) as f:
+            index = json.load(f)
+        self.shard_dir = os.path.dirname(index_path)
+        self.shards = index['shards']
+        self.shard_metas = index['metas']
+        self.records = index['records']
+        self.files = {}
+        self.metas = {} # shard -> its meta.json, read on demand.
+        self.preloaded = {} # key -> bytes already read, e.g. by ShardedIterableDataset.
+        if validate:
+            self.validate()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['files'] = {}
+        state['metas'] = {}
+        state['preloaded'] = {}
+        return state
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def locate(self, key):
+        """ (shard, offset, size) of the image of `key`. """
+        return self.records[key]
+
+    def pread(self, shard, offset, size):
+        if shard not in self.files:
+            self.files[shard] = os.open(os.path.join(self.shard_dir, self.shards[shard]), os.O_RDONLY)
+        return os.pread(self.files[shard], size, offset)
+
+    def read(self, key):
+        """ Encoded bytes of the image of `key`. """
+        if key in self.preloaded:
+            return self.preloaded.pop(key)
+        return self.pread(*self.records[key])
+
+    def meta(self, key):
+        """ Metadata written with the image of `key`, e.g. its labels. """
+        shard = self.records[key][0]
+        if shard not in self.metas:
+            self.metas[shard] = json.loads(self.pread(shard, *self.shard_metas[shard]))
+        return self.metas[shard][key]
+
+    def validate(self):
+        """ Raise ValueError unless the meta.json of every shard lists exactly the records the index maps to it. """
+        counts = [0] * len(self.shards)
+        for shard, _, _ in self.records.values():
+            counts[shard] += 1
+        for shard, name in enumerate(self.shards):
+            try:
+                metas = json.loads(self.pread(shard, *self.shard_metas[shard]))
+            except (OSError, ValueError):
+                metas = None
+            if metas is None or len(metas) != counts[shard] or \
+                    any(self.records.get(key, (None,))[0] != shard for key in metas):
+                raise ValueError('shard %s does not match its index %s, pack the dataset again.' % (name, self.index_path))
+
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
+
+
+class ShardedIterableDataset(IterableDataset):
+    """ Iterate a dataset in sharded layout shard by shard, so that its images are read sequentially.
+
+    Shards are shuffled every epoch and split across DataLoader workers. When there are fewer shards than
+    workers, every shard is cut into as many contiguous parts as needed for each worker to get one. Every
+    worker reads the encoded images of its shards in order into a shuffle buffer of `buffer_size`, and
+    decodes and transforms each image through the dataset when it leaves the buffer, so the buffer only holds
+    encoded bytes. The order of the items depends on the seed, the epoch and the number of workers.
+
+    Args:
+        dataset: (Dataset) map-style dataset reading its images from `dataset.shards` (ShardReader), which
+            names the record of item idx with `dataset.shard_key(idx)`, e.g. VOCDetection or CIFAR10.
+        shuffle: (bool) shuffle the shards and the items.
+        buffer_size: (int) number of items of the shuffle buffer. 1 disables shuffling within shards.
+        seed: (int) base seed of the shuffles.
+    """
+    def __init__(self, dataset, shuffle=True, buffer_size=1000, seed=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, 1)
+        self.seed = seed
+        self.epoch = mp.Value('i', 0, lock=False) # shared, so that persistent workers see the epoch change.
+
+        # items of every shard in the order of their bytes.
+        located = sorted((dataset.shards.locate(dataset.shard_key(idx))[:2], idx) for idx in range(len(dataset)))
+        self.shard_items = {}
+        for (shard, _), idx in located:
+            self.shard_items.setdefault(shard, []).append(idx)
+
+    def set_epoch(self, epoch):
+        """ Reshuffle for `epoch`. Call it before every epoch. """
+        self.epoch.value = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def worker_shards(self):
+        """ Items of every shard, or part of shard, read by this worker, and the id of the worker. """
+        shards = sorted(self.shard_items)
+        if self.shuffle:
+            random.Random(self.seed * 1000003 + self.epoch.value).shuffle(shards)
+        worker = get_worker_info()
+        if worker is None:
+            return [self.shard_items[shard] for shard in shards], 0
+        num_parts = math.ceil(worker.num_workers / len(shards)) if shards else 1
+        parts = []
+        for shard in shards:
+            items = self.shard_items[shard]
+            bounds = [len(items) * i // num_parts for i in range(num_parts + 1)]
+            parts.extend(items[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start)
+        return parts[worker.id::worker.num_workers], worker.id
+
+    def __iter__(self):
+        parts, worker_id = self.worker_shards()
+        rng = random.Random((self.seed * 1000003 + self.epoch.value) * 1009 + worker_id)
+        reader = self.dataset.shards
+        buffer_size = self.buffer_size if self.shuffle else 1
+        buffer = []
+        for items in parts:
+            for idx in items:
+                key = self.dataset.shard_key(idx)
+                buffer.append((idx, key, reader.read(key)))
+                if len(buffer) < buffer_size:
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield self.load(*buffer.pop())
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self.load(*record)
+
+    def load(self, idx, key, data):
+        self.dataset.shards.preloaded[key] = data
+        return self.dataset[idx]
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def split_shard_bytes(paths, shard_bytes, min_shards):
+    """ `shard_bytes`, reduced so that the files of `paths` fill at least `min_shards` shards. """
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    return max(min(shard_bytes, total_bytes // max(min_shards, 1)), 1)
+
+
+def pack_voc(root, out_dir, splits=('train', 'test'), shard_bytes=256 * 2**20, min_shards=32):
+    """ Pack the images of VOCDetection under `root` into `<out_dir>/voc_<split>-*.tar`, with their boxes and labels. """
+    from data import VOCDetection
+    for split in splits:
+        dset = VOCDetection(root, split)
+        paths = [os.path.join(root, 'images', str(fname)) for fname in dset.fnames]
+        writer = ShardWriter(out_dir, 'voc_%s' % split, split_shard_bytes(paths, shard_bytes, min_shards))
+        for idx, (fname, path) in enumerate(zip(dset.fnames, paths)):
+            meta = {'boxes': dset.boxes[idx].tolist(), 'labels': dset.labels[idx].tolist()}
+            writer.write(str(fname), read_file(path), meta)
+        print('%d images of %s are packed into %d shards: %s' % (len(dset), split, len(writer.shards), writer.close()))
+
+
+def pack_cifar(root, out_dir, shard_bytes=256 * 2**20, min_shards=32):
+    """ Pack the images of `root`/<split>/<class>/*.png into `<out_dir>/cifar10_<split>-*.tar`, with their labels. """
+    for split in ('train', 'test'):
+        classes = sorted(os.listdir(os.path.join(root, split)), key=int)
+        keys = ['%s/%s/%s' % (split, label, name) for label in classes
+                for name in sorted(os.listdir(os.path.join(root, split, label)))]
+        writer = ShardWriter(out_dir, 'cifar10_%s' % split,
+                             split_shard_bytes([os.path.join(root, key) for key in keys], shard_bytes, min_shards))
+        for key in keys:
+            writer.write(key, read_file(os.path.join(root, key)), {'label': int(key.split('/')[1])})
+        print('%d images of %s are packed into %d shards: %s' % (len(writer.records), split, len(writer.shards), writer.close()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a dataset into tar shards.')
+    parser.add_argument('dataset', choices=['voc', 'cifar'])
+    parser.add_argument('root', help="dataset root, e.g. 'dataset' for voc or 'dataset/cifar10' for cifar.")
+    parser.add_argument('out_dir', help='directory of the shards and their indices.')
+    parser.add_argument('--shard-mb', type=int, default=256, help='maximum size of a shard in MB.')
+    parser.add_argument('--min-shards', type=int, default=32,
+                        help='minimum number of shards per split, so that every DataLoader worker gets some.')
+    args = parser.parse_args()
+    if args.dataset == 'voc':
+        pack_voc(args.root, args.out_dir, shard_bytes=args.shard_mb * 2**20, min_shards=args.min_shards)
+    else:
+        pack_cifar(args.root, args.out_dir, shard_bytes=args.shard_mb * 2**20, min_shards=args.min_shards)
@@ -0,0 +1,151 @@
+""" Streaming VOC mAP of batched detections.
+
+By default detections are counted into per-class histograms of probability, whose memory is bounded regardless of
+the number of images. The exact mode (num_bins=None) keeps every detection instead, so its memory grows with the
+number of images; it serves as the reference.
+"""
+import numpy as np
+
+import torch
+
+from box_ops import compute_iou
+
+
+def match_detections(bboxes, class_idxs, probs, gt_boxes, gt_labels, iou_threshold=0.5):
+    """ Match the detections of a batch to the ground truths as in the VOC protocol, all images at once.
+
+    Every detection goes to the ground truth of its class it overlaps the most. It is a true positive if the IoU
+    reaches `iou_threshold` and no detection of higher probability went to the same ground truth before it,
+    which is the greedy matching of VOC in the order of probabilities, without its loop.
+
+    Args:
+        bboxes, class_idxs, probs: (Tensor) padded detections as returned by decode_batch(..., padded=True), sized
+            [N, K, 4], [N, K], [N, K], ordered by probability within each image. Paddings have class_idx -1.
+        gt_boxes: (Tensor) [x1, y1, x2, y2] of the ground truths, normalized as the detections, sized [N, G, 4].
+        gt_labels: (Tensor) class labels starting from 1, sized [N, G]. 0 marks padding.
+        iou_threshold: (float) minimum IoU of a true positive.
+    Returns:
+        (Tensor) whether each detection is a true positive, sized [N, K].
+    """
+    N, K = class_idxs.shape
+    G = gt_labels.shape[1]
+    if K == 0 or G == 0:
+        return torch.zeros((N, K), dtype=torch.bool, device=class_idxs.device)
+    same_class = (class_idxs.unsqueeze(2) == gt_labels.unsqueeze(1) - 1) & (gt_labels.unsqueeze(1) > 0) # [N, K, G]
+    iou = compute_iou(bboxes, gt_boxes).masked_fill(~same_class, -1) # [N, K, G]
+    best_iou, best_gt = iou.max(-1) # [N, K]
+    matched = (best_iou >= iou_threshold) & (class_idxs >= 0)
+
+    # the first matched detection of every ground truth is the true positive, later ones are duplicates.
+    slot = torch.arange(K, device=class_idxs.device).expand(N, K)
+    key = (torch.arange(N, device=class_idxs.device).unsqueeze(1) * G + best_gt)[matched]
+    first = torch.full((N * G,), K, dtype=torch.long, device=class_idxs.device)
+    first.scatter_reduce_(0, key, slot[matched], reduce='amin')
+    tp = torch.zeros((N, K), dtype=torch.bool, device=class_idxs.device)
+    tp[matched] = first[key] == slot[matched]
+    return tp
+
+
+class VOCEvaluator(object):
+    """ VOC mAP accumulated batch by batch, e.g. inside the evaluation loop.
+
+    Detections are matched per batch by `match_detections`, and their boxes are not kept.
+
+    Bounded mode (default, `num_bins` given): true and false positives are counted in per-class histograms over
+    `num_bins` bins of probability. Memory stays [C, num_bins] however many images are evaluated, but detections
+    of the same bin are ranked together, so AP can differ from the exact one, e.g. in the 4th decimal.
+
+    Exact mode (`num_bins=None`): the class, probability and TP flag of every detection are kept and sorted
+    exactly at `compute`, which gives the AP of the VOC protocol. Memory grows with the number of detections.
+
+    Args:
+        num_classes: (int) C, number of the object classes.
+        iou_threshold: (float) minimum IoU of a true positive.
+        num_bins: (int, optional) resolution of the probabilities of the histograms, or None for the exact mode.
+    """
+    def __init__(self, num_classes=20, iou_threshold=0.5, num_bins=10000):
+        self.num_classes = num_classes
+        self.iou_threshold = iou_threshold
+        self.num_bins = num_bins
+        self.reset()
+
+    def reset(self):
+        if self.num_bins is not None:
+            self.tp = torch.zeros((self.num_classes, self.num_bins), dtype=torch.long)
+            self.fp = torch.zeros((self.num_classes, self.num_bins), dtype=torch.long)
+        self.detections = [] # (class_idxs, probs, tp) of every batch, when exact.
+        self.num_gts = torch.zeros(self.num_classes, dtype=torch.long)
+        self.num_images = 0
+
+    def update(self, detections, gt_boxes, gt_labels):
+        """ Accumulate the detections of a batch against its ground truths.
+
+        Args:
+            detections: (tuple) (bboxes, class_idxs, probs, num_dets) of decode_batch(..., padded=True).
+            gt_boxes: (Tensor) [x1, y1, x2, y2] normalized in image-size, sized [N, G, 4].
+            gt_labels: (Tensor) class labels starting from 1, sized [N, G]. 0 marks padding.
+        """
+        bboxes, class_idxs, probs = detections[:3]
+        gt_boxes, gt_labels = gt_boxes.to(bboxes.device), gt_labels.to(bboxes.device)
+        tp = match_detections(bboxes.float(), class_idxs, probs, gt_boxes.float(), gt_labels, self.iou_threshold)
+
+        valid = class_idxs >= 0
+        if self.num_bins is None:
+            self.detections.append((class_idxs[valid].cpu(), probs[valid].float().cpu(), tp[valid].cpu()))
+        else:
+            bins = (probs[valid].float() * self.num_bins).long().clamp(0, self.num_bins - 1)
+            index = (class_idxs[valid] * self.num_bins + bins).cpu()
+            tp = tp[valid].cpu()
+            self.tp.view(-1).index_add_(0, index[tp], torch.ones_like(index[tp]))
+            self.fp.view(-1).index_add_(0, index[~tp], torch.ones_like(index[~tp]))
+        labels = gt_labels[gt_labels > 0].cpu() - 1
+        self.num_gts += torch.bincount(labels, minlength=self.num_classes)
+        self.num_images += len(class_idxs)
+
+    def precision_recall(self):
+        """ Precision and recall of every class from the highest probability down: a list of C arrays, one entry
+        per detection of the class, or per bin with `num_bins`. """
+        if self.num_bins is None:
+            if not self.detections:
+                return [np.zeros(0)] * self.num_classes, [np.zeros(0)] * self.num_classes
+            class_idxs, probs, tp = (torch.cat(t) for t in zip(*self.detections))
+            order = probs.argsort(descending=True, stable=True)
+            class_idxs, tp = class_idxs[order], tp[order]
+            tp = [tp[class_idxs == c] for c in range(self.num_classes)]
+            fp = [(~t).long().cumsum(0).double() for t in tp]
+            tp = [t.long().cumsum(0).double() for t in tp]
+        else:
+            tp = self.tp.flip(1).cumsum(1).double()
+            fp = self.fp.flip(1).cumsum(1).double()
+        precision, recall = [], []
+        for c in range(self.num_classes):
+            recall.append((tp[c] / max(int(self.num_gts[c]), 1)).numpy())
+            precision.append((tp[c] / (tp[c] + fp[c]).clamp(min=1)).numpy())
+        return precision, recall
+
+    def compute(self):
+        """ AP of every class and their mean, by the VOC07 11-point and the area under the precision envelope.
+
+        Returns:
+            (dict) {'ap_11point': [C], 'ap_area': [C], 'map_11point': float, 'map_area': float, 'num_images': int}.
+            Classes without ground truth have AP nan and are left out of the means.
+        """
+        precision, recall = self.precision_recall()
+        ap_11point, ap_area = [], []
+        for c in range(self.num_classes):
+            if self.num_gts[c] == 0:
+                ap_11point.append(float('nan'))
+                ap_area.append(float('nan'))
+                continue
+            prec, rec = precision[c], recall[c]
+            ap_11point.append(np.mean([prec[rec >= t].max() if (rec >= t).any() else 0. for t in np.arange(0., 1.1, 0.1)]))
+
+            # area under the envelope of precision, which decreases with recall.
+            mrec = np.concatenate([[0.], rec, [1.]])
+            mpre = np.concatenate([[0.], prec, [0.]])
+            mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+            ap_area.append(float(np.sum((mrec[1:] - mrec[:-1]) * mpre[1:])))
+        return {'ap_11point': ap_11point, 'ap_area': ap_area,
+                'map_11point': float(np.nanmean(ap_11point)) if self.num_gts.any() else float('nan'),
+                'map_area': float(np.nanmean(ap_area)) if self.num_gts.any() else float('nan'),
+                'num_images': self.num_images}